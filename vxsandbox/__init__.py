@@ -4,12 +4,14 @@ from .worker import Sandbox, JsSandbox, JsFileSandbox
 from .utils import SandboxError
 from .resources import (
     SandboxResource, LoggingResource, HttpClientResource,
-    MetricsResource, OutboundResource, RedisResource)
+    MetricsResource, OutboundResource, RedisResource, HashRedisResource,
+    SqliteKvResource)
 
 __version__ = "0.6.2-alpha2"
 
 __all__ = [
     "Sandbox", "JsSandbox", "JsFileSandbox", "SandboxError", "SandboxResource",
     "LoggingResource", "HttpClientResource", "MetricsResource",
-    "OutboundResource", "RedisResource",
+    "OutboundResource", "RedisResource", "HashRedisResource",
+    "SqliteKvResource",
 ]
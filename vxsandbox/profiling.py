@@ -0,0 +1,89 @@
+# -*- test-case-name: vxsandbox.tests.test_profiling -*-
+
+"""On-demand profiling of the sandbox worker's reactor thread."""
+
+import cProfile
+import os
+import time
+from string import Template
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+
+from vumi import log
+
+
+class ReactorProfiler(object):
+    """
+    Runs :mod:`cProfile` for a fixed period and writes a pstats dump.
+
+    By default everything that runs in the reactor thread while the
+    profiler is running is profiled. If ``sandbox_id`` is given, only
+    calls made through :meth:`call` on behalf of that sandbox are
+    profiled. For sandbox commands this covers the synchronous part of
+    each handler and not any callbacks that fire later.
+
+    :param int duration:
+        Number of seconds to profile for.
+    :param str path:
+        Path to write the pstats dump to. May contain ``$pid`` and
+        ``$timestamp`` placeholders, written as in :class:`string.Template`.
+        Any other ``$`` or ``%`` characters are left as they are.
+    :param str sandbox_id:
+        Optional sandbox id to limit profiling to.
+    """
+
+    def __init__(self, duration, path, sandbox_id=None, clock=reactor):
+        self.duration = duration
+        self.path = path
+        self.sandbox_id = sandbox_id
+        self.clock = clock
+        self._profile = None
+        self._stop_call = None
+        self._done = None
+
+    @property
+    def running(self):
+        return self._profile is not None
+
+    def start(self):
+        """
+        Start profiling. Returns a deferred that fires with the path of
+        the dump once profiling stops. Returns ``None`` if the profiler is
+        already running.
+        """
+        if self.running:
+            log.warning("Profiler already running, ignoring request to start.")
+            return None
+        self._profile = cProfile.Profile()
+        if self.sandbox_id is None:
+            self._profile.enable()
+        self._stop_call = self.clock.callLater(self.duration, self.stop)
+        self._done = Deferred()
+        log.info("Profiling for %s seconds." % (self.duration,))
+        return self._done
+
+    def stop(self):
+        """Stop profiling and write the dump."""
+        if not self.running:
+            return
+        if self._stop_call.active():
+            self._stop_call.cancel()
+        profile, self._profile = self._profile, None
+        profile.disable()
+        path = Template(self.path).safe_substitute(
+            pid=os.getpid(), timestamp=int(time.time()))
+        profile.dump_stats(path)
+        log.info("Profile written to %s." % (path,))
+        done, self._done = self._done, None
+        done.callback(path)
+
+    def call(self, sandbox_id, func, *args, **kw):
+        """
+        Call ``func``, profiling the call if the profiler is running and
+        limited to ``sandbox_id``.
+        """
+        if (not self.running or self.sandbox_id is None or
+                sandbox_id != self.sandbox_id):
+            return func(*args, **kw)
+        return self._profile.runcall(func, *args, **kw)
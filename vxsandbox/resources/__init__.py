@@ -3,12 +3,14 @@
 from .utils import SandboxResource, SandboxCommand, SandboxResources
 from .logging import LoggingResource
 from .http import HttpClientResource
-from .kv import RedisResource
+from .kv import RedisResource, HashRedisResource
+from .sqlite_kv import SqliteKvResource
 from .metrics import MetricsResource
 from .outbound import OutboundResource
 
 __all__ = [
     "SandboxResource", "SandboxCommand", "SandboxResources",
     "LoggingResource", "HttpClientResource", "MetricsResource",
-    "OutboundResource", "RedisResource",
+    "OutboundResource", "RedisResource", "HashRedisResource",
+    "SqliteKvResource",
 ]
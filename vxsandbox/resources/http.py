@@ -3,22 +3,89 @@
 """An HTTP client resource for Vumi's application sandbox."""
 
 import base64
+import math
 import operator
+import zlib
+from collections import OrderedDict, deque
+from functools import partial
 from StringIO import StringIO
+from urlparse import urlparse
+
+from zope.interface import implementer
 
 from twisted.internet import reactor
-from twisted.internet.defer import succeed, maybeDeferred
-from twisted.web.client import WebClientContextFactory, Agent
+from twisted.internet.defer import (
+    Deferred, DeferredSemaphore, CancelledError, succeed, fail,
+    maybeDeferred, inlineCallbacks, gatherResults)
+from twisted.internet.interfaces import (
+    IOpenSSLClientConnectionCreator, IHostResolution, IHostnameResolver,
+    IResolutionReceiver, IReactorPluggableNameResolver, IReactorTCP,
+    IReactorTime)
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+from twisted.web.client import (
+    WebClientContextFactory, Agent, HTTPConnectionPool, ResponseDone)
+from twisted.web.http import stringToDatetime, PotentialDataLoss
+from twisted.web.iweb import IPolicyForHTTPS
 
 from OpenSSL.SSL import (
-    VERIFY_PEER, VERIFY_FAIL_IF_NO_PEER_CERT, VERIFY_CLIENT_ONCE, VERIFY_NONE,
-    SSLv3_METHOD, SSLv23_METHOD, TLSv1_METHOD)
+    Connection, VERIFY_PEER, VERIFY_FAIL_IF_NO_PEER_CERT, VERIFY_CLIENT_ONCE,
+    VERIFY_NONE, SSLv3_METHOD, SSLv23_METHOD, TLSv1_METHOD)
 
 from treq.client import HTTPClient
 
+from vumi import log
 from vumi.utils import HttpDataLimitError
 
-from .utils import SandboxResource
+from .utils import SandboxResource, StatsMixin, LRUCache
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class ResumingCreator(object):
+    """
+    Wraps a client connection creator so that each new connection offers
+    the server the TLS session of the previous connection. Servers that
+    support session resumption then skip the full handshake.
+    """
+
+    def __init__(self, creator):
+        self.creator = creator
+        self._connection = None
+        self._session = None
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = self.creator.clientConnectionForTLS(tlsProtocol)
+        if self._connection is not None:
+            session = self._connection.get_session()
+            if session is not None:
+                self._session = session
+        if self._session is not None:
+            connection.set_session(self._session)
+        self._connection = connection
+        return connection
+
+
+class CreatorCache(object):
+    """
+    Keeps the TLS connection creators of the most recently used hosts, so
+    that their contexts and sessions are reused by later connections.
+    """
+
+    MAX_CREATORS = 100
+
+    def __init__(self):
+        self._creators = OrderedDict()
+
+    def get(self, hostname, port, make_creator):
+        key = (hostname, port)
+        creator = self._creators.pop(key, None)
+        if creator is None:
+            creator = ResumingCreator(make_creator())
+            while len(self._creators) >= self.MAX_CREATORS:
+                self._creators.popitem(last=False)
+        self._creators[key] = creator
+        return creator
+
 
 try:
     from twisted.web.client import BrowserLikePolicyForHTTPS
@@ -32,8 +99,13 @@ try:
         def __init__(self, ssl_method=None):
             super(HttpClientPolicyForHTTPS, self).__init__()
             self.ssl_method = ssl_method
+            self._creators = CreatorCache()
 
         def creatorForNetloc(self, hostname, port):
+            return self._creators.get(
+                hostname, port, lambda: self._make_creator(hostname))
+
+        def _make_creator(self, hostname):
             options = {}
             if self.ssl_method is not None:
                 options['method'] = self.ssl_method
@@ -44,16 +116,50 @@ except ImportError:
     HttpClientPolicyForHTTPS = None
 
 
+@implementer(IOpenSSLClientConnectionCreator)
+class ContextClientCreator(object):
+    """
+    Client connection creator for a fixed context. No host verification
+    is done.
+    """
+    def __init__(self, context):
+        self._context = context
+
+    def getContext(self):
+        return self._context
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = Connection(self._context, None)
+        connection.set_app_data(tlsProtocol)
+        connection.set_connect_state()
+        return connection
+
+
+@implementer(IPolicyForHTTPS)
 class HttpClientContextFactory(object):
     """
     This context factory is used if we have a Twisted version older than 14.0.0
     or if we are explicitly disabling host verification.
+
+    The context is built once and shared by all connections.
     """
     def __init__(self, verify_options=None, ssl_method=None):
         self.verify_options = verify_options
         self.ssl_method = ssl_method
+        self._context = None
+        self._creators = CreatorCache()
+
+    def creatorForNetloc(self, hostname, port):
+        return self._creators.get(
+            hostname, port,
+            lambda: ContextClientCreator(self.getContext(hostname, port)))
 
     def getContext(self, hostname, port):
+        if self._context is None:
+            self._context = self._make_context()
+        return self._context
+
+    def _make_context(self):
         context = self._get_noverify_context()
 
         if self.verify_options in (None, VERIFY_NONE):
@@ -87,7 +193,659 @@ def make_context_factory(ssl_method=None, verify_options=None):
         return HttpClientPolicyForHTTPS(ssl_method=ssl_method)
 
 
-class HttpClientResource(SandboxResource):
+@implementer(IHostResolution)
+class HostResolution(object):
+    """A hostname resolution started by :class:`CachingHostnameResolver`."""
+
+    def __init__(self, name):
+        self.name = name
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Stop delivering addresses to the resolution's receiver. The lookup
+        itself carries on, so that its result is still cached.
+        """
+        self.cancelled = True
+
+
+@implementer(IResolutionReceiver)
+class AddressCollector(object):
+    """
+    Resolution receiver that fires ``finished`` with the list of resolved
+    addresses.
+    """
+
+    def __init__(self, finished):
+        self.finished = finished
+        self.addresses = []
+
+    def resolutionBegan(self, resolutionInProgress):
+        pass
+
+    def addressResolved(self, address):
+        self.addresses.append(address)
+
+    def resolutionComplete(self):
+        self.finished.callback(self.addresses)
+
+
+@implementer(IHostnameResolver)
+class CachingHostnameResolver(object):
+    """
+    Hostname resolver that caches the addresses found by another
+    resolver.
+
+    The system resolver doesn't report the TTLs of the records it finds,
+    so resolved addresses are cached for a fixed number of seconds.
+    Hostnames that don't resolve are cached too, for a shorter time. A
+    cached hostname that is used after ``PREFETCH_AFTER`` of its lifetime
+    has passed is resolved again in the background, so that hosts in
+    constant use don't wait for the resolver when their entries expire.
+    If a background lookup finds nothing, the cached addresses are kept
+    until they expire and the lookup is retried after ``negative_ttl``.
+
+    :param resolver:
+        The :class:`IHostnameResolver` to look hostnames up with.
+    :param float ttl:
+        Number of seconds resolved addresses are cached for.
+    :param float negative_ttl:
+        Number of seconds hostnames that don't resolve are cached for.
+    :param clock:
+        Provider of the current time.
+    :param StatsCollector stats:
+        Collector to record ``dns.hits``, ``dns.misses`` and
+        ``dns.prefetches`` in, or ``None`` to record nothing.
+    """
+
+    #: Fraction of an entry's lifetime after which using it causes it to
+    #: be resolved again in the background.
+    PREFETCH_AFTER = 0.8
+
+    #: Maximum number of hostnames cached. The least recently used ones
+    #: are removed to make room for new ones.
+    MAX_ENTRIES = 1000
+
+    def __init__(self, resolver, ttl, negative_ttl, clock, stats=None):
+        self.resolver = resolver
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.stats = stats
+        self._entries = OrderedDict()
+        self._lookups = {}
+
+    def _incr_stat(self, name):
+        if self.stats is not None:
+            self.stats.incr(name)
+
+    def resolveHostName(self, resolutionReceiver, hostName, portNumber=0,
+                        addressTypes=None, transportSemantics='TCP'):
+        resolution = HostResolution(hostName)
+        resolutionReceiver.resolutionBegan(resolution)
+        key = (hostName, portNumber,
+               tuple(addressTypes) if addressTypes is not None else None,
+               transportSemantics)
+        now = self.clock.seconds()
+        entry = self._entries.pop(key, None)
+        if entry is not None and now < entry[1]:
+            self._incr_stat('dns.hits')
+            addresses, expires, prefetch_at = entry
+            self._entries[key] = entry
+            if addresses and now >= prefetch_at and key not in self._lookups:
+                self._incr_stat('dns.prefetches')
+                self._lookup(key).addErrback(
+                    log.err, "Error prefetching %r" % (hostName,))
+            d = succeed(addresses)
+        else:
+            self._incr_stat('dns.misses')
+            d = self._lookup(key)
+        d.addCallback(self._deliver, resolution, resolutionReceiver)
+        return resolution
+
+    def _lookup(self, key):
+        """
+        Resolve a hostname and cache the result. Concurrent lookups of the
+        same hostname share the first lookup's result.
+        """
+        waiters = self._lookups.get(key)
+        if waiters is not None:
+            d = Deferred()
+            waiters.append(d)
+            return d
+        waiters = self._lookups[key] = []
+        d = Deferred()
+        hostName, portNumber, addressTypes, transportSemantics = key
+        try:
+            self.resolver.resolveHostName(
+                AddressCollector(d), hostName, portNumber, addressTypes,
+                transportSemantics)
+        except Exception:
+            d.errback()
+        d.addErrback(self._lookup_failed, hostName)
+        d.addCallback(self._cache, key)
+        return d
+
+    def _lookup_failed(self, failure, hostName):
+        log.err(failure, "Error resolving %r" % (hostName,))
+        return []
+
+    def _cache(self, addresses, key):
+        now = self.clock.seconds()
+        ttl = self.ttl if addresses else self.negative_ttl
+        entry = self._entries.pop(key, None)
+        if not addresses and entry is not None and now < entry[1]:
+            addresses, expires, _prefetch_at = entry
+            self._entries[key] = (
+                addresses, expires, min(expires, now + self.negative_ttl))
+        elif ttl > 0:
+            while len(self._entries) >= self.MAX_ENTRIES:
+                self._entries.popitem(last=False)
+            self._entries[key] = (
+                addresses, now + ttl, now + ttl * self.PREFETCH_AFTER)
+        for d in self._lookups.pop(key):
+            d.callback(addresses)
+        return addresses
+
+    def _deliver(self, addresses, resolution, resolutionReceiver):
+        if resolution.cancelled:
+            return
+        for address in addresses:
+            resolutionReceiver.addressResolved(address)
+        resolutionReceiver.resolutionComplete()
+
+
+@implementer(IReactorPluggableNameResolver, IReactorTCP, IReactorTime)
+class ResolverReactor(object):
+    """
+    Passes everything through to a reactor except name resolution, which
+    is done by ``nameResolver``. Agents created with this reactor look up
+    hostnames with ``nameResolver`` without it being installed in the
+    reactor itself.
+    """
+
+    def __init__(self, reactor, nameResolver):
+        self._reactor = reactor
+        self.nameResolver = nameResolver
+
+    def installNameResolver(self, resolver):
+        previous, self.nameResolver = self.nameResolver, resolver
+        return previous
+
+    def __getattr__(self, name):
+        return getattr(self._reactor, name)
+
+
+class MeteredConnectionPool(HTTPConnectionPool):
+    """
+    An :class:`HTTPConnectionPool` that counts how often a request finds a
+    cached connection to reuse.
+
+    The pool keeps its own record of the idle connections to each host,
+    following the connections returned to and removed from the cache,
+    rather than relying on how :class:`HTTPConnectionPool` stores them.
+
+    :param StatsCollector stats:
+        Collector to record ``pool.hits`` and ``pool.misses`` in, or
+        ``None`` to record nothing.
+    """
+
+    def __init__(self, reactor, persistent=True, stats=None):
+        HTTPConnectionPool.__init__(self, reactor, persistent=persistent)
+        self.stats = stats
+        self._idle = {}
+
+    def getConnection(self, key, endpoint):
+        idle = self._idle.get(key, [])
+        reused = False
+        while idle and not reused:
+            reused = idle.pop(0).state == "QUIESCENT"
+        if not idle:
+            self._idle.pop(key, None)
+        if self.stats is not None:
+            self.stats.incr("pool.hits" if reused else "pool.misses")
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def _putConnection(self, key, connection):
+        HTTPConnectionPool._putConnection(self, key, connection)
+        if connection.state != "QUIESCENT":
+            return
+        idle = self._idle.setdefault(key, [])
+        if len(idle) == self.maxPersistentPerHost:
+            idle.pop(0)
+        idle.append(connection)
+
+    def _removeConnection(self, key, connection):
+        HTTPConnectionPool._removeConnection(self, key, connection)
+        idle = self._idle.get(key, [])
+        if connection in idle:
+            idle.remove(connection)
+        if not idle:
+            self._idle.pop(key, None)
+
+    def closeCachedConnections(self):
+        self._idle = {}
+        return HTTPConnectionPool.closeCachedConnections(self)
+
+
+def parse_cache_control(headers):
+    """
+    Return a dictionary mapping the lower-cased directives of the
+    ``Cache-Control`` headers to their values, or to ``None`` for
+    directives without a value.
+    """
+    directives = {}
+    for header in headers.getRawHeaders('Cache-Control', []):
+        for directive in header.split(','):
+            name, _, value = directive.partition('=')
+            name = name.strip().lower()
+            if name:
+                directives[name] = value.strip().strip('"') or None
+    return directives
+
+
+def _header_time(headers, name):
+    value = headers.getRawHeaders(name)
+    if not value:
+        return None
+    try:
+        return stringToDatetime(value[0])
+    except ValueError:
+        return None
+
+
+def _header_seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def cache_lifetime(headers, now, shared=False):
+    """
+    Return the number of seconds a response with the given headers stays
+    fresh, or ``None`` if the response may not be stored.
+    """
+    directives = parse_cache_control(headers)
+    if 'no-store' in directives or (shared and 'private' in directives):
+        return None
+    if 'no-cache' in directives:
+        return 0
+    if shared and 's-maxage' in directives:
+        lifetime = _header_seconds(directives['s-maxage'])
+    elif 'max-age' in directives:
+        lifetime = _header_seconds(directives['max-age'])
+    elif headers.hasHeader('Expires'):
+        expires = _header_time(headers, 'Expires')
+        date = _header_time(headers, 'Date')
+        if expires is None:
+            return 0
+        lifetime = max(0, expires - (date if date is not None else now))
+    else:
+        return 0
+    age = headers.getRawHeaders('Age')
+    return max(0, lifetime - (_header_seconds(age[0]) if age else 0))
+
+
+class HostQueueFullError(Exception):
+    """
+    Raised when a request can't be queued because too many requests to
+    the same host are already waiting, or has waited in the queue for
+    longer than ``queue_timeout``.
+    """
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a request isn't sent because its host's circuit breaker
+    is open.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the outcome of requests to one host. After ``max_failures``
+    consecutive failures the breaker opens and requests should fail
+    immediately. Once it has been open for ``reset_timeout`` seconds, a
+    single request is allowed through to probe the host. The breaker
+    closes if the probe succeeds and opens again if it fails.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, max_failures, reset_timeout, clock):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        """
+        Return whether a request may be sent. The first request allowed
+        after ``reset_timeout`` is the probe.
+        """
+        if self.state == self.CLOSED:
+            return True
+        if (self.state == self.OPEN and
+                self.clock.seconds() >= self.opened_at + self.reset_timeout):
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def succeeded(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def failed(self):
+        """
+        Record a failed request. Returns whether the breaker opened.
+        """
+        self.failures += 1
+        if self.state == self.OPEN:
+            return False
+        if (self.state == self.HALF_OPEN or
+                self.failures >= self.max_failures):
+            self.state = self.OPEN
+            self.opened_at = self.clock.seconds()
+            return True
+        return False
+
+    def abandoned(self):
+        """
+        Record a request that ended without reaching the host. If it was
+        the probe, the next request is allowed to probe instead.
+        """
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+
+
+class LatencyTracker(object):
+    """
+    Keeps the latencies of the most recent requests to the most recently
+    used hosts.
+    """
+
+    MAX_HOSTS = 100
+    #: Number of latencies kept for each host.
+    WINDOW = 100
+
+    def __init__(self, min_samples):
+        self.min_samples = min_samples
+        self._samples = OrderedDict()
+
+    def record(self, key, latency):
+        samples = self._samples.pop(key, None)
+        if samples is None:
+            samples = deque(maxlen=self.WINDOW)
+            while len(self._samples) >= self.MAX_HOSTS:
+                self._samples.popitem(last=False)
+        samples.append(latency)
+        self._samples[key] = samples
+
+    def percentile(self, key, percentile):
+        """
+        Return the given percentile of a host's recent latencies, or
+        ``None`` if fewer than ``min_samples`` have been recorded.
+        """
+        samples = self._samples.get(key)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        rank = int(math.ceil(len(ordered) * percentile / 100.0))
+        return ordered[max(rank - 1, 0)]
+
+
+class HedgedRequest(object):
+    """
+    Calls ``make_request``, and calls it a second time if no response has
+    arrived after ``delay`` seconds. :meth:`start` returns a deferred that
+    fires with the first successful response, after which the other
+    request is cancelled. If every request fails, it fails with the first
+    failure. A ``delay`` of ``None`` never sends a second request.
+
+    Once finished, ``hedged`` says whether a second request was sent,
+    ``winner`` which request (0 or 1) answered and ``latency`` how many
+    seconds it took.
+    """
+
+    def __init__(self, make_request, delay, clock):
+        self.make_request = make_request
+        self.delay = delay
+        self.clock = clock
+        self.finished = Deferred()
+        self.hedged = False
+        self.winner = None
+        self.latency = None
+        self._attempts = {}
+        self._failure = None
+        self._timer = None
+
+    def start(self):
+        if self.delay is not None:
+            self._timer = self.clock.callLater(self.delay, self._hedge)
+        self._attempt(0)
+        return self.finished
+
+    def _hedge(self):
+        self._timer = None
+        self.hedged = True
+        self._attempt(1)
+
+    def _stop_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _attempt(self, index):
+        d = maybeDeferred(self.make_request)
+        self._attempts[index] = d
+        d.addBoth(self._attempt_finished, index, self.clock.seconds())
+
+    def _attempt_finished(self, result, index, started):
+        del self._attempts[index]
+        if self.finished.called:
+            return None
+        if isinstance(result, Failure):
+            if self._failure is None:
+                self._failure = result
+            if not self._attempts:
+                self._stop_timer()
+                self.finished.errback(self._failure)
+            return None
+        self._stop_timer()
+        self.winner = index
+        self.latency = self.clock.seconds() - started
+        self.finished.callback(result)
+        for d in self._attempts.values():
+            d.cancel()
+
+
+class LimitedBodyCollector(Protocol):
+    """
+    Collects a response body, stopping the transfer as soon as the body
+    grows beyond ``data_limit`` bytes. ``finished`` fires with the body,
+    or fails with :class:`HttpDataLimitError`.
+
+    If the body's ``length`` is known and is over the limit, the transfer
+    is stopped before any of the body is read.
+    """
+
+    def __init__(self, finished, data_limit=None, length=None):
+        self.finished = finished
+        self.data_limit = data_limit
+        self.length = length
+        self.received = 0
+        self._chunks = []
+
+    def _over_limit(self, length):
+        return self.data_limit is not None and length > self.data_limit
+
+    def _abort(self, length):
+        self._fail(HttpDataLimitError(
+            "Received %d bytes, maximum of %d bytes allowed."
+            % (length, self.data_limit)))
+
+    def _fail(self, error):
+        finished, self.finished = self.finished, None
+        self._chunks = []
+        self.transport.stopProducing()
+        finished.errback(error)
+
+    def connectionMade(self):
+        if self.length is not None and self._over_limit(self.length):
+            self._abort(self.length)
+
+    def dataReceived(self, data):
+        if self.finished is None:
+            return
+        self.received += len(data)
+        if self._over_limit(self.received):
+            self._abort(self.received)
+            return
+        self._chunks.append(data)
+
+    def connectionLost(self, reason):
+        if self.finished is None:
+            return
+        finished, self.finished = self.finished, None
+        if reason.check(ResponseDone, PotentialDataLoss):
+            finished.callback("".join(self._chunks))
+        else:
+            finished.errback(reason)
+
+
+class ContentDecodingError(Exception):
+    """
+    Raised when a compressed response body can't be decompressed.
+    """
+
+
+class DecodingBodyCollector(LimitedBodyCollector):
+    """
+    Collects a response body compressed with ``encoding``, decompressing
+    it as it arrives. ``data_limit`` applies to the decompressed body, and
+    no more than ``data_limit`` bytes are ever decompressed, so a small
+    body that decompresses to a huge one is stopped early. ``finished``
+    fails with :class:`ContentDecodingError` if the body isn't valid.
+    """
+
+    #: zlib window bits for each supported content encoding.
+    WBITS = {
+        'gzip': 16 + zlib.MAX_WBITS,
+        'x-gzip': 16 + zlib.MAX_WBITS,
+        'deflate': zlib.MAX_WBITS,
+    }
+
+    def __init__(self, finished, encoding, data_limit=None):
+        LimitedBodyCollector.__init__(self, finished, data_limit)
+        self._decoder = zlib.decompressobj(self.WBITS[encoding])
+
+    def _decode(self, data):
+        while data and self.finished is not None:
+            max_length = 0
+            if self.data_limit is not None:
+                max_length = self.data_limit - self.received + 1
+            decoded = self._decoder.decompress(data, max_length)
+            data = self._decoder.unconsumed_tail
+            LimitedBodyCollector.dataReceived(self, decoded)
+
+    def dataReceived(self, data):
+        if self.finished is None:
+            return
+        try:
+            self._decode(data)
+        except zlib.error, e:
+            self._fail(ContentDecodingError(
+                "Error decompressing response body: %s" % (e,)))
+
+    def connectionLost(self, reason):
+        if self.finished is not None and reason.check(
+                ResponseDone, PotentialDataLoss):
+            LimitedBodyCollector.dataReceived(self, self._decoder.flush())
+        LimitedBodyCollector.connectionLost(self, reason)
+
+
+class BufferedResponse(object):
+    """
+    An HTTP response whose body has been read. Provides the parts of a
+    treq response that :class:`HttpClientResource` uses, and is what the
+    response cache holds.
+    """
+
+    #: Response codes that are cached.
+    CACHEABLE_CODES = (200,)
+
+    #: Headers used to revalidate stale responses.
+    VALIDATORS = (('ETag', 'If-None-Match'),
+                  ('Last-Modified', 'If-Modified-Since'))
+
+    def __init__(self, code, headers, body):
+        self.code = code
+        self.headers = headers
+        self.body = body
+        self.fresh_until = None
+
+    def content(self):
+        return succeed(self.body)
+
+    def copy(self):
+        """
+        Return a copy of the response with its own headers, so that the
+        copy can be revalidated without changing the original.
+        """
+        response = BufferedResponse(self.code, self.headers.copy(), self.body)
+        response.fresh_until = self.fresh_until
+        return response
+
+    def update_headers(self, headers):
+        """
+        Replace the stored headers with the ones sent in a ``304 Not
+        Modified`` response.
+        """
+        for name, values in headers.getAllRawHeaders():
+            self.headers.setRawHeaders(name, values)
+
+    def update_freshness(self, now, shared):
+        """
+        Work out how long the response stays fresh from its headers.
+        Returns whether the response may be stored.
+        """
+        lifetime = cache_lifetime(self.headers, now, shared)
+        if self.code not in self.CACHEABLE_CODES or lifetime is None:
+            return False
+        self.fresh_until = now + lifetime
+        return lifetime > 0 or self.has_validators()
+
+    def is_fresh(self, now):
+        return self.fresh_until is not None and now < self.fresh_until
+
+    def has_validators(self):
+        return any(
+            self.headers.hasHeader(name) for name, _ in self.VALIDATORS)
+
+    def conditional_headers(self, headers):
+        """
+        Return a copy of the request headers with the headers that ask the
+        server to only send the body if it has changed.
+        """
+        headers = dict(headers or {})
+        for name, request_name in self.VALIDATORS:
+            value = self.headers.getRawHeaders(name)
+            if value:
+                headers[request_name] = [value[0].decode("utf-8")]
+        return headers
+
+    def size(self):
+        return len(self.body) + sum(
+            len(name) + sum(len(value) for value in values)
+            for name, values in self.headers.getAllRawHeaders())
+
+
+class HttpClientResource(StatsMixin, SandboxResource):
     """
     Resource that allows making HTTP calls to outside services.
 
@@ -120,6 +878,9 @@ class HttpClientResource(SandboxResource):
 
             The ``data`` field in the dictionary will be base64 decoded
             before the HTTP request is made.
+        - ``coalesce``: Set to ``false`` to stop a ``GET`` request from
+            sharing its response with identical requests when
+            ``coalesce_gets`` is set.
 
     Success reply fields:
         - ``success``: Set to ``true``
@@ -139,67 +900,506 @@ class HttpClientResource(SandboxResource):
             {url: 'http://foo/'},
             function(reply) { api.log_info(reply.body); });
 
+    Configuration options:
+
+    :param int timeout:
+        Number of seconds to wait for a response. (default: 30).
+    :param int data_limit:
+        Maximum size of a response body in bytes. The limit applies to the
+        decompressed body when ``decompress_responses`` is set.
+        (default: 128 KB).
+    :param bool decompress_responses:
+        If true, requests are sent with an ``Accept-Encoding: gzip,
+        deflate`` header (unless they set their own) and response bodies
+        compressed with ``gzip`` or ``deflate`` are decompressed before
+        they are returned. (default: false).
+    :param bool persistent_connections:
+        If true, connections are kept open after a request and reused by
+        later requests to the same host from any sandbox. Requests with
+        different ``verify_options`` or ``ssl_method`` never share a
+        connection. (default: false).
+    :param int max_connections_per_host:
+        Maximum number of idle connections kept open to each host for each
+        combination of TLS settings. (default: 2).
+    :param float connection_idle_timeout:
+        Number of seconds an idle connection is kept open before it is
+        closed. (default: 240).
+    :param int cache_max_bytes:
+        If non-zero, responses to ``GET`` requests are cached in the
+        worker, in a least-recently-used cache holding up to this many
+        bytes. Responses are cached for as long as their
+        ``Cache-Control`` or ``Expires`` headers allow. Stale responses
+        with an ``ETag`` or ``Last-Modified`` header are revalidated with
+        a conditional request. Requests that send their own
+        ``Cache-Control``, ``Pragma``, ``Range`` or conditional headers
+        bypass the cache. (default: 0).
+    :param bool cache_shared:
+        If true, cached responses are shared by all sandboxes. Responses
+        marked ``private`` and responses to requests with an
+        ``Authorization`` header are then not cached. If false, each
+        sandbox has its own cached responses. (default: false).
+    :param bool coalesce_gets:
+        If true, a ``GET`` request made while an identical request (with
+        the same URL, headers and TLS settings) is waiting for its
+        response isn't sent. It is given the response to the request
+        already in flight, even if that request was made by another
+        sandbox. (default: false).
+    :param int max_requests_per_host:
+        If non-zero, at most this many requests to each host are sent at
+        once. Further requests wait in a queue until an earlier request
+        to the host finishes. Requests answered by the response cache or
+        coalesced with another request don't count. (default: 0).
+    :param int max_queued_per_host:
+        Maximum number of requests waiting in each host's queue. Requests
+        that find the queue full fail immediately. (default: 100).
+    :param float queue_timeout:
+        Number of seconds a request may wait in a host's queue before it
+        fails. The request's ``timeout`` only starts once it is sent.
+        (default: the value of ``timeout``).
+    :param int circuit_breaker_failures:
+        If non-zero, once this many consecutive requests to a host have
+        failed with an error, a timeout or a ``5xx`` response, requests
+        to the host fail immediately without being sent. (default: 0).
+    :param float circuit_breaker_reset_timeout:
+        Number of seconds requests to a failing host fail immediately for.
+        After that, one request is sent to the host. If it succeeds,
+        requests are sent as usual again, otherwise they keep failing
+        immediately for another period. (default: 30).
+    :param float hedge_percentile:
+        If non-zero, a second, identical ``GET`` request is sent when the
+        first hasn't been answered within this percentile of the
+        latencies of recent requests to the same host (e.g. ``95``). The
+        first response to arrive is used and the other request is
+        cancelled. (default: 0).
+    :param int hedge_min_samples:
+        Number of recent requests to a host needed before requests to it
+        are hedged. (default: 20).
+    :param int max_batch_size:
+        Maximum number of requests in a ``batch`` command. (default: 20).
+    :param float dns_cache_ttl:
+        If non-zero, the addresses hostnames resolve to are cached in the
+        worker for this many seconds. Hostnames in use are resolved again
+        in the background shortly before their entries expire.
+        (default: 0).
+    :param float dns_negative_ttl:
+        Number of seconds hostnames that don't resolve are cached for when
+        ``dns_cache_ttl`` is set. (default: 5).
+    :param str metrics_prefix:
+        If set, the number of requests that reused an open connection
+        (``pool.hits``) and that had to open a new one (``pool.misses``),
+        cache hits, misses, revalidations and evictions, the number of
+        coalesced requests (``requests.coalesced``), the time requests
+        wait in host queues (``queue.wait_time``, in milliseconds), the
+        number of requests rejected by full queues (``queue.rejected``)
+        or that waited too long in them (``queue.timeouts``),
+        DNS cache hits, misses and prefetches, the number of times circuit
+        breakers opened (``circuit.opened``) and requests they rejected
+        (``circuit.rejected``), and the number of hedged requests
+        (``requests.hedged``) and of those answered by the second request
+        (``requests.hedge_wins``) are published as metrics with this
+        prefix. (default: no metrics).
+    :param int metrics_interval:
+        Number of seconds between metric publications. (default: 60).
     """
 
     DEFAULT_TIMEOUT = 30  # seconds
     DEFAULT_DATA_LIMIT = 128 * 1024  # 128 KB
+    VERIFY_OPTIONS = {
+        'VERIFY_NONE': VERIFY_NONE,
+        'VERIFY_PEER': VERIFY_PEER,
+        'VERIFY_CLIENT_ONCE': VERIFY_CLIENT_ONCE,
+        'VERIFY_FAIL_IF_NO_PEER_CERT': VERIFY_FAIL_IF_NO_PEER_CERT,
+    }
+    SSL_METHODS = {
+        'SSLv3': SSLv3_METHOD,
+        'SSLv23': SSLv23_METHOD,
+        'TLSv1': TLSv1_METHOD,
+    }
+    #: Request headers that make a request bypass the response cache.
+    UNCACHED_REQUEST_HEADERS = frozenset([
+        'cache-control', 'pragma', 'range', 'if-none-match',
+        'if-modified-since', 'if-match', 'if-unmodified-since',
+        'if-range'])
+
+    #: Methods the requests in a batch may use.
+    BATCH_METHODS = frozenset([
+        'GET', 'PUT', 'DELETE', 'HEAD', 'POST', 'PATCH'])
+
+    #: Maximum number of hosts whose circuit breakers are kept. The least
+    #: recently used ones are forgotten to make room for new ones.
+    MAX_BREAKERS = 1000
+
     agent_class = Agent
     http_client_class = HTTPClient
+    pool_class = MeteredConnectionPool
+    clock = reactor
 
+    @inlineCallbacks
     def setup(self):
         self.timeout = self.config.get('timeout', self.DEFAULT_TIMEOUT)
         self.data_limit = self.config.get('data_limit',
                                           self.DEFAULT_DATA_LIMIT)
+        self.persistent_connections = self.config.get(
+            'persistent_connections', False)
+        self.pools = {}
+        self.context_factories = {}
+        cache_max_bytes = self.config.get('cache_max_bytes', 0)
+        self.cache = (LRUCache(cache_max_bytes, clock=self.clock)
+                      if cache_max_bytes else None)
+        self.cache_shared = self.config.get('cache_shared', False)
+        self.coalesce_gets = self.config.get('coalesce_gets', False)
+        self._in_flight = {}
+        self.max_requests_per_host = self.config.get(
+            'max_requests_per_host', 0)
+        self.max_queued_per_host = self.config.get(
+            'max_queued_per_host', 100)
+        self.queue_timeout = self.config.get('queue_timeout', self.timeout)
+        self._host_semaphores = {}
+        self.max_batch_size = self.config.get('max_batch_size', 20)
+        self.decompress_responses = self.config.get(
+            'decompress_responses', False)
+        self.circuit_breaker_failures = self.config.get(
+            'circuit_breaker_failures', 0)
+        self.circuit_breaker_reset_timeout = self.config.get(
+            'circuit_breaker_reset_timeout', 30)
+        self._breakers = OrderedDict()
+        self.hedge_percentile = self.config.get('hedge_percentile', 0)
+        self._latencies = LatencyTracker(
+            self.config.get('hedge_min_samples', 20))
+        yield self.setup_stats()
+        self.agent_reactor = reactor
+        dns_cache_ttl = self.config.get('dns_cache_ttl', 0)
+        if dns_cache_ttl:
+            self.agent_reactor = ResolverReactor(
+                reactor, CachingHostnameResolver(
+                    reactor.nameResolver, dns_cache_ttl,
+                    self.config.get('dns_negative_ttl', 5), self.clock,
+                    self.stats))
+
+    def teardown(self):
+        self.teardown_stats()
+        pools, self.pools = self.pools, {}
+        return gatherResults([
+            pool.closeCachedConnections() for pool in pools.itervalues()])
+
+    def context_factory(self, verify_options=None, ssl_method=None):
+        """
+        Return the context factory shared by requests with the given TLS
+        settings. Each factory reuses its TLS contexts and resumes the
+        sessions of earlier connections to the same host.
+        """
+        key = (verify_options, ssl_method)
+        context_factory = self.context_factories.get(key)
+        if context_factory is None:
+            context_factory = self.context_factories[key] = (
+                make_context_factory(
+                    verify_options=verify_options, ssl_method=ssl_method))
+        return context_factory
+
+    def connection_pool(self, verify_options=None, ssl_method=None):
+        """
+        Return the connection pool shared by requests with the given TLS
+        settings, or ``None`` if connections aren't persistent.
+        """
+        if not self.persistent_connections:
+            return None
+        key = (verify_options, ssl_method)
+        pool = self.pools.get(key)
+        if pool is None:
+            pool = self.pools[key] = self.pool_class(
+                self.agent_reactor, persistent=True, stats=self.stats)
+            pool.maxPersistentPerHost = self.config.get(
+                'max_connections_per_host', pool.maxPersistentPerHost)
+            pool.cachedConnectionTimeout = self.config.get(
+                'connection_idle_timeout', pool.cachedConnectionTimeout)
+        return pool
+
+    def _limit_host(self, url, make_request):
+        """
+        Call ``make_request`` once fewer than ``max_requests_per_host``
+        requests to the URL's host are in flight. Fails with
+        :class:`HostQueueFullError` if the host's queue is full or the
+        request waits in it for longer than ``queue_timeout``.
+        """
+        if not self.max_requests_per_host:
+            return maybeDeferred(make_request)
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        semaphore = self._host_semaphores.get(key)
+        if semaphore is None:
+            semaphore = self._host_semaphores[key] = DeferredSemaphore(
+                self.max_requests_per_host)
+        if (semaphore.tokens == 0 and
+                len(semaphore.waiting) >= self.max_queued_per_host):
+            self._incr_stat('queue.rejected')
+            return fail(HostQueueFullError(
+                "Too many requests queued for %s" % (parsed.netloc,)))
+        d = semaphore.acquire()
+        if not d.called and self.queue_timeout:
+            timer = self.clock.callLater(self.queue_timeout, d.cancel)
+            d.addBoth(self._queue_wait_ended, timer, parsed.netloc)
+        d.addCallback(
+            self._host_acquired, key, self.clock.seconds(), make_request)
+        return d
+
+    def _queue_wait_ended(self, result, timer, netloc):
+        if timer.active():
+            timer.cancel()
+        elif isinstance(result, Failure) and result.check(CancelledError):
+            self._incr_stat('queue.timeouts')
+            raise HostQueueFullError(
+                "Timed out waiting in the queue for %s" % (netloc,))
+        return result
+
+    def _host_acquired(self, semaphore, key, queued_at, make_request):
+        # The slot is only released once it has been acquired, so that
+        # cancelling a queued request (such as the losing attempt of a
+        # hedged request) doesn't free a slot it never held.
+        self._observe_stat(
+            'queue.wait_time', (self.clock.seconds() - queued_at) * 1000)
+        d = maybeDeferred(make_request)
+        d.addBoth(self._host_released, key, semaphore)
+        return d
+
+    def _host_released(self, result, key, semaphore):
+        semaphore.release()
+        if (semaphore.tokens == semaphore.limit and
+                self._host_semaphores.get(key) is semaphore):
+            del self._host_semaphores[key]
+        return result
+
+    def _guard_host(self, url, make_request):
+        """
+        Call ``make_request`` unless the circuit breaker of the URL's host
+        is open, in which case fail with :class:`CircuitOpenError`.
+        """
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        breaker = self._breakers.pop(key, None)
+        if breaker is None:
+            while len(self._breakers) >= self.MAX_BREAKERS:
+                self._breakers.popitem(last=False)
+            breaker = CircuitBreaker(
+                self.circuit_breaker_failures,
+                self.circuit_breaker_reset_timeout, self.clock)
+        self._breakers[key] = breaker
+        if not breaker.allow():
+            self._incr_stat('circuit.rejected')
+            return fail(CircuitOpenError(
+                "Circuit breaker open for %s" % (parsed.netloc,)))
+        d = maybeDeferred(make_request)
+        d.addBoth(self._breaker_result, key, breaker)
+        return d
+
+    def _breaker_result(self, result, key, breaker):
+        if not isinstance(result, Failure):
+            failed = result.code >= 500
+        elif result.check(HostQueueFullError):
+            breaker.abandoned()
+            return result
+        else:
+            # Responses that are too large or can't be decoded still
+            # show that the host is answering.
+            failed = not result.check(
+                HttpDataLimitError, ContentDecodingError)
+        if not failed:
+            breaker.succeeded()
+            if self._breakers.get(key) is breaker:
+                del self._breakers[key]
+        elif breaker.failed():
+            self._incr_stat('circuit.opened')
+        return result
+
+    def _hedge(self, url, make_request):
+        """
+        Call ``make_request``, and call it again if the first request
+        takes longer than ``hedge_percentile`` of recent requests to the
+        URL's host. See :class:`HedgedRequest`.
+        """
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        hedged = HedgedRequest(
+            make_request,
+            self._latencies.percentile(key, self.hedge_percentile),
+            self.clock)
+        d = hedged.start()
+        d.addBoth(self._hedge_finished, key, hedged)
+        return d
+
+    def _hedge_finished(self, result, key, hedged):
+        if hedged.hedged:
+            self._incr_stat('requests.hedged')
+        if hedged.winner == 1:
+            self._incr_stat('requests.hedge_wins')
+        if hedged.latency is not None:
+            self._latencies.record(key, hedged.latency)
+        return result
+
+    def _cache_key(self, api, method, url, headers, data, files):
+        """
+        Return the key a request's response is cached under, or ``None``
+        if the response shouldn't be cached.
+        """
+        if (self.cache is None or method != 'GET' or data is not None or
+                files is not None):
+            return None
+        header_names = set(name.lower() for name in (headers or {}))
+        if header_names & self.UNCACHED_REQUEST_HEADERS:
+            return None
+        if self.cache_shared:
+            if 'authorization' in header_names:
+                return None
+            scope = None
+        else:
+            scope = api.sandbox_id
+        return (scope, url, self._headers_key(headers))
+
+    def _headers_key(self, headers):
+        return tuple(sorted(
+            (name.lower(), tuple(values))
+            for name, values in (headers or {}).iteritems()))
+
+    def _coalesce_key(self, command, method, url, headers, data, files,
+                      verify_options, ssl_method):
+        """
+        Return the key identical in-flight requests are coalesced under,
+        or ``None`` if the request shouldn't be coalesced.
+        """
+        if (not self.coalesce_gets or method != 'GET' or
+                data is not None or files is not None or
+                not command.get('coalesce', True)):
+            return None
+        return (url, self._headers_key(headers), verify_options, ssl_method)
+
+    def _single_flight(self, coalesce_key, make_request):
+        """
+        Call ``make_request`` unless an identical request is in flight, in
+        which case wait for its result instead.
+        """
+        if coalesce_key is None:
+            return make_request()
+        waiters = self._in_flight.get(coalesce_key)
+        if waiters is not None:
+            self._incr_stat('requests.coalesced')
+            d = Deferred()
+            waiters.append(d)
+            return d
+        self._in_flight[coalesce_key] = []
+        d = maybeDeferred(make_request)
+        d.addBoth(self._fan_out, coalesce_key)
+        return d
+
+    def _fan_out(self, result, coalesce_key):
+        # Each waiter gets its own copy of the response, because responses
+        # are stored in the caches of different sandboxes and revalidating
+        # one of them updates its headers.
+        for d in self._in_flight.pop(coalesce_key):
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result.copy())
+        return result
+
+    def _cached_response(self, cache_key):
+        """
+        Return the cached response for a request, which may be stale, or
+        ``None`` if there is no cached response.
+        """
+        if cache_key is None:
+            return None
+        cached = self.cache.get(cache_key)
+        if cached is not None and cached.is_fresh(self.clock.seconds()):
+            self._incr_stat('cache.hits')
+        else:
+            self._incr_stat('cache.misses')
+        return cached
+
+    def _cache_response(self, response, cache_key, cached):
+        now = self.clock.seconds()
+        if response.code == 304 and cached is not None:
+            self._incr_stat('cache.revalidated')
+            # Replies may still be using the cached response, so its copy
+            # is updated and replaces it.
+            revalidated = cached.copy()
+            revalidated.update_headers(response.headers)
+            response = revalidated
+        if response.update_freshness(now, self.cache_shared):
+            evictions = self.cache.evictions
+            # Stale responses with validators are kept until they're
+            # evicted, so that they can be revalidated.
+            ttl = None if response.has_validators() else (
+                response.fresh_until - now)
+            self.cache.set(cache_key, response, response.size(), ttl)
+            self._incr_stat(
+                'cache.evictions', self.cache.evictions - evictions)
+        else:
+            self.cache.delete(cache_key)
+        return response
+
+    def _make_request_from_command(self, method, command, api):
+        d = self._response_from_command(method, command, api)
+        d.addCallback(self._make_success_reply, command)
+        d.addErrback(self._make_failure_reply, command)
+        return d
 
-    def _make_request_from_command(self, method, command):
+    def _response_from_command(self, method, command, api):
+        """
+        Make the request described by a command's fields. Returns a
+        deferred that fires with a :class:`BufferedResponse`.
+        """
         url = command.get('url', None)
         if not isinstance(url, basestring):
-            return succeed(self.reply(command, success=False,
-                                      reason="No URL given"))
+            return fail(ValueError("No URL given"))
         url = url.encode("utf-8")
 
-        verify_map = {
-            'VERIFY_NONE': VERIFY_NONE,
-            'VERIFY_PEER': VERIFY_PEER,
-            'VERIFY_CLIENT_ONCE': VERIFY_CLIENT_ONCE,
-            'VERIFY_FAIL_IF_NO_PEER_CERT': VERIFY_FAIL_IF_NO_PEER_CERT,
-        }
-        method_map = {
-            'SSLv3': SSLv3_METHOD,
-            'SSLv23': SSLv23_METHOD,
-            'TLSv1': TLSv1_METHOD,
-        }
-
         if 'verify_options' in command:
-            verify_options = [verify_map[key] for key in
+            verify_options = [self.VERIFY_OPTIONS[key] for key in
                               command.get('verify_options', [])]
             verify_options = reduce(operator.or_, verify_options)
         else:
             verify_options = None
         if 'ssl_method' in command:
             # TODO: Fail better with unknown method.
-            ssl_method = method_map[command['ssl_method']]
+            ssl_method = self.SSL_METHODS[command['ssl_method']]
         else:
             ssl_method = None
 
-        context_factory = make_context_factory(
-            verify_options=verify_options, ssl_method=ssl_method)
+        context_factory = self.context_factory(verify_options, ssl_method)
 
         headers = command.get('headers', None)
         data = command.get('data', None)
         files = command.get('files', None)
 
-        d = self._make_request(method, url, headers=headers, data=data,
-                               files=files, timeout=self.timeout,
-                               context_factory=context_factory,
-                               data_limit=self.data_limit)
-        d.addCallback(self._make_success_reply, command)
-        d.addErrback(self._make_failure_reply, command)
+        cache_key = self._cache_key(api, method, url, headers, data, files)
+        cached = self._cached_response(cache_key)
+        if cached is not None:
+            if cached.is_fresh(self.clock.seconds()):
+                return succeed(cached)
+            headers = cached.conditional_headers(headers)
+
+        coalesce_key = self._coalesce_key(
+            command, method, url, headers, data, files, verify_options,
+            ssl_method)
+        if self.decompress_responses:
+            headers = self._accept_encoding(headers)
+        make_request = partial(
+            self._make_request, method, url, headers=headers, data=data,
+            files=files, timeout=self.timeout,
+            context_factory=context_factory, data_limit=self.data_limit,
+            pool=self.connection_pool(verify_options, ssl_method))
+        request = partial(self._limit_host, url, make_request)
+        if self.hedge_percentile and method == 'GET':
+            request = partial(self._hedge, url, request)
+        if self.circuit_breaker_failures:
+            request = partial(self._guard_host, url, request)
+        d = self._single_flight(coalesce_key, request)
+        if cache_key is not None:
+            d.addCallback(self._cache_response, cache_key, cached)
         return d
 
     def _make_request(self, method, url, headers=None, data=None, files=None,
                       timeout=None, context_factory=None,
-                      data_limit=None):
+                      data_limit=None, pool=None):
         context_factory = (context_factory if context_factory is not None
                            else WebClientContextFactory())
 
@@ -218,32 +1418,101 @@ class HttpClientResource(SandboxResource):
                      StringIO(base64.b64decode(value['data']))))
                 for key, value in files.iteritems()])
 
-        agent = self.agent_class(reactor, contextFactory=context_factory)
+        agent = self.agent_class(
+            self.agent_reactor, contextFactory=context_factory, pool=pool)
         http_client = self.http_client_class(agent)
 
         d = http_client.request(method, url, headers=headers, data=data,
-                                files=files, timeout=timeout)
+                                files=files, timeout=timeout,
+                                unbuffered=True)
 
         d.addCallback(self._ensure_data_limit, method, data_limit)
         return d
 
     def _ensure_data_limit(self, response, method, data_limit):
-        header = response.headers.getRawHeaders('Content-Length')
+        """
+        Read the response body, failing with :class:`HttpDataLimitError`
+        if it is larger than ``data_limit``. The body is read as it
+        arrives, and the connection is closed as soon as the limit is
+        exceeded. Returns a :class:`BufferedResponse`.
+        """
+        headers = response.headers
+        encoding = self._content_encoding(headers)
+        d = Deferred()
+        if encoding is not None and method.upper() != 'HEAD':
+            headers = headers.copy()
+            headers.removeHeader('Content-Encoding')
+            headers.removeHeader('Content-Length')
+            collector = DecodingBodyCollector(d, encoding, data_limit)
+        else:
+            header = headers.getRawHeaders('Content-Length')
+            length = None
+            if header is not None and method.upper() != 'HEAD':
+                length = int(header[0])
+            collector = LimitedBodyCollector(d, data_limit, length)
+
+        response.deliverBody(collector)
+        d.addCallback(
+            lambda body: BufferedResponse(response.code, headers, body))
+        return d
+
+    def _content_encoding(self, headers):
+        """
+        Return the encoding the response body should be decompressed
+        from, or ``None`` if it should be left as it is.
+        """
+        if not self.decompress_responses:
+            return None
+        values = headers.getRawHeaders('Content-Encoding')
+        if values is None or len(values) != 1:
+            return None
+        encoding = values[0].strip().lower()
+        if encoding not in DecodingBodyCollector.WBITS:
+            return None
+        return encoding
+
+    def _accept_encoding(self, headers):
+        """
+        Return a copy of the request headers that asks for a compressed
+        response, unless they already say which encodings are accepted.
+        """
+        headers = dict(headers or {})
+        if not any(k.lower() == 'accept-encoding' for k in headers):
+            headers[u'Accept-Encoding'] = [u'gzip, deflate']
+        return headers
+
+    def _batch_result(self, spec, api):
+        """
+        Make one request of a batch. Returns a deferred that fires with
+        the request's result, which is never a failure.
+        """
+        started = self.clock.seconds()
 
-        def data_limit_check(response, length):
-            if data_limit is not None and length > data_limit:
-                raise HttpDataLimitError(
-                    "Received %d bytes, maximum of %d bytes allowed."
-                    % (length, data_limit,))
-            return response
+        def result(**fields):
+            fields['time_ms'] = int(
+                (self.clock.seconds() - started) * 1000)
+            return fields
 
-        if header is None or method.upper() == 'HEAD':
+        def success(response):
             d = response.content()
-            d.addCallback(lambda body: data_limit_check(response, len(body)))
+            d.addCallback(lambda body: result(
+                success=True, body=body, code=response.code))
             return d
 
-        content_length = header[0]
-        return maybeDeferred(data_limit_check, response, int(content_length))
+        if not isinstance(spec, dict):
+            return succeed(result(
+                success=False, reason="Request must be an object"))
+        method = spec.get('method', 'GET')
+        if (not isinstance(method, basestring) or
+                method.upper() not in self.BATCH_METHODS):
+            return succeed(result(
+                success=False, reason="Unsupported method: %s" % (method,)))
+        d = maybeDeferred(
+            self._response_from_command, str(method.upper()), spec, api)
+        d.addCallback(success)
+        d.addErrback(lambda failure: result(
+            success=False, reason=failure.getErrorMessage()))
+        return d
 
     def _make_success_reply(self, response, command):
         d = response.content()
@@ -262,7 +1531,7 @@ class HttpClientResource(SandboxResource):
 
         See :class:`HttpResource` for details.
         """
-        return self._make_request_from_command('GET', command)
+        return self._make_request_from_command('GET', command, api)
 
     def handle_put(self, api, command):
         """
@@ -270,7 +1539,7 @@ class HttpClientResource(SandboxResource):
 
         See :class:`HttpResource` for details.
         """
-        return self._make_request_from_command('PUT', command)
+        return self._make_request_from_command('PUT', command, api)
 
     def handle_delete(self, api, command):
         """
@@ -278,7 +1547,7 @@ class HttpClientResource(SandboxResource):
 
         See :class:`HttpResource` for details.
         """
-        return self._make_request_from_command('DELETE', command)
+        return self._make_request_from_command('DELETE', command, api)
 
     def handle_head(self, api, command):
         """
@@ -286,7 +1555,7 @@ class HttpClientResource(SandboxResource):
 
         See :class:`HttpResource` for details.
         """
-        return self._make_request_from_command('HEAD', command)
+        return self._make_request_from_command('HEAD', command, api)
 
     def handle_post(self, api, command):
         """
@@ -294,7 +1563,7 @@ class HttpClientResource(SandboxResource):
 
         See :class:`HttpResource` for details.
         """
-        return self._make_request_from_command('POST', command)
+        return self._make_request_from_command('POST', command, api)
 
     def handle_patch(self, api, command):
         """
@@ -302,4 +1571,53 @@ class HttpClientResource(SandboxResource):
 
         See :class:`HttpResource` for details.
         """
-        return self._make_request_from_command('PATCH', command)
+        return self._make_request_from_command('PATCH', command, api)
+
+    def handle_batch(self, api, command):
+        """
+        Make several HTTP requests at once.
+
+        Command fields:
+            - ``requests``: A list of requests. Each request is an object
+              with a ``method`` (one of ``GET``, ``PUT``, ``DELETE``,
+              ``HEAD``, ``POST`` or ``PATCH``, default ``GET``) and the
+              same fields as the other commands.
+
+        Success reply fields:
+            - ``success``: Set to ``true``
+            - ``results``: A list with the result of each request, in the
+              same order as ``requests``. Each result has the success or
+              failure reply fields of the other commands and ``time_ms``,
+              the number of milliseconds the request took.
+
+        The requests are made concurrently, and the reply is sent once all
+        of them have finished. A failed request doesn't stop the others.
+
+        Example:
+
+        .. code-block:: javascript
+
+            api.request(
+                'http.batch',
+                {requests: [
+                    {url: 'http://foo/'},
+                    {method: 'POST', url: 'http://bar/', data: 'baz'}]},
+                function(reply) {
+                    reply.results.forEach(function(result) {
+                        api.log_info(result.body);
+                    });
+                });
+        """
+        specs = command.get('requests')
+        if not isinstance(specs, list):
+            return self.reply_error(command, "requests must be a list")
+        if len(specs) > self.max_batch_size:
+            return self.reply_error(
+                command, "Too many requests in batch (maximum %d)" % (
+                    self.max_batch_size,))
+        d = gatherResults(
+            [self._batch_result(spec, api) for spec in specs])
+        d.addCallback(
+            lambda results: self.reply(command, success=True,
+                                       results=results))
+        return d
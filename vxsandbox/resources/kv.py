@@ -6,15 +6,374 @@ from __future__ import absolute_import
 
 import logging
 import json
+import time
+import zlib
+from collections import OrderedDict
+from functools import partial
+from hashlib import sha1
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, returnValue, succeed, gatherResults,
+    maybeDeferred)
 
+from txredis.client import RedisSubscriber, RedisSubscriberFactory
+from txredis.exceptions import NoScript
+
+from vumi import log
+from vumi.errors import ConfigError
+from vumi.persist.fake_redis import FakeRedis
 from vumi.persist.txredis_manager import TxRedisManager
 
-from .utils import SandboxResource
+from .utils import SandboxResource, StatsMixin, LRUCache, HashRing, RawJSON
+
+
+def glob_escape(value):
+    """Escape the characters that Redis treats specially in a pattern."""
+    for char in '\\*?[]':
+        value = value.replace(char, '\\' + char)
+    return value
+
+
+class RedisScript(object):
+    """
+    A Lua script run with ``EVALSHA``, falling back to ``EVAL`` if Redis
+    doesn't have the script cached yet.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.sha = sha1(source).hexdigest()
+
+    @inlineCallbacks
+    def __call__(self, redis, keys, args):
+        client = redis._client
+        keys = [redis._key(key) for key in keys]
+        try:
+            result = yield client.evalsha(self.sha, keys, args)
+        except NoScript:
+            result = yield client.eval(self.source, keys, args)
+        returnValue(result)
+
+
+@inlineCallbacks
+def mget(redis, keys):
+    """
+    Fetch the values of several keys with a single ``MGET``. Clients
+    without ``MGET`` fall back to fetching each key in turn.
+    """
+    client = redis._client
+    if len(keys) == 1 or not hasattr(client, 'mget'):
+        values = []
+        for key in keys:
+            values.append((yield redis.get(key)))
+        returnValue(values)
+    values = yield client.mget(*[redis._key(key) for key in keys])
+    returnValue(values)
+
+
+class GetBatcher(object):
+    """
+    Collects the ``GET`` requests made during one reactor iteration and
+    sends them to Redis as a single ``MGET``.
+
+    Many sandboxes share one Redis connection, so the ``kv.get`` commands
+    they issue while the reactor processes a batch of sandbox output can
+    be answered by one command instead of one each.
+    """
+
+    def __init__(self, redis, clock=reactor):
+        self.redis = redis
+        self.clock = clock
+        self._pending = []
+        self._flush_call = None
+
+    def get(self, key):
+        d = Deferred()
+        self._pending.append((key, d))
+        if self._flush_call is None:
+            self._flush_call = self.clock.callLater(0, self.flush)
+        return d
+
+    def flush(self):
+        """
+        Send any pending requests now. Returns a deferred that fires once
+        they have all been answered.
+        """
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return succeed(None)
+        keys = [key for key, _d in pending]
+        d = mget(self.redis, keys)
+        d.addCallbacks(self._fan_out, self._fan_out_failure,
+                       callbackArgs=(pending,), errbackArgs=(pending,))
+        return d
+
+    def _fan_out(self, values, pending):
+        for (_key, d), value in zip(pending, values):
+            d.callback(value)
+
+    def _fan_out_failure(self, failure, pending):
+        for _key, d in pending:
+            d.errback(failure)
+
+
+class IncrBuffer(object):
+    """
+    Accumulates increments to integer keys in memory and writes them to
+    Redis in batches.
+
+    A key must be tracked with its current value before it is
+    incremented. The buffered value of a key is the last value seen in
+    Redis plus any increments not yet written. Keys are forgotten once a
+    flush happens without them having been incremented, so only recently
+    incremented keys are held in memory.
+
+    :param redis:
+        The Redis manager to write increments with.
+    :param int threshold:
+        Number of buffered increments that triggers a flush.
+    :param on_flushed:
+        Optional function called with the keys written by each flush.
+    """
+
+    def __init__(self, redis, threshold, on_flushed=None, clock=reactor):
+        self.redis = redis
+        self.threshold = threshold
+        self.on_flushed = on_flushed
+        self.clock = clock
+        self._values = {}
+        self._pending = {}
+        self._increments = 0
+        self._task = None
+
+    def start(self, interval):
+        """Flush every ``interval`` seconds."""
+        self._task = LoopingCall(self.flush)
+        self._task.clock = self.clock
+        d = self._task.start(interval, now=False)
+        d.addErrback(log.err, "IncrBuffer flushing task died")
+
+    def stop(self):
+        """Stop the flushing task and write any outstanding increments."""
+        if self._task is not None and self._task.running:
+            self._task.stop()
+        self._task = None
+        return self.flush()
+
+    def get(self, key):
+        """
+        Return the buffered value of ``key``, or ``None`` if the key is not
+        being tracked.
+        """
+        value = self._values.get(key)
+        if value is None:
+            return None
+        return value + self._pending.get(key, 0)
+
+    def track(self, key, value):
+        self._values[key] = value
+
+    def incr(self, key, amount):
+        """Buffer an increment to a tracked key and return its new value."""
+        self._pending[key] = self._pending.get(key, 0) + amount
+        value = self.get(key)
+        self._increments += 1
+        if self._increments >= self.threshold:
+            self.flush()
+        return value
+
+    def has_pending(self, *keys):
+        return any(key in self._pending for key in keys)
+
+    def discard(self, *keys):
+        """
+        Forget keys and any increments to them that haven't been written.
+        Used when the keys are overwritten or deleted.
+        """
+        for key in keys:
+            self._values.pop(key, None)
+            self._pending.pop(key, None)
+
+    def flush(self):
+        """
+        Write all buffered increments. Returns a deferred that fires once
+        they have been written.
+        """
+        pending, self._pending = self._pending, {}
+        self._increments = 0
+        self._values = dict(
+            (key, self._values[key] + amount)
+            for key, amount in pending.iteritems())
+        if not pending:
+            return succeed(None)
+        d = gatherResults([
+            self._write(key, amount) for key, amount in pending.iteritems()])
+        if self.on_flushed is not None:
+            d.addCallback(lambda _: self.on_flushed(*pending.keys()))
+        return d
+
+    def _write(self, key, amount):
+        d = self.redis.incr(key, amount)
+        d.addCallbacks(
+            self._written, self._write_failed,
+            callbackArgs=(key,), errbackArgs=(key, amount))
+        return d
+
+    def _written(self, value, key):
+        if key in self._values:
+            self._values[key] = int(value)
+
+    def _write_failed(self, failure, key, amount):
+        log.warning("Failed to increment %r by %s: %s" % (
+            key, amount, failure.getErrorMessage()))
+        self.discard(key)
 
 
-class RedisResource(SandboxResource):
+class CacheInvalidationSubscriber(RedisSubscriber):
+    """
+    Listens for keys published on a channel by other workers and removes
+    them from the resource's cache.
+    """
+
+    def connectionMade(self):
+        RedisSubscriber.connectionMade(self)
+        self.subscribe(self.factory.channel)
+
+    def messageReceived(self, channel, message):
+        # Keys are published as UTF-8, but cached under unicode keys.
+        if isinstance(message, str):
+            message = message.decode('utf-8')
+        self.factory.resource.invalidate_cached(message)
+
+
+class CacheInvalidationFactory(RedisSubscriberFactory):
+    protocol = CacheInvalidationSubscriber
+
+    def __init__(self, resource, channel, **client_options):
+        RedisSubscriberFactory.__init__(self, **client_options)
+        self.resource = resource
+        self.channel = channel
+
+
+class KvShard(object):
+    """
+    One of the Redis backends kv data is spread across, together with the
+    get batcher and increment buffer that talk to it and its read replicas,
+    which are also :class:`KvShard` instances.
+
+    :param str name:
+        The shard's name, which places it on the hash ring.
+    :param dict r_config:
+        The shard's Redis manager configuration.
+    :param redis:
+        The shard's Redis manager.
+    """
+
+    def __init__(self, name, r_config, redis):
+        self.name = name
+        self.r_config = r_config
+        self.redis = redis
+        self.get_batcher = None
+        self.incr_buffer = None
+        self.cache_subscriber = None
+        self.replicas = []
+        self._next_replica = 0
+
+    def next_replica(self):
+        """Return the next replica to read from, in turn."""
+        replica = self.replicas[self._next_replica % len(self.replicas)]
+        self._next_replica += 1
+        return replica
+
+
+# Checks the quota for KEYS[1] and counts it in KEYS[2] if it is a new key.
+# ARGV[1] and ARGV[2] are the soft and hard key limits. Returns 0 if the key
+# already exists, the new key count if the key was counted or the negated key
+# count that would have been reached if the hard limit prevents writing the
+# key.
+_CHECK_KEYS_LUA = """
+local function check_keys()
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        return 0
+    end
+    local key_count = tonumber(redis.call('GET', KEYS[2]) or '0') + 1
+    if key_count > tonumber(ARGV[1]) and key_count >= tonumber(ARGV[2]) then
+        return -key_count
+    end
+    redis.call('INCR', KEYS[2])
+    return key_count
+end
+"""
+
+# ARGV[3] is the value to set, ARGV[4] is the expiry in seconds or an empty
+# string for no expiry. Returns the result of check_keys().
+SET_SCRIPT = RedisScript(_CHECK_KEYS_LUA + """
+local key_count = check_keys()
+if key_count >= 0 then
+    if ARGV[4] == '' then
+        redis.call('SET', KEYS[1], ARGV[3])
+    else
+        redis.call('SETEX', KEYS[1], ARGV[4], ARGV[3])
+    end
+end
+return key_count
+""")
+
+# ARGV[3] is the amount to increment by. Returns the result of check_keys()
+# and the new value.
+INCR_SCRIPT = RedisScript(_CHECK_KEYS_LUA + """
+local key_count = check_keys()
+if key_count < 0 then
+    return {key_count, 0}
+end
+local value = redis.pcall('INCRBY', KEYS[1], ARGV[3])
+if type(value) == 'table' and value.err then
+    if key_count > 0 then
+        redis.call('DECR', KEYS[2])
+    end
+    return value
+end
+return {key_count, value}
+""")
+
+# KEYS[1] is the key count and the remaining keys are the keys to set. ARGV[1]
+# and ARGV[2] are the soft and hard key limits, ARGV[3] the expiry in seconds
+# or an empty string for no expiry and the remaining arguments the values, in
+# the same order as the keys. Returns 0 if none of the keys are new, the new
+# key count if new keys were counted or the negated key count that would have
+# been reached if the hard limit prevents writing the keys.
+MSET_SCRIPT = RedisScript("""
+local new_keys = 0
+for i = 2, #KEYS do
+    if redis.call('EXISTS', KEYS[i]) == 0 then
+        new_keys = new_keys + 1
+    end
+end
+local key_count = 0
+if new_keys > 0 then
+    key_count = tonumber(redis.call('GET', KEYS[1]) or '0') + new_keys
+    if key_count > tonumber(ARGV[1]) and key_count >= tonumber(ARGV[2]) then
+        return -key_count
+    end
+    redis.call('INCRBY', KEYS[1], new_keys)
+end
+for i = 2, #KEYS do
+    if ARGV[3] == '' then
+        redis.call('SET', KEYS[i], ARGV[i + 2])
+    else
+        redis.call('SETEX', KEYS[i], ARGV[3], ARGV[i + 2])
+    end
+end
+return key_count
+""")
+
+
+class RedisResource(StatsMixin, SandboxResource):
     """
     Resource that provides access to a simple key-value store.
 
@@ -22,6 +381,18 @@ class RedisResource(SandboxResource):
 
     :param dict redis_manager:
         Redis manager configuration options.
+    :param dict redis_managers:
+        If set, kv data is sharded across several Redis backends instead
+        of the single ``redis_manager``. This maps shard names to Redis
+        manager configuration options. Each sandbox's keys are all stored
+        on one shard, chosen by a consistent hash of the sandbox id and
+        the shard names, so adding a shard moves only a share of the
+        sandboxes to it. Existing keys must be moved with the
+        ``vxsandbox.scripts.rebalance_kv_shards`` script when shards are
+        added or removed. Without sharding, the resource's ``redis`` and
+        ``r_config`` attributes are the single backend's Redis manager and
+        its configuration. With sharding they are ``None``.
+        (default: no sharding).
     :param int keys_per_user_soft:
         Maximum number of keys each user may make use of in redis
         before usage warnings are logged.
@@ -31,6 +402,85 @@ class RedisResource(SandboxResource):
         (default: 100). Falls back to keys_per_user.
     :param int keys_per_user:
         Synonym for `keys_per_user_hard`. Deprecated.
+    :param int scan_max_count:
+        Maximum number of keys a ``scan`` command may ask for in a single
+        page. (default: 100).
+    :param list redis_replicas:
+        Redis manager configuration options for read replicas of the
+        ``redis_manager`` backend. When sharding, this is instead a
+        dictionary mapping shard names to lists of replica configuration
+        options. ``get`` and ``mget`` commands are sent to the replicas in
+        turn, unless the sandbox has written to the kv store within the
+        last ``replica_lag`` seconds. ``scan`` commands always use the
+        backend, because scan cursors are specific to a server. Replicas
+        must use the same key prefix as the backend they replicate.
+        (default: no replicas).
+    :param float replica_lag:
+        Number of seconds replicas are allowed to lag behind the backend
+        they replicate. A sandbox reads from the backend itself for this
+        long after each write, so that it sees its own writes.
+        (default: 1).
+    :param bool atomic_writes:
+        If true, ``set``, ``incr`` and ``mset`` check the key quota and
+        write the keys in a single Lua script on the Redis server. This
+        saves several round trips per write and prevents concurrent
+        writers from racing each other past the key limit. Requires Redis
+        2.6 or newer.
+        (default: false).
+    :param bool batch_gets:
+        If true, ``get`` commands issued by any sandbox during the same
+        reactor iteration are sent to Redis as a single ``MGET``.
+        (default: false).
+    :param int cache_max_bytes:
+        If non-zero, values read by ``get`` are cached in the worker, in
+        a least-recently-used cache holding up to this many bytes. Writes
+        made through this worker remove the written keys from the cache.
+        (default: 0).
+    :param float cache_ttl:
+        Number of seconds a value stays in the cache. Writes made by other
+        workers are only seen once the cached value expires, unless
+        ``cache_invalidation_channel`` is set. Cached values may also
+        outlive keys with a shorter expiry than this.
+        (default: 60).
+    :param str cache_invalidation_channel:
+        Redis channel to publish written keys on and to listen on for keys
+        written by other workers, so that they can be removed from the
+        cache. All workers sharing the Redis keys should use the same
+        channel. The channel name is prefixed with the Redis manager's key
+        prefix. (default: no channel).
+    :param bool buffer_incrs:
+        If true, ``incr`` commands are buffered in the worker and written
+        to Redis in batches. The key limit is checked the first time a
+        key is incremented. The values returned by ``incr`` and ``get``
+        include this worker's buffered increments, but increments made by
+        other workers are only seen after the next flush.
+        (default: false).
+    :param float incr_flush_interval:
+        Number of seconds between writes of buffered increments.
+        (default: 1).
+    :param int incr_flush_threshold:
+        Number of buffered increments that triggers a write before the
+        next interval. (default: 1000).
+    :param int compress_threshold:
+        If non-zero, values whose JSON encoding is at least this many
+        bytes long are stored compressed with zlib. Compressed values are
+        decompressed transparently when read, so this can be turned on or
+        off without migrating existing values. (default: 0).
+    :param int compress_level:
+        The zlib compression level, from 1 (fastest) to 9 (smallest).
+        (default: 6).
+    :param bool raw_json_values:
+        If true, the value of a ``set`` command is stored as the JSON text
+        the sandbox sent, and the values in ``get`` and ``mget`` replies
+        are sent to the sandbox as the stored JSON text. This saves
+        decoding and re-encoding every value in the worker, but values are
+        stored exactly as sent, including any whitespace. (default: false).
+    :param str metrics_prefix:
+        If set, cache hits, misses and evictions and the bytes and time
+        spent on compression are published as metrics with this prefix.
+        (default: no metrics).
+    :param int metrics_interval:
+        Number of seconds between metric publications. (default: 60).
     """
 
     # FIXME:
@@ -40,17 +490,348 @@ class RedisResource(SandboxResource):
     #    better than not allowing expiry of keys and filling up Redis
     #    though.
 
-    @inlineCallbacks
-    def setup(self):
-        self.r_config = self.config.get('redis_manager', {})
+    #: Marks compressed values. JSON text never starts with a NUL byte.
+    ZLIB_HEADER = "\x00z"
+
+    #: Redis manager options that aren't passed on to the Redis client.
+    MANAGER_OPTIONS = frozenset(
+        ['FAKE_REDIS', 'key_prefix', 'key_separator', 'host', 'port'])
+
+    clock = reactor
+
+    def _setup_key_limits(self):
         self.keys_per_user_hard = self.config.get(
             'keys_per_user_hard', self.config.get('keys_per_user', 100))
         self.keys_per_user_soft = self.config.get(
             'keys_per_user_soft', int(0.8 * self.keys_per_user_hard))
-        self.redis = yield TxRedisManager.from_config(self.r_config)
+        self.scan_max_count = self.config.get('scan_max_count', 100)
+
+    def _setup_value_encoding(self):
+        self.compress_threshold = self.config.get('compress_threshold', 0)
+        self.compress_level = self.config.get('compress_level', 6)
+        self.raw_json_values = self.config.get('raw_json_values', False)
+
+    @inlineCallbacks
+    def setup_shards(self, require_scripting=None):
+        """
+        Connect to the configured Redis backends and build the hash ring
+        that maps sandboxes onto them. If ``require_scripting`` is set,
+        a :class:`ConfigError` with that reason is raised unless every
+        backend supports EVALSHA.
+
+        Without sharding, ``redis`` and ``r_config`` are set to the single
+        backend's Redis manager and configuration, as they were before kv
+        data could be sharded. With sharding they are ``None``.
+        """
+        r_configs = self.config.get('redis_managers')
+        if r_configs is None:
+            r_configs = {'default': self.config.get('redis_manager', {})}
+        elif not r_configs:
+            raise ConfigError("redis_managers must name at least one shard")
+        self.shards = {}
+        for name, r_config in sorted(r_configs.iteritems()):
+            redis = yield TxRedisManager.from_config(r_config)
+            self.shards[name] = KvShard(name, r_config, redis)
+        self.redis = self.r_config = None
+        if self.config.get('redis_managers') is None:
+            self.redis = self.shards['default'].redis
+            self.r_config = self.shards['default'].r_config
+        if require_scripting is not None and not all(
+                hasattr(shard.redis._client, 'evalsha')
+                for shard in self.shards.itervalues()):
+            yield self.close_shards()
+            raise ConfigError(require_scripting)
+        self.ring = HashRing(self.shards.keys())
+
+    @inlineCallbacks
+    def setup_replicas(self):
+        """Connect to the configured read replicas of each shard."""
+        self.replica_lag = self.config.get('replica_lag', 1)
+        # Sandbox ids mapped to the time of their last write, oldest first.
+        self._recent_writes = OrderedDict()
+        r_configs = self.config.get('redis_replicas', {})
+        if isinstance(r_configs, list):
+            r_configs = {'default': r_configs}
+        for name, replica_configs in sorted(r_configs.iteritems()):
+            if name not in self.shards:
+                yield self.close_shards()
+                raise ConfigError(
+                    "redis_replicas names unknown shard %r" % (name,))
+            shard = self.shards[name]
+            for i, r_config in enumerate(replica_configs):
+                redis = yield TxRedisManager.from_config(r_config)
+                shard.replicas.append(
+                    KvShard("%s-replica-%d" % (name, i), r_config, redis))
+
+    def close_shards(self):
+        return gatherResults([
+            maybeDeferred(shard.redis.close_manager)
+            for primary in self.shards.itervalues()
+            for shard in [primary] + primary.replicas])
+
+    def shard_for(self, sandbox_id):
+        """Return the shard that holds the given sandbox's keys."""
+        return self.shards[self.ring.get_node(sandbox_id)]
+
+    @inlineCallbacks
+    def setup(self):
+        self._setup_key_limits()
+        self._setup_value_encoding()
+        self.atomic_writes = self.config.get('atomic_writes', False)
+        self.batch_gets = self.config.get('batch_gets', False)
+        cache_max_bytes = self.config.get('cache_max_bytes', 0)
+        self.cache_ttl = self.config.get('cache_ttl', 60)
+        self.cache_channel = self.config.get('cache_invalidation_channel')
+        yield self.setup_shards(
+            "atomic_writes requires a Redis client that supports EVALSHA"
+            if self.atomic_writes else None)
+        yield self.setup_replicas()
+        self.cache = LRUCache(cache_max_bytes) if cache_max_bytes else None
+        # Bumped whenever cached keys are invalidated, so that values read
+        # before a write finished aren't cached after it.
+        self._cache_invalidations = 0
+        for shard in self.shards.itervalues():
+            if self.batch_gets:
+                for reader in [shard] + shard.replicas:
+                    reader.get_batcher = GetBatcher(reader.redis)
+            if self.cache is not None and self.cache_channel is not None:
+                shard.cache_subscriber = self.connect_cache_subscriber(shard)
+            if self.config.get('buffer_incrs', False):
+                shard.incr_buffer = IncrBuffer(
+                    shard.redis,
+                    self.config.get('incr_flush_threshold', 1000),
+                    on_flushed=partial(self._invalidate_written, shard))
+                shard.incr_buffer.start(
+                    self.config.get('incr_flush_interval', 1))
+        yield self.setup_stats()
 
+    def _cache_channel_for(self, shard):
+        """
+        Return the invalidation channel on a shard, namespaced with the
+        shard's key prefix.
+        """
+        return shard.redis._key(self.cache_channel)
+
+    def connect_cache_subscriber(self, shard):
+        """
+        Subscribe to the cache invalidation channel on a shard, connecting
+        with the same client options (such as ``password``) as the shard's
+        Redis manager. Returns ``None`` for fake Redis backends, which
+        can't be subscribed to.
+        """
+        if isinstance(shard.redis._client, FakeRedis):
+            return None
+        client_options = dict(
+            (option, value) for option, value in shard.r_config.iteritems()
+            if option not in self.MANAGER_OPTIONS)
+        factory = CacheInvalidationFactory(
+            self, self._cache_channel_for(shard), **client_options)
+        reactor.connectTCP(
+            shard.r_config.get('host', '127.0.0.1'),
+            shard.r_config.get('port', 6379), factory)
+        return factory
+
+    @inlineCallbacks
     def teardown(self):
-        return self.redis.close_manager()
+        for shard in self.shards.itervalues():
+            for reader in [shard] + shard.replicas:
+                if reader.get_batcher is not None:
+                    yield reader.get_batcher.flush()
+            if shard.incr_buffer is not None:
+                yield shard.incr_buffer.stop()
+            if shard.cache_subscriber is not None:
+                shard.cache_subscriber.stopTrying()
+                if shard.cache_subscriber.client is not None:
+                    shard.cache_subscriber.client.transport.loseConnection()
+        self.teardown_stats()
+        yield self.close_shards()
+
+    def _encode_value(self, value):
+        """
+        Encode a value as JSON for storing, compressing it if it is large
+        enough.
+        """
+        return self._encode_json(json.dumps(value))
+
+    def _encode_command_value(self, command):
+        """
+        Encode the ``value`` field of a command for storing, reusing the
+        JSON text the command was decoded from if ``raw_json_values`` is
+        set.
+        """
+        json_value = None
+        if self.raw_json_values:
+            json_value = command.raw_json('value')
+        if json_value is None:
+            json_value = json.dumps(command.get('value'))
+        return self._encode_json(json_value)
+
+    def _encode_json(self, json_value):
+        """Compress JSON text for storing if it is large enough."""
+        if not (self.compress_threshold and
+                len(json_value) >= self.compress_threshold):
+            return json_value
+        start = time.time()
+        raw_value = self.ZLIB_HEADER + zlib.compress(
+            json_value, self.compress_level)
+        self._observe_stat('compression.compress_time',
+                           (time.time() - start) * 1000)
+        self._incr_stat('compression.bytes_in', len(json_value))
+        self._incr_stat('compression.bytes_out', len(raw_value))
+        return raw_value
+
+    def _decompress(self, raw_value):
+        """Return the JSON text of a stored value."""
+        if raw_value.startswith(self.ZLIB_HEADER):
+            start = time.time()
+            raw_value = zlib.decompress(raw_value[len(self.ZLIB_HEADER):])
+            self._observe_stat('compression.decompress_time',
+                               (time.time() - start) * 1000)
+        return raw_value
+
+    def _decode_value(self, raw_value):
+        """Decode a stored value, decompressing it if necessary."""
+        if raw_value is None:
+            return None
+        return json.loads(self._decompress(raw_value))
+
+    def _reply_value(self, raw_value):
+        """
+        Return a stored value for including in a reply, as raw JSON if
+        ``raw_json_values`` is set.
+        """
+        if not self.raw_json_values:
+            return self._decode_value(raw_value)
+        if raw_value is None:
+            return None
+        return RawJSON(self._decompress(raw_value))
+
+    def _reply_values(self, raw_values):
+        """
+        Return a list of stored values for including in a reply, as a raw
+        JSON array if ``raw_json_values`` is set.
+        """
+        if not self.raw_json_values:
+            return [self._decode_value(raw_value) for raw_value in raw_values]
+        return RawJSON("[%s]" % ", ".join(
+            "null" if raw_value is None else self._decompress(raw_value)
+            for raw_value in raw_values))
+
+    def invalidate_cached(self, *keys):
+        """Remove keys from the cache."""
+        if self.cache is None:
+            return
+        self._cache_invalidations += 1
+        for key in keys:
+            self.cache.delete(key)
+
+    @inlineCallbacks
+    def _invalidate_written(self, shard, *keys):
+        if self.cache is None:
+            return
+        self.invalidate_cached(*keys)
+        if self.cache_channel is not None:
+            yield gatherResults([
+                shard.redis._client.publish(
+                    self._cache_channel_for(shard), key)
+                for key in keys])
+
+    @inlineCallbacks
+    def _flush_buffered(self, shard, *keys):
+        """
+        Write any buffered increments to keys that are about to be
+        overwritten or deleted and stop tracking the keys.
+        """
+        if shard.incr_buffer is None:
+            return
+        if shard.incr_buffer.has_pending(*keys):
+            yield shard.incr_buffer.flush()
+        shard.incr_buffer.discard(*keys)
+
+    @inlineCallbacks
+    def _buffered_incr(self, api, key, amount):
+        """
+        Buffer an increment, tracking the key first if necessary. Returns
+        the new value, or ``None`` if the key limit prevents creating the
+        key.
+        """
+        shard = self.shard_for(api.sandbox_id)
+        if shard.incr_buffer.get(key) is None:
+            raw_value = yield shard.redis.get(key)
+            if raw_value is None:
+                if not (yield self.check_keys(api, key)):
+                    returnValue(None)
+                value = 0
+            else:
+                value = int(raw_value)
+            if shard.incr_buffer.get(key) is None:
+                shard.incr_buffer.track(key, value)
+        returnValue(shard.incr_buffer.incr(key, amount))
+
+    def _record_write(self, api):
+        """
+        Note that a sandbox is writing, so that its reads are sent to the
+        primary backend until replicas have caught up.
+        """
+        if not self._has_replicas(api):
+            return
+        now = self.clock.seconds()
+        self._recent_writes.pop(api.sandbox_id, None)
+        self._recent_writes[api.sandbox_id] = now
+        while self._recent_writes:
+            sandbox_id, written = next(self._recent_writes.iteritems())
+            if written > now - self.replica_lag:
+                break
+            del self._recent_writes[sandbox_id]
+
+    def _has_replicas(self, api):
+        return bool(self.shard_for(api.sandbox_id).replicas)
+
+    def _reader(self, api):
+        """
+        Return the shard or the replica of it to read a sandbox's keys
+        from.
+        """
+        shard = self.shard_for(api.sandbox_id)
+        if not shard.replicas:
+            return shard
+        written = self._recent_writes.get(api.sandbox_id)
+        if (written is not None and
+                written > self.clock.seconds() - self.replica_lag):
+            return shard
+        return shard.next_replica()
+
+    @inlineCallbacks
+    def _get_raw(self, shard, key, reader=None):
+        """
+        Return a key's stored value. Values that aren't buffered or cached
+        are read from ``reader``, which defaults to the shard itself.
+        """
+        if reader is None:
+            reader = shard
+        if shard.incr_buffer is not None:
+            value = shard.incr_buffer.get(key)
+            if value is not None:
+                returnValue(str(value))
+        if self.cache is not None:
+            raw_value = self.cache.get(key)
+            if raw_value is not None:
+                self._incr_stat('cache.hits')
+                returnValue(raw_value)
+            self._incr_stat('cache.misses')
+        invalidations = self._cache_invalidations
+        if reader.get_batcher is not None:
+            raw_value = yield reader.get_batcher.get(key)
+        else:
+            raw_value = yield reader.redis.get(key)
+        if (self.cache is not None and raw_value is not None and
+                invalidations == self._cache_invalidations):
+            evictions = self.cache.evictions
+            self.cache.set(
+                key, raw_value, len(key) + len(raw_value), self.cache_ttl)
+            self._incr_stat(
+                'cache.evictions', self.cache.evictions - evictions)
+        returnValue(raw_value)
 
     def _count_key(self, sandbox_id):
         return "#".join(["count", sandbox_id])
@@ -62,12 +843,11 @@ class RedisResource(SandboxResource):
         return self.reply(command, success=False,
                           reason="Too many keys")
 
-    @inlineCallbacks
-    def check_keys(self, api, key):
-        if (yield self.redis.exists(key)):
-            returnValue(True)
-        count_key = self._count_key(api.sandbox_id)
-        key_count = yield self.redis.incr(count_key, 1)
+    def _key_count_allowed(self, api, key_count):
+        """
+        Log any key limits reached by a new key count and return whether
+        the hard limit still allows the new keys to be written.
+        """
         if key_count > self.keys_per_user_soft:
             if key_count < self.keys_per_user_hard:
                 api.log('Redis soft limit of %s keys reached for sandbox %s. '
@@ -83,10 +863,51 @@ class RedisResource(SandboxResource):
                             self.keys_per_user_hard,
                             api.sandbox_id),
                         logging.ERROR)
-                yield self.redis.incr(count_key, -1)
-                returnValue(False)
+                return False
+        return True
+
+    @inlineCallbacks
+    def check_keys(self, api, key):
+        redis = self.shard_for(api.sandbox_id).redis
+        if (yield redis.exists(key)):
+            returnValue(True)
+        count_key = self._count_key(api.sandbox_id)
+        key_count = yield redis.incr(count_key, 1)
+        if not self._key_count_allowed(api, key_count):
+            yield redis.incr(count_key, -1)
+            returnValue(False)
         returnValue(True)
 
+    def _script_keys_and_limits(self, api, key):
+        keys = [key, self._count_key(api.sandbox_id)]
+        args = [self.keys_per_user_soft, self.keys_per_user_hard]
+        return keys, args
+
+    @inlineCallbacks
+    def _atomic_set(self, api, key, json_value, seconds):
+        keys, args = self._script_keys_and_limits(api, key)
+        args.extend([json_value, seconds if seconds is not None else ''])
+        key_count = yield SET_SCRIPT(
+            self.shard_for(api.sandbox_id).redis, keys, args)
+        returnValue(self._key_count_allowed(api, abs(key_count)))
+
+    @inlineCallbacks
+    def _atomic_incr(self, api, key, amount):
+        keys, args = self._script_keys_and_limits(api, key)
+        args.append(amount)
+        key_count, value = yield INCR_SCRIPT(
+            self.shard_for(api.sandbox_id).redis, keys, args)
+        returnValue((self._key_count_allowed(api, abs(key_count)), value))
+
+    @inlineCallbacks
+    def _atomic_mset(self, api, keys, json_values, seconds):
+        args = [self.keys_per_user_soft, self.keys_per_user_hard,
+                seconds if seconds is not None else '']
+        key_count = yield MSET_SCRIPT(
+            self.shard_for(api.sandbox_id).redis,
+            [self._count_key(api.sandbox_id)] + keys, args + json_values)
+        returnValue(self._key_count_allowed(api, abs(key_count)))
+
     @inlineCallbacks
     def handle_set(self, api, command):
         """
@@ -115,17 +936,27 @@ class RedisResource(SandboxResource):
                                                reply.success); });
         """
         key = self._sandboxed_key(api.sandbox_id, command.get('key'))
+        shard = self.shard_for(api.sandbox_id)
+        self._record_write(api)
         seconds = command.get('seconds')
         if not (seconds is None or isinstance(seconds, (int, long))):
             returnValue(self.reply_error(
                 command, "seconds must be a number or null"))
+        yield self._flush_buffered(shard, key)
+        if self.atomic_writes:
+            json_value = self._encode_command_value(command)
+            if not (yield self._atomic_set(api, key, json_value, seconds)):
+                returnValue(self._too_many_keys(command))
+            yield self._invalidate_written(shard, key)
+            returnValue(self.reply(command, success=True))
         if not (yield self.check_keys(api, key)):
             returnValue(self._too_many_keys(command))
-        json_value = json.dumps(command.get('value'))
+        json_value = self._encode_command_value(command)
         if seconds is None:
-            yield self.redis.set(key, json_value)
+            yield shard.redis.set(key, json_value)
         else:
-            yield self.redis.setex(key, seconds, json_value)
+            yield shard.redis.setex(key, seconds, json_value)
+        yield self._invalidate_written(shard, key)
         returnValue(self.reply(command, success=True))
 
     @inlineCallbacks
@@ -156,10 +987,10 @@ class RedisResource(SandboxResource):
             );
         """
         key = self._sandboxed_key(api.sandbox_id, command.get('key'))
-        raw_value = yield self.redis.get(key)
-        value = json.loads(raw_value) if raw_value is not None else None
+        shard = self.shard_for(api.sandbox_id)
+        raw_value = yield self._get_raw(shard, key, self._reader(api))
         returnValue(self.reply(command, success=True,
-                               value=value))
+                               value=self._reply_value(raw_value)))
 
     @inlineCallbacks
     def handle_delete(self, api, command):
@@ -187,13 +1018,37 @@ class RedisResource(SandboxResource):
             );
         """
         key = self._sandboxed_key(api.sandbox_id, command.get('key'))
-        existed = bool((yield self.redis.delete(key)))
+        shard = self.shard_for(api.sandbox_id)
+        self._record_write(api)
+        yield self._flush_buffered(shard, key)
+        existed = bool((yield shard.redis.delete(key)))
+        yield self._invalidate_written(shard, key)
         if existed:
             count_key = self._count_key(api.sandbox_id)
-            yield self.redis.incr(count_key, -1)
+            yield shard.redis.incr(count_key, -1)
         returnValue(self.reply(command, success=True,
                                existed=existed))
 
+    def _key_arg(self, command):
+        """
+        Return the key of a command, or raise :class:`ValueError` if it
+        isn't a string.
+        """
+        key = command.get('key')
+        if not isinstance(key, basestring):
+            raise ValueError("key must be a string")
+        return key
+
+    def _amount_arg(self, command):
+        """
+        Return the amount to increment by for an incr command, or raise
+        :class:`ValueError` if it isn't an integer.
+        """
+        amount = command.get('amount', 1)
+        if isinstance(amount, bool) or not isinstance(amount, (int, long)):
+            raise ValueError("amount must be an integer")
+        return amount
+
     @inlineCallbacks
     def handle_incr(self, api, command):
         """
@@ -226,12 +1081,685 @@ class RedisResource(SandboxResource):
                 }
             );
         """
+        try:
+            amount = self._amount_arg(command)
+        except ValueError, e:
+            returnValue(self.reply_error(command, str(e)))
         key = self._sandboxed_key(api.sandbox_id, command.get('key'))
+        shard = self.shard_for(api.sandbox_id)
+        self._record_write(api)
+        if shard.incr_buffer is not None:
+            try:
+                value = yield self._buffered_incr(api, key, amount)
+            except ValueError:
+                returnValue(self.reply(
+                    command, success=False, reason=u"value is not an integer"))
+            if value is None:
+                returnValue(self._too_many_keys(command))
+            returnValue(self.reply(command, value=value, success=True))
+        if self.atomic_writes:
+            try:
+                allowed, value = yield self._atomic_incr(api, key, amount)
+            except shard.redis.RESPONSE_ERROR, e:
+                returnValue(
+                    self.reply(command, success=False, reason=unicode(e)))
+            if not allowed:
+                returnValue(self._too_many_keys(command))
+            yield self._invalidate_written(shard, key)
+            returnValue(self.reply(command, value=int(value), success=True))
         if not (yield self.check_keys(api, key)):
             returnValue(self._too_many_keys(command))
-        amount = command.get('amount', 1)
         try:
-            value = yield self.redis.incr(key, amount=amount)
+            value = yield shard.redis.incr(key, amount=amount)
         except Exception, e:
             returnValue(self.reply(command, success=False, reason=unicode(e)))
+        yield self._invalidate_written(shard, key)
         returnValue(self.reply(command, value=int(value), success=True))
+
+    def _valid_keys(self, keys):
+        return (isinstance(keys, list) and
+                all(isinstance(key, basestring) for key in keys))
+
+    def _sandboxed_keys(self, api, keys):
+        if not self._valid_keys(keys):
+            return None
+        return [self._sandboxed_key(api.sandbox_id, key) for key in keys]
+
+    @inlineCallbacks
+    def handle_mget(self, api, command):
+        """
+        Retrieve the values of several keys at once.
+
+        Command fields:
+            - ``keys``: A list of the keys whose values should be retrieved.
+
+        Reply fields:
+            - ``success``: ``true`` if the operation was successful, otherwise
+              ``false``.
+            - ``values``: A list of the values retrieved, in the same order
+              as ``keys``. Keys that do not exist have the value ``null``.
+
+        Example:
+
+        .. code-block:: javascript
+
+            api.request(
+                'kv.mget',
+                {keys: ['name', 'age']},
+                function(reply) {
+                    api.log_info(
+                        'Values retrieved: ' +
+                        JSON.stringify(reply.values));
+                }
+            );
+        """
+        keys = self._sandboxed_keys(api, command.get('keys'))
+        if keys is None:
+            returnValue(self.reply_error(
+                command, "keys must be a list of strings"))
+        shard = self.shard_for(api.sandbox_id)
+        reader = self._reader(api)
+        raw_values = (yield mget(reader.redis, keys)) if keys else []
+        if shard.incr_buffer is not None:
+            buffered = [shard.incr_buffer.get(key) for key in keys]
+            raw_values = [
+                raw_value if buffered_value is None else str(buffered_value)
+                for raw_value, buffered_value in zip(raw_values, buffered)]
+        returnValue(self.reply(
+            command, success=True, values=self._reply_values(raw_values)))
+
+    @inlineCallbacks
+    def handle_mset(self, api, command):
+        """
+        Set the values of several keys at once.
+
+        The key limit is checked for all the new keys together, so either
+        all of the keys are written or none of them are.
+
+        Command fields:
+            - ``items``: An object mapping keys to the values to store.
+              Values may be any JSON serializable object.
+            - ``seconds``: Lifetime of the keys in seconds. The default
+              ``null`` indicates that the keys should not expire.
+
+        Reply fields:
+            - ``success``: ``true`` if the operation was successful, otherwise
+              ``false``.
+
+        Example:
+
+        .. code-block:: javascript
+
+            api.request(
+                'kv.mset',
+                {items: {name: 'Jane', age: 32}},
+                function(reply) { api.log_info('Values stored: ' +
+                                               reply.success); });
+        """
+        items = command.get('items')
+        if not isinstance(items, dict):
+            returnValue(self.reply_error(command, "items must be an object"))
+        seconds = command.get('seconds')
+        if not (seconds is None or isinstance(seconds, (int, long))):
+            returnValue(self.reply_error(
+                command, "seconds must be a number or null"))
+        if not items:
+            returnValue(self.reply(command, success=True))
+        keys = [self._sandboxed_key(api.sandbox_id, key) for key in items]
+        shard = self.shard_for(api.sandbox_id)
+        self._record_write(api)
+        yield self._flush_buffered(shard, *keys)
+        if self.atomic_writes:
+            json_values = [self._encode_value(value)
+                           for value in items.itervalues()]
+            if not (yield self._atomic_mset(api, keys, json_values, seconds)):
+                returnValue(self._too_many_keys(command))
+            yield self._invalidate_written(shard, *keys)
+            returnValue(self.reply(command, success=True))
+        existing = yield mget(shard.redis, keys)
+        new_keys = existing.count(None)
+        if new_keys:
+            count_key = self._count_key(api.sandbox_id)
+            key_count = yield shard.redis.incr(count_key, new_keys)
+            if not self._key_count_allowed(api, key_count):
+                yield shard.redis.incr(count_key, -new_keys)
+                returnValue(self._too_many_keys(command))
+        writes = []
+        for key, value in zip(keys, items.itervalues()):
+            json_value = self._encode_value(value)
+            if seconds is None:
+                writes.append(shard.redis.set(key, json_value))
+            else:
+                writes.append(shard.redis.setex(key, seconds, json_value))
+        yield gatherResults(writes)
+        yield self._invalidate_written(shard, *keys)
+        returnValue(self.reply(command, success=True))
+
+    @inlineCallbacks
+    def handle_mdelete(self, api, command):
+        """
+        Delete several keys at once.
+
+        Command fields:
+            - ``keys``: A list of the keys to delete.
+
+        Reply fields:
+            - ``success``: ``true`` if the operation was successful, otherwise
+              ``false``.
+            - ``existed``: A list of booleans, in the same order as ``keys``,
+              indicating which keys existed before they were deleted.
+
+        Example:
+
+        .. code-block:: javascript
+
+            api.request(
+                'kv.mdelete',
+                {keys: ['name', 'age']},
+                function(reply) {
+                    api.log_info('Values deleted: ' +
+                                 reply.success);
+                }
+            );
+        """
+        keys = self._sandboxed_keys(api, command.get('keys'))
+        if keys is None:
+            returnValue(self.reply_error(
+                command, "keys must be a list of strings"))
+        shard = self.shard_for(api.sandbox_id)
+        self._record_write(api)
+        yield self._flush_buffered(shard, *keys)
+        deleted = yield gatherResults(
+            [shard.redis.delete(key) for key in keys])
+        existed = [bool(count) for count in deleted]
+        yield self._invalidate_written(shard, *keys)
+        if any(existed):
+            count_key = self._count_key(api.sandbox_id)
+            yield shard.redis.incr(count_key, -existed.count(True))
+        returnValue(self.reply(command, success=True, existed=existed))
+
+    def _scan_args(self, command):
+        """
+        Return the cursor, count and match pattern for a scan command, or
+        raise :class:`ValueError` if they are invalid.
+        """
+        cursor = command.get('cursor')
+        if not (cursor is None or isinstance(cursor, basestring)):
+            raise ValueError("cursor must be a string or null")
+        count = command.get('count', 10)
+        if not (isinstance(count, (int, long)) and count > 0):
+            raise ValueError("count must be a positive number")
+        match = command.get('match', '*')
+        if not isinstance(match, basestring):
+            raise ValueError("match must be a string")
+        return cursor, min(count, self.scan_max_count), match
+
+    @inlineCallbacks
+    def handle_scan(self, api, command):
+        """
+        Iterate over the sandbox's keys a page at a time.
+
+        Each reply includes a cursor to pass to the next request. The scan
+        is finished when the returned cursor is ``null``. Keys that exist
+        for the whole scan are returned at least once, but a key may be
+        returned more than once and pages may be empty. Keys that are
+        written or deleted during the scan may or may not be returned.
+
+        Command fields:
+            - ``cursor``: The cursor returned by the previous request, or
+              ``null`` to start a new scan.
+            - ``count``: Roughly how many keys to return. Defaults to 10
+              and is limited by the ``scan_max_count`` option.
+            - ``match``: An optional glob-style pattern that the returned
+              keys must match, e.g. ``user:*``.
+
+        Reply fields:
+            - ``success``: ``true`` if the operation was successful, otherwise
+              ``false``.
+            - ``keys``: A list of keys.
+            - ``cursor``: The cursor to continue the scan with, or ``null``
+              if the scan is finished.
+
+        Example:
+
+        .. code-block:: javascript
+
+            function scan(cursor) {
+                api.request(
+                    'kv.scan',
+                    {cursor: cursor, match: 'user:*'},
+                    function(reply) {
+                        api.log_info('Keys: ' + reply.keys.join(', '));
+                        if (reply.cursor !== null) {
+                            scan(reply.cursor);
+                        }
+                    }
+                );
+            }
+            scan(null);
+        """
+        try:
+            cursor, count, match = self._scan_args(command)
+        except ValueError, e:
+            returnValue(self.reply_error(command, str(e)))
+        prefix = self._sandboxed_key(api.sandbox_id, '')
+        # Cursors are only meaningful to the server that returned them, so
+        # scans always use the shard itself rather than its replicas.
+        shard = self.shard_for(api.sandbox_id)
+        next_cursor, keys = yield shard.redis.scan(
+            cursor, match=glob_escape(prefix) + match, count=count)
+        keys = [key[len(prefix):] for key in keys]
+        returnValue(self.reply(
+            command, success=True, keys=keys, cursor=next_cursor))
+
+
+# Helpers for the hash layout scripts. KEYS[1] is the sandbox's hash and
+# KEYS[2] its expiry index, a sorted set of fields scored by the time they
+# expire at.
+# check_new_fields() removes all of the sandbox's expired fields before
+# counting them, so that the key limit doesn't count expired keys.
+_HASH_HELPERS_LUA = """
+local function expired(field, now)
+    local expires = redis.call('ZSCORE', KEYS[2], field)
+    return expires and tonumber(expires) <= tonumber(now)
+end
+
+local function remove_all_expired(now)
+    local fields = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)
+    for _, field in ipairs(fields) do
+        redis.call('HDEL', KEYS[1], field)
+        redis.call('ZREM', KEYS[2], field)
+    end
+end
+
+local function check_new_fields(fields, soft, hard, now)
+    remove_all_expired(now)
+    local new_fields = 0
+    for _, field in ipairs(fields) do
+        if redis.call('HEXISTS', KEYS[1], field) == 0 then
+            new_fields = new_fields + 1
+        end
+    end
+    if new_fields == 0 then
+        return 0
+    end
+    local key_count = redis.call('HLEN', KEYS[1]) + new_fields
+    if key_count > tonumber(soft) and key_count >= tonumber(hard) then
+        return -key_count
+    end
+    return key_count
+end
+"""
+
+# KEYS[3] is the set of sandboxes with expiring fields. ARGV[1] and ARGV[2]
+# are the soft and hard key limits, ARGV[3] the current time, ARGV[4] the
+# sandbox id and ARGV[5] the expiry time or an empty string for no expiry.
+# The remaining arguments are pairs of fields and values. Returns 0 if no
+# new fields were written, the new key count if some were or the negated key
+# count that would have been reached if the hard limit prevents writing.
+HASH_SET_SCRIPT = RedisScript(_HASH_HELPERS_LUA + """
+local fields = {}
+for i = 6, #ARGV, 2 do
+    table.insert(fields, ARGV[i])
+end
+local key_count = check_new_fields(fields, ARGV[1], ARGV[2], ARGV[3])
+if key_count < 0 then
+    return key_count
+end
+for i = 6, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    if ARGV[5] == '' then
+        redis.call('ZREM', KEYS[2], ARGV[i])
+    else
+        redis.call('ZADD', KEYS[2], ARGV[5], ARGV[i])
+        redis.call('SADD', KEYS[3], ARGV[4])
+    end
+end
+return key_count
+""")
+
+# ARGV[1] to ARGV[3] are as for HASH_SET_SCRIPT, ARGV[4] is the field and
+# ARGV[5] the amount to increment by. Returns the key count as for
+# HASH_SET_SCRIPT and the new value.
+HASH_INCR_SCRIPT = RedisScript(_HASH_HELPERS_LUA + """
+local key_count = check_new_fields({ARGV[4]}, ARGV[1], ARGV[2], ARGV[3])
+if key_count < 0 then
+    return {key_count, 0}
+end
+local value = redis.pcall('HINCRBY', KEYS[1], ARGV[4], ARGV[5])
+if type(value) == 'table' and value.err then
+    return value
+end
+return {key_count, value}
+""")
+
+# ARGV[1] is the current time and the remaining arguments are fields.
+# Returns the values of the fields, with nil for missing or expired fields.
+HASH_GET_SCRIPT = RedisScript(_HASH_HELPERS_LUA + """
+local values = {}
+for i = 2, #ARGV do
+    if expired(ARGV[i], ARGV[1]) then
+        values[i - 1] = false
+    else
+        values[i - 1] = redis.call('HGET', KEYS[1], ARGV[i])
+    end
+end
+return values
+""")
+
+# ARGV[1] is the current time and the remaining arguments are fields.
+# Returns 1 for each field that existed and hadn't expired and 0 otherwise.
+HASH_DELETE_SCRIPT = RedisScript(_HASH_HELPERS_LUA + """
+local existed = {}
+for i = 2, #ARGV do
+    local was_expired = expired(ARGV[i], ARGV[1])
+    local deleted = redis.call('HDEL', KEYS[1], ARGV[i])
+    redis.call('ZREM', KEYS[2], ARGV[i])
+    if was_expired then
+        deleted = 0
+    end
+    existed[i - 1] = deleted
+end
+return existed
+""")
+
+# ARGV[1] is the current time, ARGV[2] the HSCAN cursor, ARGV[3] the match
+# pattern and ARGV[4] the count. Returns the next cursor and the fields
+# found that haven't expired.
+HASH_SCAN_SCRIPT = RedisScript(_HASH_HELPERS_LUA + """
+local result = redis.call(
+    'HSCAN', KEYS[1], ARGV[2], 'MATCH', ARGV[3], 'COUNT', ARGV[4])
+local fields = {}
+local items = result[2]
+for i = 1, #items, 2 do
+    if not expired(items[i], ARGV[1]) then
+        table.insert(fields, items[i])
+    end
+end
+return {result[1], fields}
+""")
+
+# KEYS[3] is the set of sandboxes with expiring fields. ARGV[1] is the
+# current time, ARGV[2] the sandbox id and ARGV[3] the maximum number of
+# fields to remove. Returns the number of fields removed.
+HASH_SWEEP_SCRIPT = RedisScript("""
+local fields = redis.call(
+    'ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+for _, field in ipairs(fields) do
+    redis.call('HDEL', KEYS[1], field)
+    redis.call('ZREM', KEYS[2], field)
+end
+if redis.call('ZCARD', KEYS[2]) == 0 then
+    redis.call('SREM', KEYS[3], ARGV[2])
+end
+return #fields
+""")
+
+
+class HashRedisResource(RedisResource):
+    """
+    Resource that provides access to a simple key-value store, storing
+    each sandbox's keys as the fields of a single Redis hash.
+
+    The commands are the same as those of :class:`RedisResource`. The
+    number of keys a sandbox has is the length of its hash, so the key
+    limit never drifts from the number of keys actually stored. It is
+    checked and the keys are written in a single Lua script, which
+    requires Redis 2.6 or newer.
+
+    Redis can't expire hash fields, so keys written with an expiry are
+    added to a sorted set of expiry times. Expired keys are hidden from
+    reads immediately. They are removed from the hash before each write
+    that adds keys, so that they don't count towards the key limit, and
+    by a periodic sweep.
+
+    Existing data can be moved to this layout with
+    :mod:`vxsandbox.scripts.migrate_kv_to_hashes`.
+
+    Configuration options:
+
+    :param dict redis_manager:
+        Redis manager configuration options.
+    :param dict redis_managers:
+        If set, kv data is sharded across several Redis backends instead
+        of the single ``redis_manager``. This maps shard names to Redis
+        manager configuration options. Each sandbox's keys are all stored
+        on one shard, chosen by a consistent hash of the sandbox id and
+        the shard names, so adding a shard moves only a share of the
+        sandboxes to it. Existing keys must be moved with the
+        ``vxsandbox.scripts.rebalance_kv_shards`` script when shards are
+        added or removed. Without sharding, the resource's ``redis`` and
+        ``r_config`` attributes are the single backend's Redis manager and
+        its configuration. With sharding they are ``None``.
+        (default: no sharding).
+    :param int keys_per_user_soft:
+        Maximum number of keys each user may make use of in redis
+        before usage warnings are logged.
+        (default: 80% of hard limit).
+    :param int keys_per_user_hard:
+        Maximum number of keys each user may make use of in redis
+        (default: 100). Falls back to keys_per_user.
+    :param int keys_per_user:
+        Synonym for `keys_per_user_hard`. Deprecated.
+    :param float expiry_sweep_interval:
+        Number of seconds between sweeps for expired keys.
+        (default: 60).
+    :param int expiry_sweep_limit:
+        Maximum number of expired keys removed per sandbox in each sweep.
+        (default: 1000).
+    :param int compress_threshold:
+        As for :class:`RedisResource`.
+    :param int compress_level:
+        As for :class:`RedisResource`.
+    :param bool raw_json_values:
+        As for :class:`RedisResource`.
+    :param str metrics_prefix:
+        If set, the bytes and time spent on compression are published as
+        metrics with this prefix. (default: no metrics).
+    :param int metrics_interval:
+        Number of seconds between metric publications. (default: 60).
+    """
+
+    HASH_KEY = "kv#%s"
+    EXPIRY_KEY = "kv-expiry#%s"
+    EXPIRING_KEY = "kv-expiring"
+
+    clock = reactor
+
+    @inlineCallbacks
+    def setup(self):
+        self._setup_key_limits()
+        self._setup_value_encoding()
+        self.sweep_limit = self.config.get('expiry_sweep_limit', 1000)
+        yield self.setup_shards(
+            "HashRedisResource requires a Redis client that supports"
+            " EVALSHA")
+        self._sweeper = LoopingCall(self.sweep_expired)
+        self._sweeper.clock = self.clock
+        d = self._sweeper.start(
+            self.config.get('expiry_sweep_interval', 60), now=False)
+        d.addErrback(log.err, "HashRedisResource expiry sweeper died")
+        yield self.setup_stats()
+
+    def teardown(self):
+        if self._sweeper.running:
+            self._sweeper.stop()
+        self.teardown_stats()
+        return self.close_shards()
+
+    def _script_keys(self, sandbox_id):
+        return [self.HASH_KEY % (sandbox_id,), self.EXPIRY_KEY % (sandbox_id,),
+                self.EXPIRING_KEY]
+
+    def _redis(self, api):
+        return self.shard_for(api.sandbox_id).redis
+
+    def _write_args(self, api, seconds):
+        now = self.clock.seconds()
+        return [self.keys_per_user_soft, self.keys_per_user_hard, now,
+                api.sandbox_id, now + seconds if seconds is not None else '']
+
+    @inlineCallbacks
+    def sweep_expired(self):
+        """
+        Remove expired keys from the hashes of all sandboxes with expiring
+        keys on every shard. Returns the number of keys removed.
+        """
+        removed = 0
+        for _name, shard in sorted(self.shards.iteritems()):
+            sandbox_ids = yield shard.redis.smembers(self.EXPIRING_KEY)
+            for sandbox_id in list(sandbox_ids):
+                removed += yield HASH_SWEEP_SCRIPT(
+                    shard.redis, self._script_keys(sandbox_id),
+                    [self.clock.seconds(), sandbox_id, self.sweep_limit])
+        returnValue(removed)
+
+    @inlineCallbacks
+    def _set_fields(self, api, items, seconds):
+        """
+        Write encoded values to several fields if the key limit allows it.
+        Returns whether the values were written.
+        """
+        args = self._write_args(api, seconds)
+        for field, raw_value in items:
+            args.extend([field, raw_value])
+        key_count = yield HASH_SET_SCRIPT(
+            self._redis(api), self._script_keys(api.sandbox_id), args)
+        returnValue(self._key_count_allowed(api, abs(key_count)))
+
+    def _get_fields(self, api, fields):
+        return HASH_GET_SCRIPT(
+            self._redis(api), self._script_keys(api.sandbox_id)[:2],
+            [self.clock.seconds()] + fields)
+
+    def _delete_fields(self, api, fields):
+        return HASH_DELETE_SCRIPT(
+            self._redis(api), self._script_keys(api.sandbox_id)[:2],
+            [self.clock.seconds()] + fields)
+
+    @inlineCallbacks
+    def handle_set(self, api, command):
+        """Set the value of a key. See :meth:`RedisResource.handle_set`."""
+        try:
+            key = self._key_arg(command)
+        except ValueError, e:
+            returnValue(self.reply_error(command, str(e)))
+        seconds = command.get('seconds')
+        if not (seconds is None or isinstance(seconds, (int, long))):
+            returnValue(self.reply_error(
+                command, "seconds must be a number or null"))
+        items = [(key, self._encode_command_value(command))]
+        if not (yield self._set_fields(api, items, seconds)):
+            returnValue(self._too_many_keys(command))
+        returnValue(self.reply(command, success=True))
+
+    @inlineCallbacks
+    def handle_get(self, api, command):
+        """
+        Retrieve the value of a key. See :meth:`RedisResource.handle_get`.
+        """
+        try:
+            key = self._key_arg(command)
+        except ValueError, e:
+            returnValue(self.reply_error(command, str(e)))
+        [raw_value] = yield self._get_fields(api, [key])
+        returnValue(self.reply(
+            command, success=True, value=self._reply_value(raw_value)))
+
+    @inlineCallbacks
+    def handle_delete(self, api, command):
+        """Delete a key. See :meth:`RedisResource.handle_delete`."""
+        try:
+            key = self._key_arg(command)
+        except ValueError, e:
+            returnValue(self.reply_error(command, str(e)))
+        [existed] = yield self._delete_fields(api, [key])
+        returnValue(self.reply(command, success=True, existed=bool(existed)))
+
+    @inlineCallbacks
+    def handle_incr(self, api, command):
+        """
+        Atomically increment the value of an integer key. See
+        :meth:`RedisResource.handle_incr`.
+        """
+        try:
+            key = self._key_arg(command)
+            amount = self._amount_arg(command)
+        except ValueError, e:
+            returnValue(self.reply_error(command, str(e)))
+        args = [self.keys_per_user_soft, self.keys_per_user_hard,
+                self.clock.seconds(), key, amount]
+        redis = self._redis(api)
+        try:
+            key_count, value = yield HASH_INCR_SCRIPT(
+                redis, self._script_keys(api.sandbox_id)[:2], args)
+        except redis.RESPONSE_ERROR, e:
+            returnValue(self.reply(command, success=False, reason=unicode(e)))
+        if not self._key_count_allowed(api, abs(key_count)):
+            returnValue(self._too_many_keys(command))
+        returnValue(self.reply(command, value=int(value), success=True))
+
+    @inlineCallbacks
+    def handle_mget(self, api, command):
+        """
+        Retrieve the values of several keys at once. See
+        :meth:`RedisResource.handle_mget`.
+        """
+        fields = command.get('keys')
+        if not self._valid_keys(fields):
+            returnValue(self.reply_error(
+                command, "keys must be a list of strings"))
+        raw_values = (yield self._get_fields(api, fields)) if fields else []
+        returnValue(self.reply(
+            command, success=True, values=self._reply_values(raw_values)))
+
+    @inlineCallbacks
+    def handle_mset(self, api, command):
+        """
+        Set the values of several keys at once. See
+        :meth:`RedisResource.handle_mset`.
+        """
+        items = command.get('items')
+        if not isinstance(items, dict):
+            returnValue(self.reply_error(command, "items must be an object"))
+        seconds = command.get('seconds')
+        if not (seconds is None or isinstance(seconds, (int, long))):
+            returnValue(self.reply_error(
+                command, "seconds must be a number or null"))
+        encoded_items = [(field, self._encode_value(value))
+                         for field, value in items.iteritems()]
+        if items and not (yield self._set_fields(
+                api, encoded_items, seconds)):
+            returnValue(self._too_many_keys(command))
+        returnValue(self.reply(command, success=True))
+
+    @inlineCallbacks
+    def handle_mdelete(self, api, command):
+        """
+        Delete several keys at once. See
+        :meth:`RedisResource.handle_mdelete`.
+        """
+        fields = command.get('keys')
+        if not self._valid_keys(fields):
+            returnValue(self.reply_error(
+                command, "keys must be a list of strings"))
+        deleted = (yield self._delete_fields(api, fields)) if fields else []
+        returnValue(self.reply(
+            command, success=True, existed=[bool(d) for d in deleted]))
+
+    @inlineCallbacks
+    def handle_scan(self, api, command):
+        """
+        Iterate over the sandbox's keys a page at a time. See
+        :meth:`RedisResource.handle_scan`.
+        """
+        try:
+            cursor, count, match = self._scan_args(command)
+        except ValueError, e:
+            returnValue(self.reply_error(command, str(e)))
+        next_cursor, keys = yield HASH_SCAN_SCRIPT(
+            self._redis(api), self._script_keys(api.sandbox_id)[:2],
+            [self.clock.seconds(), cursor or '0', match, count])
+        returnValue(self.reply(
+            command, success=True, keys=keys,
+            cursor=None if next_cursor == '0' else next_cursor))
@@ -0,0 +1,361 @@
+# -*- test-case-name: vxsandbox.resources.tests.test_sqlite_kv -*-
+
+"""An embedded SQLite key-value store resource for Vumi's sandbox."""
+
+from __future__ import absolute_import
+
+import sqlite3
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.internet.defer import inlineCallbacks
+
+from vumi import log
+
+from .kv import RedisResource
+
+
+class SqliteKvResource(RedisResource):
+    """
+    Resource that provides the same key-value store as
+    :class:`RedisResource`, kept in an SQLite database in the worker
+    process instead of in Redis.
+
+    This avoids a network round trip for every command on single-node
+    deployments and in tests. The database is accessed directly from the
+    reactor thread, so each command briefly blocks the worker. Expired
+    keys don't count towards the key limit.
+
+    Configuration options:
+
+    :param str database:
+        Path of the SQLite database file. The file is opened in
+        write-ahead logging mode, so several workers on the same host may
+        share it, but writes from different workers are serialised and
+        each one blocks its worker while it waits for the lock.
+        ``:memory:`` keeps the keys in memory, and they are lost when the
+        worker stops. (default: ``:memory:``).
+    :param float lock_timeout:
+        Number of seconds to wait for another worker to finish writing to
+        a shared database. The worker is blocked while it waits, so this
+        should be short. Commands that time out fail with the reason
+        ``database is locked``. (default: 0.1).
+    :param int keys_per_user_soft:
+        Maximum number of keys each user may make use of before usage
+        warnings are logged. (default: 80% of hard limit).
+    :param int keys_per_user_hard:
+        Maximum number of keys each user may make use of
+        (default: 100). Falls back to keys_per_user.
+    :param int keys_per_user:
+        Synonym for `keys_per_user_hard`. Deprecated.
+    :param int scan_max_count:
+        As for :class:`RedisResource`.
+    :param float expiry_sweep_interval:
+        Number of seconds between deletions of expired keys.
+        (default: 60).
+    :param int compress_threshold:
+        As for :class:`RedisResource`.
+    :param int compress_level:
+        As for :class:`RedisResource`.
+    :param bool raw_json_values:
+        As for :class:`RedisResource`.
+    :param str metrics_prefix:
+        If set, the bytes and time spent on compression are published as
+        metrics with this prefix. (default: no metrics).
+    :param int metrics_interval:
+        Number of seconds between metric publications. (default: 60).
+    """
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS kv ("
+        " sandbox_id TEXT NOT NULL,"
+        " key TEXT NOT NULL,"
+        " value BLOB NOT NULL,"
+        " expires REAL,"
+        " PRIMARY KEY (sandbox_id, key))",
+        "CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires)"
+        " WHERE expires IS NOT NULL",
+    ]
+
+    #: Keys looked up per query, to stay below SQLite's limit on the number
+    #: of query parameters.
+    QUERY_CHUNK_SIZE = 500
+
+    clock = reactor
+
+    @inlineCallbacks
+    def setup(self):
+        self._setup_key_limits()
+        self._setup_value_encoding()
+        self.db = sqlite3.connect(
+            self.config.get('database', ':memory:'), isolation_level=None,
+            timeout=self.config.get('lock_timeout', 0.1))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        self._sweeper = LoopingCall(self.sweep_expired)
+        self._sweeper.clock = self.clock
+        d = self._sweeper.start(
+            self.config.get('expiry_sweep_interval', 60), now=False)
+        d.addErrback(log.err, "SqliteKvResource expiry sweeper died")
+        yield self.setup_stats()
+
+    def teardown(self):
+        if self._sweeper.running:
+            self._sweeper.stop()
+        self.teardown_stats()
+        self.db.close()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Run a block of queries in a single transaction. The database is
+        locked for writing at the start of the transaction, so that other
+        workers can't write keys between the key count being checked and
+        new keys being written.
+        """
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        else:
+            self.db.execute("COMMIT")
+
+    def dispatch_request(self, api, command):
+        d = super(SqliteKvResource, self).dispatch_request(api, command)
+        d.addErrback(self._database_error, command)
+        return d
+
+    def _database_error(self, failure, command):
+        """
+        Reply with a failure if the database couldn't be used, usually
+        because another worker held the write lock for longer than
+        ``lock_timeout``.
+        """
+        failure.trap(sqlite3.OperationalError)
+        return self.reply_error(command, unicode(failure.value))
+
+    def sweep_expired(self):
+        """
+        Delete the expired keys of all sandboxes. Returns the number of
+        keys deleted. The sweep is skipped if another worker is writing to
+        the database.
+        """
+        try:
+            with self._transaction():
+                cursor = self.db.execute(
+                    "DELETE FROM kv WHERE expires <= ?",
+                    (self.clock.seconds(),))
+        except sqlite3.OperationalError, e:
+            log.warning("Skipping expiry sweep: %s" % (e,))
+            return 0
+        return cursor.rowcount
+
+    def _remove_expired(self, sandbox_id):
+        self.db.execute(
+            "DELETE FROM kv WHERE sandbox_id = ? AND expires <= ?",
+            (sandbox_id, self.clock.seconds()))
+
+    def _key_count(self, sandbox_id):
+        [(key_count,)] = self.db.execute(
+            "SELECT COUNT(*) FROM kv WHERE sandbox_id = ?", (sandbox_id,))
+        return key_count
+
+    def _get_rows(self, sandbox_id, keys):
+        """
+        Return a dictionary mapping the keys that exist and haven't expired
+        to their values and expiry times.
+        """
+        rows = {}
+        for i in range(0, len(keys), self.QUERY_CHUNK_SIZE):
+            chunk = keys[i:i + self.QUERY_CHUNK_SIZE]
+            for key, value, expires in self.db.execute(
+                    "SELECT key, value, expires FROM kv"
+                    " WHERE sandbox_id = ? AND key IN (%s)"
+                    " AND (expires IS NULL OR expires > ?)" % (
+                        ", ".join("?" * len(chunk)),),
+                    [sandbox_id] + chunk + [self.clock.seconds()]):
+                rows[key] = (str(value), expires)
+        return rows
+
+    def _get_raw_values(self, api, keys):
+        rows = self._get_rows(api.sandbox_id, keys)
+        return [rows[key][0] if key in rows else None for key in keys]
+
+    def _write_rows(self, api, rows):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO kv (sandbox_id, key, value, expires)"
+            " VALUES (?, ?, ?, ?)",
+            [(api.sandbox_id, key, sqlite3.Binary(raw_value), expires)
+             for key, raw_value, expires in rows])
+
+    def _new_keys_allowed(self, api, keys):
+        """
+        Return whether the key limit allows writing the given keys. Must be
+        called in a transaction, after expired keys have been removed.
+        """
+        new_keys = len(set(keys) - set(self._get_rows(api.sandbox_id, keys)))
+        if not new_keys:
+            return True
+        return self._key_count_allowed(
+            api, self._key_count(api.sandbox_id) + new_keys)
+
+    def _set_values(self, api, items, seconds):
+        """
+        Write several encoded values if the key limit allows it. Returns
+        whether the values were written.
+        """
+        expires = (self.clock.seconds() + seconds
+                   if seconds is not None else None)
+        rows = [(key, raw_value, expires) for key, raw_value in items]
+        with self._transaction():
+            self._remove_expired(api.sandbox_id)
+            if not self._new_keys_allowed(api, [key for key, _v in items]):
+                return False
+            self._write_rows(api, rows)
+        return True
+
+    def _delete_keys(self, api, keys):
+        with self._transaction():
+            self._remove_expired(api.sandbox_id)
+            return [
+                self.db.execute(
+                    "DELETE FROM kv WHERE sandbox_id = ? AND key = ?",
+                    (api.sandbox_id, key)).rowcount > 0
+                for key in keys]
+
+    def _seconds_arg(self, command):
+        seconds = command.get('seconds')
+        if not (seconds is None or isinstance(seconds, (int, long))):
+            raise ValueError("seconds must be a number or null")
+        return seconds
+
+    def handle_set(self, api, command):
+        """Set the value of a key. See :meth:`RedisResource.handle_set`."""
+        try:
+            key = self._key_arg(command)
+            seconds = self._seconds_arg(command)
+        except ValueError, e:
+            return self.reply_error(command, str(e))
+        items = [(key, self._encode_command_value(command))]
+        if not self._set_values(api, items, seconds):
+            return self._too_many_keys(command)
+        return self.reply(command, success=True)
+
+    def handle_get(self, api, command):
+        """
+        Retrieve the value of a key. See :meth:`RedisResource.handle_get`.
+        """
+        try:
+            key = self._key_arg(command)
+        except ValueError, e:
+            return self.reply_error(command, str(e))
+        [raw_value] = self._get_raw_values(api, [key])
+        return self.reply(
+            command, success=True, value=self._reply_value(raw_value))
+
+    def handle_delete(self, api, command):
+        """Delete a key. See :meth:`RedisResource.handle_delete`."""
+        try:
+            key = self._key_arg(command)
+        except ValueError, e:
+            return self.reply_error(command, str(e))
+        [existed] = self._delete_keys(api, [key])
+        return self.reply(command, success=True, existed=existed)
+
+    def handle_incr(self, api, command):
+        """
+        Atomically increment the value of an integer key. See
+        :meth:`RedisResource.handle_incr`.
+        """
+        try:
+            key = self._key_arg(command)
+            amount = self._amount_arg(command)
+        except ValueError, e:
+            return self.reply_error(command, str(e))
+        with self._transaction():
+            self._remove_expired(api.sandbox_id)
+            row = self._get_rows(api.sandbox_id, [key]).get(key)
+            if row is None:
+                if not self._new_keys_allowed(api, [key]):
+                    return self._too_many_keys(command)
+                value, expires = amount, None
+            else:
+                raw_value, expires = row
+                try:
+                    value = int(raw_value) + amount
+                except ValueError:
+                    return self.reply(
+                        command, success=False,
+                        reason=u"value is not an integer")
+            self._write_rows(api, [(key, str(value), expires)])
+        return self.reply(command, value=value, success=True)
+
+    def handle_mget(self, api, command):
+        """
+        Retrieve the values of several keys at once. See
+        :meth:`RedisResource.handle_mget`.
+        """
+        keys = command.get('keys')
+        if not self._valid_keys(keys):
+            return self.reply_error(command, "keys must be a list of strings")
+        raw_values = self._get_raw_values(api, keys)
+        return self.reply(
+            command, success=True, values=self._reply_values(raw_values))
+
+    def handle_mset(self, api, command):
+        """
+        Set the values of several keys at once. See
+        :meth:`RedisResource.handle_mset`.
+        """
+        items = command.get('items')
+        if not isinstance(items, dict):
+            return self.reply_error(command, "items must be an object")
+        try:
+            seconds = self._seconds_arg(command)
+        except ValueError, e:
+            return self.reply_error(command, str(e))
+        encoded_items = [(key, self._encode_value(value))
+                         for key, value in items.iteritems()]
+        if items and not self._set_values(api, encoded_items, seconds):
+            return self._too_many_keys(command)
+        return self.reply(command, success=True)
+
+    def handle_mdelete(self, api, command):
+        """
+        Delete several keys at once. See
+        :meth:`RedisResource.handle_mdelete`.
+        """
+        keys = command.get('keys')
+        if not self._valid_keys(keys):
+            return self.reply_error(command, "keys must be a list of strings")
+        return self.reply(
+            command, success=True, existed=self._delete_keys(api, keys))
+
+    def handle_scan(self, api, command):
+        """
+        Iterate over the sandbox's keys a page at a time. See
+        :meth:`RedisResource.handle_scan`. The cursor is the last key
+        examined by the previous page.
+        """
+        try:
+            cursor, count, match = self._scan_args(command)
+        except ValueError, e:
+            return self.reply_error(command, str(e))
+        query = ("SELECT key FROM kv WHERE sandbox_id = ?"
+                 " AND (expires IS NULL OR expires > ?)")
+        args = [api.sandbox_id, self.clock.seconds()]
+        if cursor is not None:
+            query += " AND key > ?"
+            args.append(cursor)
+        keys = [key for (key,) in self.db.execute(
+            query + " ORDER BY key LIMIT ?", args + [count])]
+        return self.reply(
+            command, success=True,
+            keys=[key for key in keys if fnmatchcase(key, match)],
+            cursor=keys[-1] if len(keys) == count else None)
@@ -1,29 +1,95 @@
 import base64
+import gzip
 import json
+import zlib
+from StringIO import StringIO
 
 from OpenSSL.SSL import (
     VERIFY_PEER, VERIFY_FAIL_IF_NO_PEER_CERT, VERIFY_NONE,
     SSLv3_METHOD, SSLv23_METHOD, TLSv1_METHOD)
 
 from twisted.web.http_headers import Headers
-from twisted.internet.defer import inlineCallbacks, fail, succeed
+from twisted.internet.defer import (
+    Deferred, CancelledError, inlineCallbacks, returnValue, fail, succeed,
+    gatherResults)
+from twisted.internet.error import ConnectionLost
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+from twisted.web.http import PotentialDataLoss
+
+from vumi.tests.helpers import VumiTestCase
+from vumi.utils import HttpDataLimitError
 
 from vxsandbox.resources.http import (
     HttpClientContextFactory, HttpClientPolicyForHTTPS, make_context_factory,
-    HttpClientResource)
+    HttpClientResource, MeteredConnectionPool, ResumingCreator, CreatorCache,
+    ContextClientCreator, LimitedBodyCollector, CachingHostnameResolver,
+    ResolverReactor, DecodingBodyCollector, ContentDecodingError,
+    CircuitBreaker, LatencyTracker, HedgedRequest)
+from vxsandbox.stats import StatsCollector
 from vxsandbox.resources.tests.utils import ResourceTestCaseBase
 
 
+def gzip_compress(data):
+    sio = StringIO()
+    gzip_file = gzip.GzipFile(fileobj=sio, mode='wb')
+    gzip_file.write(data)
+    gzip_file.close()
+    return sio.getvalue()
+
+
+class RecordingDecoder(object):
+    """
+    Wraps a zlib decompressor and counts the bytes it decompresses.
+    """
+
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self.decompressed = 0
+
+    @property
+    def unconsumed_tail(self):
+        return self.decoder.unconsumed_tail
+
+    def decompress(self, data, max_length=0):
+        decompressed = self.decoder.decompress(data, max_length)
+        self.decompressed += len(decompressed)
+        return decompressed
+
+    def flush(self):
+        return self.decoder.flush()
+
+
+class DummyBodyTransport(object):
+
+    producing = True
+
+    def stopProducing(self):
+        self.producing = False
+
+
 class DummyResponse(object):
 
     def __init__(self):
         self.headers = Headers({})
+        self.chunks = []
+        self.transport = DummyBodyTransport()
+
+    def deliverBody(self, protocol):
+        protocol.makeConnection(self.transport)
+        for chunk in self.chunks:
+            if not self.transport.producing:
+                return
+            protocol.dataReceived(chunk)
+        protocol.connectionLost(Failure(ResponseDone()))
 
 
 class DummyHTTPClient(object):
 
     def __init__(self):
         self._next_http_request_result = None
+        self._held = None
         self.http_requests = []
 
     def set_agent(self, agent):
@@ -61,14 +127,118 @@ class DummyHTTPClient(object):
         response.code = code
         for header, value in default_headers.items():
             response.headers.addRawHeader(header, value)
-        response.content = lambda: succeed(body)
+        response.chunks = [body]
         self._next_http_request_result = succeed(response)
+        return response
+
+    def hold_next(self, body, code=200, headers={}):
+        """
+        Make requests wait for the response until :meth:`release` is
+        called.
+        """
+        self._held_response = self.succeed_next(body, code, headers)
+        self._held = []
+
+    def release(self, error=None):
+        held, self._held = self._held, None
+        for d in held:
+            if error is not None:
+                d.errback(error)
+            else:
+                d.callback(self._held_response)
 
     def request(self, *args, **kw):
         self.http_requests.append((args, kw))
+        if self._held is not None:
+            d = Deferred()
+            self._held.append(d)
+            return d
         return self._next_http_request_result
 
 
+class DummyConnection(object):
+
+    state = "QUIESCENT"
+
+    def __init__(self):
+        self.transport = self
+
+    def loseConnection(self):
+        self.state = "DISCONNECTED"
+
+
+class DummyTLSConnection(object):
+
+    def __init__(self, session=None):
+        self.session = session
+        self.offered_session = None
+
+    def get_session(self):
+        return self.session
+
+    def set_session(self, session):
+        self.offered_session = session
+
+
+class DummyCreator(object):
+
+    def __init__(self, connections):
+        self.connections = list(connections)
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = self.connections.pop(0)
+        connection.protocol = tlsProtocol
+        return connection
+
+
+class DummyResolver(object):
+    """
+    Resolver that answers lookups when :meth:`answer` is called.
+    """
+
+    def __init__(self):
+        self.lookups = []
+
+    def resolveHostName(self, resolutionReceiver, hostName, portNumber=0,
+                        addressTypes=None, transportSemantics='TCP'):
+        resolutionReceiver.resolutionBegan(None)
+        self.lookups.append((hostName, resolutionReceiver))
+
+    def answer(self, *addresses):
+        _hostName, receiver = self.lookups[-1]
+        for address in addresses:
+            receiver.addressResolved(address)
+        receiver.resolutionComplete()
+
+
+class DummyResolutionReceiver(object):
+
+    def __init__(self):
+        self.resolution = None
+        self.addresses = None
+
+    def resolutionBegan(self, resolution):
+        self.resolution = resolution
+        self.addresses = []
+
+    def addressResolved(self, address):
+        self.addresses.append(address)
+
+    def resolutionComplete(self):
+        self.complete = True
+
+
+class DummyEndpoint(object):
+
+    def __init__(self):
+        self.connections = []
+
+    def connect(self, factory):
+        connection = DummyConnection()
+        self.connections.append(connection)
+        return succeed(connection)
+
+
 class TestHttpClientResource(ResourceTestCaseBase):
 
     resource_cls = HttpClientResource
@@ -91,7 +261,13 @@ class TestHttpClientResource(ResourceTestCaseBase):
         self.dummy_client.fail_next(error)
 
     def http_request_succeed(self, body, code=200, headers={}):
-        self.dummy_client.succeed_next(body, code, headers)
+        return self.dummy_client.succeed_next(body, code, headers)
+
+    def http_request_stream(self, chunks):
+        response = self.http_request_succeed('')
+        response.headers.removeHeader('Content-Length')
+        response.chunks = chunks
+        return response
 
     def assert_not_unicode(self, arg):
         self.assertFalse(isinstance(arg, unicode))
@@ -110,6 +286,8 @@ class TestHttpClientResource(ResourceTestCaseBase):
             # one) or a ClientTLSOptions object (which means we have to grab
             # the context from a private attribute).
             creator = context_factory.creatorForNetloc('example.com', 80)
+            if isinstance(creator, ResumingCreator):
+                creator = creator.creator
             if hasattr(creator, 'getContext'):
                 return creator.getContext()
             else:
@@ -125,7 +303,7 @@ class TestHttpClientResource(ResourceTestCaseBase):
                    else self.resource.timeout)
         args = (method, url,)
         kw = dict(headers=headers, data=data,
-                  timeout=timeout, files=files)
+                  timeout=timeout, files=files, unbuffered=True)
         [(actual_args, actual_kw)] = self.dummy_client.http_requests
 
         # NOTE: Files are handed over to treq as file pointer-ish things
@@ -215,6 +393,50 @@ class TestHttpClientResource(ResourceTestCaseBase):
         else:
             self.assertIsInstance(context_factory, HttpClientPolicyForHTTPS)
 
+    def test_context_factory_reuses_context(self):
+        context_factory = make_context_factory(verify_options=VERIFY_NONE)
+        context = context_factory.getContext('example.com', 443)
+        self.assertIdentical(
+            context_factory.getContext('example.org', 443), context)
+        creator = context_factory.creatorForNetloc('example.com', 443)
+        self.assertIsInstance(creator.creator, ContextClientCreator)
+        self.assertIdentical(creator.creator.getContext(), context)
+
+    def test_creators_cached_by_host(self):
+        self.assertIsInstance(make_context_factory(), HttpClientPolicyForHTTPS)
+        for verify_options in [None, VERIFY_NONE]:
+            context_factory = make_context_factory(
+                verify_options=verify_options)
+            creator = context_factory.creatorForNetloc('example.com', 443)
+            self.assertIdentical(
+                context_factory.creatorForNetloc('example.com', 443),
+                creator)
+            self.assertNotIdentical(
+                context_factory.creatorForNetloc('example.org', 443),
+                creator)
+            self.assertNotIdentical(
+                context_factory.creatorForNetloc('example.com', 8443),
+                creator)
+
+    @inlineCallbacks
+    def test_context_factories_shared_between_requests(self):
+        self.http_request_succeed("foo")
+        yield self.dispatch_command('get', url='https://www.example.com')
+        context_factory = self.get_context_factory()
+        self.http_request_succeed("foo")
+        yield self.dispatch_command('get', url='https://www.example.org')
+        self.assertIdentical(self.get_context_factory(), context_factory)
+        self.http_request_succeed("foo")
+        yield self.dispatch_command(
+            'get', url='https://www.example.com',
+            verify_options=['VERIFY_NONE'])
+        self.assertNotIdentical(self.get_context_factory(), context_factory)
+        self.http_request_succeed("foo")
+        yield self.dispatch_command(
+            'get', url='https://www.example.com', ssl_method='TLSv1')
+        self.assertEqual(sorted(self.resource.context_factories.keys()), [
+            (None, None), (None, TLSv1_METHOD), (VERIFY_NONE, None)])
+
     @inlineCallbacks
     def test_handle_get(self):
         self.http_request_succeed("foo")
@@ -390,6 +612,36 @@ class TestHttpClientResource(ResourceTestCaseBase):
                 self.resource.DEFAULT_DATA_LIMIT + 1,
                 self.resource.DEFAULT_DATA_LIMIT,))
 
+    @inlineCallbacks
+    def test_data_limit_exceeded_stops_transfer(self):
+        response = self.http_request_succeed('1' * 10)
+        yield self.create_resource({'data_limit': 5})
+        reply = yield self.dispatch_command(
+            'get', url='https://www.example.com',)
+        self.assertFalse(reply['success'])
+        self.assertEqual(
+            reply['reason'], 'Received 10 bytes, maximum of 5 bytes allowed.')
+        self.assertFalse(response.transport.producing)
+
+    @inlineCallbacks
+    def test_streamed_body(self):
+        self.http_request_stream(['foo', 'bar', 'baz'])
+        reply = yield self.dispatch_command(
+            'get', url='https://www.example.com',)
+        self.assertTrue(reply['success'])
+        self.assertEqual(reply['body'], 'foobarbaz')
+
+    @inlineCallbacks
+    def test_streamed_body_exceeds_data_limit(self):
+        response = self.http_request_stream(['1' * 4, '1' * 4, '1' * 4, '1'])
+        yield self.create_resource({'data_limit': 10})
+        reply = yield self.dispatch_command(
+            'get', url='https://www.example.com',)
+        self.assertFalse(reply['success'])
+        self.assertEqual(
+            reply['reason'], 'Received 12 bytes, maximum of 10 bytes allowed.')
+        self.assertFalse(response.transport.producing)
+
     @inlineCallbacks
     def test_https_request_method_default(self):
         self.http_request_succeed("foo")
@@ -437,3 +689,1368 @@ class TestHttpClientResource(ResourceTestCaseBase):
 
         context_factory = self.get_context_factory()
         self.assertEqual(context_factory.ssl_method, TLSv1_METHOD)
+
+    @inlineCallbacks
+    def create_cache_resource(self, **config):
+        self.clock = Clock()
+        self.patch(HttpClientResource, 'clock', self.clock)
+        config.setdefault('cache_max_bytes', 1024)
+        config.setdefault('metrics_prefix', 'http')
+        yield self.create_resource(config)
+
+    def cache_stats(self):
+        return dict((name, value)
+                    for name, _agg, value in self.resource.stats.collect()
+                    if name.startswith('cache.'))
+
+    @inlineCallbacks
+    def cached_get(self, body, url='http://www.example.com/', code=200,
+                   headers={}, request_headers=None):
+        """
+        Make a GET request that receives the given response if it is sent
+        to the server. Returns the reply and the headers of the request
+        sent to the server, or ``None`` if the cache answered it.
+        """
+        requests = len(self.dummy_client.http_requests)
+        self.http_request_succeed(body, code=code, headers=headers)
+        kw = {}
+        if request_headers is not None:
+            kw['headers'] = request_headers
+        reply = yield self.dispatch_command('get', url=url, **kw)
+        self.assertTrue(reply['success'])
+        if len(self.dummy_client.http_requests) == requests:
+            returnValue((reply, None))
+        [(_args, request_kw)] = self.dummy_client.http_requests[requests:]
+        returnValue((reply, request_kw['headers'] or {}))
+
+    @inlineCallbacks
+    def test_cache_disabled_by_default(self):
+        headers = {'Cache-Control': 'max-age=60'}
+        _, sent = yield self.cached_get("foo", headers=headers)
+        _, sent = yield self.cached_get("foo", headers=headers)
+        self.assertNotEqual(sent, None)
+        self.assertEqual(self.resource.cache, None)
+
+    @inlineCallbacks
+    def test_cache_max_age(self):
+        yield self.create_cache_resource()
+        headers = {'Cache-Control': 'public, max-age=60'}
+        reply, sent = yield self.cached_get("foo", headers=headers)
+        self.assertEqual(sent, {})
+        self.check_reply(reply, body="foo", code=200)
+        reply, sent = yield self.cached_get("bar", headers=headers)
+        self.assertEqual(sent, None)
+        self.check_reply(reply, body="foo", code=200)
+        self.clock.advance(60)
+        reply, sent = yield self.cached_get("bar", headers=headers)
+        self.assertEqual(sent, {})
+        self.check_reply(reply, body="bar")
+        self.assertEqual(self.cache_stats(), {
+            'cache.hits': 1, 'cache.misses': 2})
+
+    @inlineCallbacks
+    def test_cache_age_reduces_lifetime(self):
+        yield self.create_cache_resource()
+        yield self.cached_get("foo", headers={
+            'Cache-Control': 'max-age=60', 'Age': '50'})
+        self.clock.advance(9)
+        _, sent = yield self.cached_get("bar")
+        self.assertEqual(sent, None)
+        self.clock.advance(1)
+        _, sent = yield self.cached_get("bar")
+        self.assertEqual(sent, {})
+
+    @inlineCallbacks
+    def test_cache_expires(self):
+        yield self.create_cache_resource()
+        yield self.cached_get("foo", headers={
+            'Date': 'Sun, 06 Nov 1994 08:49:37 GMT',
+            'Expires': 'Sun, 06 Nov 1994 08:50:07 GMT'})
+        self.clock.advance(29)
+        _, sent = yield self.cached_get("bar")
+        self.assertEqual(sent, None)
+        self.clock.advance(1)
+        reply, sent = yield self.cached_get("bar")
+        self.assertEqual(sent, {})
+        self.check_reply(reply, body="bar")
+
+    @inlineCallbacks
+    def test_cache_invalid_expires(self):
+        yield self.create_cache_resource()
+        yield self.cached_get("foo", headers={'Expires': '0'})
+        _, sent = yield self.cached_get("bar")
+        self.assertEqual(sent, {})
+
+    @inlineCallbacks
+    def test_cache_not_stored(self):
+        yield self.create_cache_resource()
+        for headers in [{}, {'Cache-Control': 'no-store, max-age=60'}]:
+            yield self.cached_get("foo", headers=headers)
+            reply, sent = yield self.cached_get("bar", headers=headers)
+            self.assertEqual(sent, {})
+            self.check_reply(reply, body="bar")
+        yield self.cached_get(
+            "foo", code=404, headers={'Cache-Control': 'max-age=60'})
+        reply, sent = yield self.cached_get("bar")
+        self.assertEqual(sent, {})
+        self.assertEqual(len(self.resource.cache), 0)
+
+    @inlineCallbacks
+    def test_cache_only_gets(self):
+        yield self.create_cache_resource()
+        self.http_request_succeed("foo", headers={
+            'Cache-Control': 'max-age=60'})
+        yield self.dispatch_command('post', url='http://www.example.com/')
+        _, sent = yield self.cached_get("bar")
+        self.assertEqual(sent, {})
+
+    @inlineCallbacks
+    def test_cache_bypassed_by_request_headers(self):
+        yield self.create_cache_resource()
+        yield self.cached_get("foo", headers={'Cache-Control': 'max-age=60'})
+        for name in ['Cache-Control', 'Pragma', 'If-None-Match', 'Range']:
+            _, sent = yield self.cached_get(
+                "bar", headers={'Cache-Control': 'max-age=60'},
+                request_headers={name: [u'x']})
+            self.assertEqual(sent, {name: ['x']})
+
+    @inlineCallbacks
+    def test_cache_keyed_by_request_headers(self):
+        yield self.create_cache_resource()
+        yield self.cached_get("foo", headers={'Cache-Control': 'max-age=60'})
+        reply, sent = yield self.cached_get(
+            "bar", headers={'Cache-Control': 'max-age=60'},
+            request_headers={'Accept': [u'text/plain']})
+        self.assertEqual(sent, {'Accept': ['text/plain']})
+        self.check_reply(reply, body="bar")
+
+    @inlineCallbacks
+    def test_cache_revalidate_etag(self):
+        yield self.create_cache_resource()
+        yield self.cached_get("foo", headers={
+            'Cache-Control': 'no-cache', 'ETag': '"v1"'})
+        reply, sent = yield self.cached_get(
+            "", code=304, headers={'Cache-Control': 'max-age=60'})
+        self.assertEqual(sent, {'If-None-Match': ['"v1"']})
+        self.check_reply(reply, body="foo", code=200)
+        reply, sent = yield self.cached_get("bar")
+        self.assertEqual(sent, None)
+        self.check_reply(reply, body="foo")
+        self.assertEqual(self.cache_stats(), {
+            'cache.hits': 1, 'cache.misses': 2, 'cache.revalidated': 1})
+
+    @inlineCallbacks
+    def test_cache_revalidate_last_modified(self):
+        yield self.create_cache_resource()
+        last_modified = 'Sun, 06 Nov 1994 08:49:37 GMT'
+        yield self.cached_get(
+            "foo", headers={'Last-Modified': last_modified})
+        reply, sent = yield self.cached_get(
+            "bar", headers={'Last-Modified': 'Mon, 07 Nov 1994 08:49:37 GMT'})
+        self.assertEqual(sent, {'If-Modified-Since': [last_modified]})
+        self.check_reply(reply, body="bar")
+        _, sent = yield self.cached_get("baz")
+        self.assertEqual(
+            sent, {'If-Modified-Since': ['Mon, 07 Nov 1994 08:49:37 GMT']})
+
+    @inlineCallbacks
+    def test_cache_per_sandbox(self):
+        yield self.create_cache_resource()
+        yield self.cached_get("foo", headers={'Cache-Control': 'max-age=60'})
+        self.api = self.app_worker.create_sandbox_api()
+        self.app_worker.create_sandbox_protocol('other_id', self.api)
+        reply, sent = yield self.cached_get("bar")
+        self.assertEqual(sent, {})
+        self.check_reply(reply, body="bar")
+
+    @inlineCallbacks
+    def test_cache_shared(self):
+        yield self.create_cache_resource(cache_shared=True)
+        yield self.cached_get("foo", headers={'Cache-Control': 'max-age=60'})
+        self.api = self.app_worker.create_sandbox_api()
+        self.app_worker.create_sandbox_protocol('other_id', self.api)
+        reply, sent = yield self.cached_get("bar")
+        self.assertEqual(sent, None)
+        self.check_reply(reply, body="foo")
+
+    @inlineCallbacks
+    def test_cache_shared_not_private(self):
+        yield self.create_cache_resource(cache_shared=True)
+        yield self.cached_get("foo", headers={
+            'Cache-Control': 'private, max-age=60'})
+        _, sent = yield self.cached_get("bar")
+        self.assertEqual(sent, {})
+        auth = {'Authorization': [u'Basic Zm9vOmJhcg==']}
+        yield self.cached_get(
+            "foo", headers={'Cache-Control': 'max-age=60'},
+            request_headers=auth)
+        _, sent = yield self.cached_get("bar", request_headers=auth)
+        self.assertEqual(sent, {'Authorization': ['Basic Zm9vOmJhcg==']})
+
+    @inlineCallbacks
+    def test_cache_shared_s_maxage(self):
+        yield self.create_cache_resource(cache_shared=True)
+        yield self.cached_get("foo", headers={
+            'Cache-Control': 'max-age=600, s-maxage=10'})
+        self.clock.advance(10)
+        _, sent = yield self.cached_get("bar")
+        self.assertEqual(sent, {})
+
+    @inlineCallbacks
+    def test_cache_evicts_least_recently_used(self):
+        yield self.create_cache_resource(cache_max_bytes=100)
+        headers = {'Cache-Control': 'max-age=60'}
+        yield self.cached_get("a" * 40, url='http://a/', headers=headers)
+        yield self.cached_get("b" * 40, url='http://b/', headers=headers)
+        self.assertEqual(len(self.resource.cache), 1)
+        _, sent = yield self.cached_get("a", url='http://a/')
+        self.assertEqual(sent, {})
+        self.assertEqual(self.cache_stats()['cache.evictions'], 1)
+
+    def use_sandbox(self, sandbox_id):
+        self.api = self.app_worker.create_sandbox_api()
+        self.app_worker.create_sandbox_protocol(sandbox_id, self.api)
+
+    @inlineCallbacks
+    def test_coalesce_gets_disabled_by_default(self):
+        self.dummy_client.hold_next("foo")
+        d1 = self.dispatch_command('get', url='http://www.example.com/')
+        d2 = self.dispatch_command('get', url='http://www.example.com/')
+        self.dummy_client.release()
+        for reply in (yield gatherResults([d1, d2])):
+            self.check_reply(reply, body="foo")
+        self.assertEqual(len(self.dummy_client.http_requests), 2)
+
+    @inlineCallbacks
+    def test_coalesce_gets(self):
+        yield self.create_resource({
+            'coalesce_gets': True, 'metrics_prefix': 'http'})
+        self.dummy_client.hold_next("foo")
+        d1 = self.dispatch_command('get', url='http://www.example.com/')
+        self.use_sandbox('other_id')
+        d2 = self.dispatch_command('get', url='http://www.example.com/')
+        self.assertEqual(len(self.dummy_client.http_requests), 1)
+        self.dummy_client.release()
+        for reply in (yield gatherResults([d1, d2])):
+            self.check_reply(reply, body="foo", code=200)
+        self.assertEqual(len(self.dummy_client.http_requests), 1)
+        self.assertEqual(
+            dict((name, value)
+                 for name, _agg, value in self.resource.stats.collect()),
+            {'requests.coalesced': 1})
+
+        self.http_request_succeed("bar")
+        reply = yield self.dispatch_command(
+            'get', url='http://www.example.com/')
+        self.check_reply(reply, body="bar")
+        self.assertEqual(len(self.dummy_client.http_requests), 2)
+
+    @inlineCallbacks
+    def test_coalesce_gets_failure(self):
+        yield self.create_resource({'coalesce_gets': True})
+        self.dummy_client.hold_next("foo")
+        d1 = self.dispatch_command('get', url='http://www.example.com/')
+        d2 = self.dispatch_command('get', url='http://www.example.com/')
+        self.dummy_client.release(Exception("Connection refused"))
+        for reply in (yield gatherResults([d1, d2])):
+            self.check_reply(
+                reply, success=False, reason="Connection refused")
+        self.assertEqual(len(self.dummy_client.http_requests), 1)
+
+    @inlineCallbacks
+    def test_coalesce_gets_cached_separately(self):
+        yield self.create_cache_resource(coalesce_gets=True)
+        url = 'http://www.example.com/'
+        self.dummy_client.hold_next("foo", headers={
+            'Cache-Control': 'no-cache', 'ETag': '"v1"'})
+        d1 = self.dispatch_command('get', url=url)
+        api1 = self.api
+        self.use_sandbox('other_id')
+        d2 = self.dispatch_command('get', url=url)
+        self.dummy_client.release()
+        yield gatherResults([d1, d2])
+        self.assertEqual(len(self.dummy_client.http_requests), 1)
+        [cached1, cached2] = [
+            self.resource.cache.get(
+                self.resource._cache_key(api, 'GET', url, None, None, None))
+            for api in (api1, self.api)]
+        self.assertNotIdentical(cached1, cached2)
+
+        _, sent = yield self.cached_get("", code=304, headers={'ETag': '"v2"'})
+        self.assertEqual(sent, {'If-None-Match': ['"v1"']})
+        self.assertEqual(cached2.headers.getRawHeaders('ETag'), ['"v1"'])
+        self.assertEqual(cached1.headers.getRawHeaders('ETag'), ['"v1"'])
+        _, sent = yield self.cached_get("", code=304)
+        self.assertEqual(sent, {'If-None-Match': ['"v2"']})
+
+    @inlineCallbacks
+    def test_coalesce_gets_only_identical_requests(self):
+        yield self.create_resource({'coalesce_gets': True})
+        self.dummy_client.hold_next("foo")
+        url = 'http://www.example.com/'
+        ds = [
+            self.dispatch_command('get', url=url),
+            self.dispatch_command('get', url=url + 'other'),
+            self.dispatch_command(
+                'get', url=url, headers={'Accept': [u'text/plain']}),
+            self.dispatch_command(
+                'get', url=url, verify_options=['VERIFY_NONE']),
+            self.dispatch_command('get', url=url, ssl_method='TLSv1'),
+            self.dispatch_command('post', url=url),
+            self.dispatch_command('get', url=url, coalesce=False),
+        ]
+        self.assertEqual(len(self.dummy_client.http_requests), 7)
+        self.dummy_client.release()
+        for reply in (yield gatherResults(ds)):
+            self.check_reply(reply, body="foo")
+
+    @inlineCallbacks
+    def test_max_requests_per_host(self):
+        self.clock = Clock()
+        self.patch(HttpClientResource, 'clock', self.clock)
+        yield self.create_resource({
+            'max_requests_per_host': 1, 'max_queued_per_host': 1,
+            'metrics_prefix': 'http'})
+        self.dummy_client.hold_next("foo")
+        d1 = self.dispatch_command('get', url='http://www.example.com/a')
+        d2 = self.dispatch_command('get', url='http://www.example.com/b')
+        self.assertEqual(len(self.dummy_client.http_requests), 1)
+        reply = yield self.dispatch_command(
+            'get', url='http://www.example.com/c')
+        self.check_reply(
+            reply, success=False,
+            reason="Too many requests queued for www.example.com")
+        self.clock.advance(0.5)
+        self.dummy_client.release()
+        for reply in (yield gatherResults([d1, d2])):
+            self.check_reply(reply, body="foo")
+        self.assertEqual(
+            [args[1] for args, _kw in self.dummy_client.http_requests],
+            ['http://www.example.com/a', 'http://www.example.com/b'])
+        self.assertEqual(self.resource._host_semaphores, {})
+        stats = dict((name, value)
+                     for name, _agg, value in self.resource.stats.collect())
+        self.assertEqual(stats['queue.rejected'], 1)
+        self.assertEqual(stats['queue.wait_time.count'], 2)
+        self.assertEqual(stats['queue.wait_time.max'], 500)
+
+    @inlineCallbacks
+    def test_max_requests_per_host_queue_timeout(self):
+        self.clock = Clock()
+        self.patch(HttpClientResource, 'clock', self.clock)
+        yield self.create_resource({
+            'max_requests_per_host': 1, 'queue_timeout': 5,
+            'metrics_prefix': 'http'})
+        self.dummy_client.hold_next("foo")
+        d1 = self.dispatch_command('get', url='http://www.example.com/a')
+        d2 = self.dispatch_command('get', url='http://www.example.com/b')
+        self.clock.advance(4)
+        d3 = self.dispatch_command('get', url='http://www.example.com/c')
+        self.clock.advance(1)
+        self.check_reply(
+            (yield d2), success=False,
+            reason="Timed out waiting in the queue for www.example.com")
+        self.dummy_client.release()
+        self.check_reply((yield d1), body="foo")
+        self.check_reply((yield d3), body="foo")
+        self.assertEqual(len(self.dummy_client.http_requests), 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.resource._host_semaphores, {})
+        self.assertEqual(
+            self.resource_stats('queue.timeouts'), {'queue.timeouts': 1})
+
+    @inlineCallbacks
+    def test_max_requests_per_host_limits_each_host(self):
+        yield self.create_resource({
+            'max_requests_per_host': 1, 'max_queued_per_host': 0})
+        self.dummy_client.hold_next("foo")
+        ds = [
+            self.dispatch_command('get', url='http://www.example.com/'),
+            self.dispatch_command('get', url='https://www.example.com/'),
+            self.dispatch_command('get', url='http://www.example.com:81/'),
+            self.dispatch_command('get', url='http://www.example.org/'),
+        ]
+        self.assertEqual(len(self.dummy_client.http_requests), 4)
+        self.dummy_client.release()
+        for reply in (yield gatherResults(ds)):
+            self.check_reply(reply, body="foo")
+
+    @inlineCallbacks
+    def test_max_requests_per_host_released_on_failure(self):
+        yield self.create_resource({'max_requests_per_host': 1})
+        self.http_request_fail(ValueError("HTTP Error"))
+        reply = yield self.dispatch_command(
+            'get', url='http://www.example.com/')
+        self.check_reply(reply, success=False, reason="HTTP Error")
+        self.assertEqual(self.resource._host_semaphores, {})
+
+    @inlineCallbacks
+    def test_max_requests_per_host_cancel_queued(self):
+        yield self.create_resource({'max_requests_per_host': 1})
+        url = 'http://www.example.com/'
+        started, responses = [], {}
+
+        def make_request(name):
+            started.append(name)
+            d = responses[name] = Deferred()
+            return d
+
+        d1 = self.resource._limit_host(url, lambda: make_request(1))
+        d2 = self.resource._limit_host(url, lambda: make_request(2))
+        d3 = self.resource._limit_host(url, lambda: make_request(3))
+        d2.cancel()
+        self.failureResultOf(d2, CancelledError)
+        self.assertEqual(started, [1])
+        responses[1].callback("foo")
+        self.assertEqual(self.successResultOf(d1), "foo")
+        self.assertEqual(started, [1, 3])
+        d4 = self.resource._limit_host(url, lambda: make_request(4))
+        self.assertEqual(started, [1, 3])
+        responses[3].callback("bar")
+        self.assertEqual(started, [1, 3, 4])
+        responses[4].callback("baz")
+        self.assertEqual(
+            [self.successResultOf(d) for d in (d3, d4)], ["bar", "baz"])
+        self.assertEqual(self.resource._host_semaphores, {})
+
+    @inlineCallbacks
+    def test_batch(self):
+        self.clock = Clock()
+        self.patch(HttpClientResource, 'clock', self.clock)
+        self.dummy_client.hold_next("foo")
+        d = self.dispatch_command('batch', requests=[
+            {'url': 'http://www.example.com/a'},
+            {'method': 'post', 'url': 'http://www.example.com/b',
+             'data': u'bar'},
+        ])
+        self.assertEqual(
+            [args for args, _kw in self.dummy_client.http_requests],
+            [('GET', 'http://www.example.com/a'),
+             ('POST', 'http://www.example.com/b')])
+        self.assertEqual(self.dummy_client.http_requests[1][1]['data'], 'bar')
+        self.assertNoResult(d)
+        self.clock.advance(0.25)
+        self.dummy_client.release()
+        reply = yield d
+        self.check_reply(reply, results=[
+            {'success': True, 'body': "foo", 'code': 200, 'time_ms': 250},
+            {'success': True, 'body': "foo", 'code': 200, 'time_ms': 250},
+        ])
+
+    @inlineCallbacks
+    def test_batch_failures(self):
+        self.patch(HttpClientResource, 'clock', Clock())
+        self.http_request_fail(Exception("Connection refused"))
+        reply = yield self.dispatch_command('batch', requests=[
+            {'url': 'http://www.example.com/'},
+            {},
+            {'method': 'TRACE', 'url': 'http://www.example.com/'},
+            'http://www.example.com/',
+        ])
+        self.check_reply(reply, results=[
+            {'success': False, 'reason': "Connection refused",
+             'time_ms': 0},
+            {'success': False, 'reason': "No URL given", 'time_ms': 0},
+            {'success': False, 'reason': "Unsupported method: TRACE",
+             'time_ms': 0},
+            {'success': False, 'reason': "Request must be an object",
+             'time_ms': 0},
+        ])
+        self.assertEqual(len(self.dummy_client.http_requests), 1)
+
+    @inlineCallbacks
+    def test_batch_empty(self):
+        reply = yield self.dispatch_command('batch', requests=[])
+        self.check_reply(reply, results=[])
+
+    @inlineCallbacks
+    def test_batch_invalid(self):
+        reply = yield self.dispatch_command('batch')
+        self.check_reply(
+            reply, success=False, reason="requests must be a list")
+
+    @inlineCallbacks
+    def test_batch_too_large(self):
+        yield self.create_resource({'max_batch_size': 1})
+        reply = yield self.dispatch_command('batch', requests=[
+            {'url': 'http://www.example.com/a'},
+            {'url': 'http://www.example.com/b'},
+        ])
+        self.check_reply(
+            reply, success=False,
+            reason="Too many requests in batch (maximum 1)")
+        self.assertEqual(self.dummy_client.http_requests, [])
+
+    @inlineCallbacks
+    def test_batch_uses_cache(self):
+        yield self.create_cache_resource()
+        headers = {'Cache-Control': 'max-age=60'}
+        yield self.cached_get("foo", headers=headers)
+        reply = yield self.dispatch_command('batch', requests=[
+            {'url': 'http://www.example.com/'},
+        ])
+        self.check_reply(reply, results=[
+            {'success': True, 'body': "foo", 'code': 200, 'time_ms': 0}])
+        self.assertEqual(len(self.dummy_client.http_requests), 1)
+
+    @inlineCallbacks
+    def test_decompress_responses_disabled_by_default(self):
+        body = gzip_compress("foo")
+        self.http_request_succeed(body, headers={'Content-Encoding': 'gzip'})
+        reply = yield self.dispatch_command(
+            'get', url='http://www.example.com/')
+        self.check_reply(reply, body=body)
+        self.assert_http_request('http://www.example.com/')
+
+    @inlineCallbacks
+    def test_decompress_gzip(self):
+        yield self.create_resource({'decompress_responses': True})
+        self.http_request_succeed(
+            gzip_compress("foo"), headers={'Content-Encoding': 'gzip'})
+        reply = yield self.dispatch_command(
+            'get', url='http://www.example.com/')
+        self.check_reply(reply, body="foo", code=200)
+        self.assert_http_request(
+            'http://www.example.com/',
+            headers={'Accept-Encoding': ['gzip, deflate']})
+
+    @inlineCallbacks
+    def test_decompress_deflate(self):
+        yield self.create_resource({'decompress_responses': True})
+        self.http_request_succeed(
+            zlib.compress("foo"), headers={'Content-Encoding': 'deflate'})
+        reply = yield self.dispatch_command(
+            'get', url='http://www.example.com/')
+        self.check_reply(reply, body="foo")
+
+    @inlineCallbacks
+    def test_decompress_uncompressed_response(self):
+        yield self.create_resource({'decompress_responses': True})
+        self.http_request_succeed("foo")
+        reply = yield self.dispatch_command(
+            'get', url='http://www.example.com/')
+        self.check_reply(reply, body="foo")
+
+    @inlineCallbacks
+    def test_decompress_own_accept_encoding(self):
+        yield self.create_resource({'decompress_responses': True})
+        self.http_request_succeed("foo")
+        yield self.dispatch_command(
+            'get', url='http://www.example.com/',
+            headers={'accept-encoding': [u'identity']})
+        self.assert_http_request(
+            'http://www.example.com/',
+            headers={'accept-encoding': ['identity']})
+
+    @inlineCallbacks
+    def test_decompress_data_limit(self):
+        yield self.create_resource({
+            'decompress_responses': True, 'data_limit': 1024})
+        body = gzip_compress("x" * 1025)
+        self.assertTrue(len(body) < 1024)
+        self.http_request_succeed(body, headers={'Content-Encoding': 'gzip'})
+        reply = yield self.dispatch_command(
+            'get', url='http://www.example.com/')
+        self.check_reply(
+            reply, success=False,
+            reason="Received 1025 bytes, maximum of 1024 bytes allowed.")
+
+    @inlineCallbacks
+    def test_decompress_invalid_body(self):
+        yield self.create_resource({'decompress_responses': True})
+        self.http_request_succeed(
+            "not gzip", headers={'Content-Encoding': 'gzip'})
+        reply = yield self.dispatch_command(
+            'get', url='http://www.example.com/')
+        self.assertFalse(reply['success'])
+        self.assertTrue(reply['reason'].startswith(
+            "Error decompressing response body:"))
+
+    @inlineCallbacks
+    def create_breaker_resource(self, **config):
+        self.clock = Clock()
+        self.patch(HttpClientResource, 'clock', self.clock)
+        config.setdefault('circuit_breaker_failures', 2)
+        config.setdefault('circuit_breaker_reset_timeout', 10)
+        config.setdefault('metrics_prefix', 'http')
+        yield self.create_resource(config)
+
+    def resource_stats(self, *prefixes):
+        return dict((name, value)
+                    for name, _agg, value in self.resource.stats.collect()
+                    if name.startswith(prefixes))
+
+    @inlineCallbacks
+    def test_circuit_breaker(self):
+        yield self.create_breaker_resource()
+        url = 'http://www.example.com/'
+        for i in range(2):
+            self.http_request_fail(Exception("Connection refused"))
+            reply = yield self.dispatch_command('get', url=url)
+            self.check_reply(
+                reply, success=False, reason="Connection refused")
+        reply = yield self.dispatch_command('get', url=url)
+        self.check_reply(
+            reply, success=False,
+            reason="Circuit breaker open for www.example.com")
+        self.assertEqual(len(self.dummy_client.http_requests), 2)
+
+        self.http_request_succeed("foo")
+        reply = yield self.dispatch_command(
+            'get', url='http://other.example.com/')
+        self.check_reply(reply, body="foo")
+        self.assertEqual(
+            self.resource_stats('circuit.'),
+            {'circuit.opened': 1, 'circuit.rejected': 1})
+
+    @inlineCallbacks
+    def test_circuit_breaker_probe(self):
+        yield self.create_breaker_resource()
+        url = 'http://www.example.com/'
+        for i in range(2):
+            self.http_request_fail(Exception("Connection refused"))
+            yield self.dispatch_command('get', url=url)
+        self.clock.advance(10)
+        self.dummy_client.hold_next("foo")
+        d = self.dispatch_command('get', url=url)
+        reply = yield self.dispatch_command('get', url=url)
+        self.check_reply(reply, success=False)
+        self.dummy_client.release()
+        self.check_reply((yield d), body="foo")
+        self.http_request_succeed("bar")
+        reply = yield self.dispatch_command('get', url=url)
+        self.check_reply(reply, body="bar")
+        self.assertEqual(self.resource._breakers, {})
+
+    @inlineCallbacks
+    def test_circuit_breaker_server_errors(self):
+        yield self.create_breaker_resource(circuit_breaker_failures=1)
+        self.http_request_succeed("oops", code=503)
+        reply = yield self.dispatch_command(
+            'get', url='http://www.example.com/')
+        self.check_reply(reply, body="oops", code=503)
+        reply = yield self.dispatch_command(
+            'get', url='http://www.example.com/')
+        self.check_reply(reply, success=False)
+        self.assertEqual(len(self.dummy_client.http_requests), 1)
+
+    @inlineCallbacks
+    def test_circuit_breaker_ignores_data_limit(self):
+        yield self.create_breaker_resource(
+            circuit_breaker_failures=1, data_limit=2)
+        self.http_request_succeed("foo")
+        yield self.dispatch_command('get', url='http://www.example.com/')
+        self.http_request_succeed("ok")
+        reply = yield self.dispatch_command(
+            'get', url='http://www.example.com/')
+        self.check_reply(reply, body="ok")
+
+    @inlineCallbacks
+    def test_circuit_breakers_limited(self):
+        self.patch(HttpClientResource, 'MAX_BREAKERS', 2)
+        yield self.create_breaker_resource()
+        for host in ['a', 'b', 'a', 'c']:
+            self.http_request_fail(Exception("Connection refused"))
+            yield self.dispatch_command(
+                'get', url='http://%s.example.com/' % (host,))
+        self.assertEqual(
+            list(self.resource._breakers),
+            [('http', 'a.example.com', None), ('http', 'c.example.com', None)])
+        self.assertEqual(
+            self.resource._breakers.values()[0].state, CircuitBreaker.OPEN)
+
+    @inlineCallbacks
+    def test_circuit_breaker_disabled_by_default(self):
+        for i in range(10):
+            self.http_request_fail(Exception("Connection refused"))
+            yield self.dispatch_command(
+                'get', url='http://www.example.com/')
+        self.assertEqual(len(self.dummy_client.http_requests), 10)
+        self.assertEqual(self.resource._breakers, {})
+
+    @inlineCallbacks
+    def timed_get(self, url, seconds):
+        self.dummy_client.hold_next("foo")
+        d = self.dispatch_command('get', url=url)
+        self.clock.advance(seconds)
+        self.dummy_client.release()
+        self.check_reply((yield d), body="foo")
+
+    @inlineCallbacks
+    def test_hedge(self):
+        self.clock = Clock()
+        self.patch(HttpClientResource, 'clock', self.clock)
+        yield self.create_resource({
+            'hedge_percentile': 50, 'hedge_min_samples': 2,
+            'metrics_prefix': 'http'})
+        url = 'http://www.example.com/'
+        yield self.timed_get(url, 1)
+        self.assertEqual(len(self.dummy_client.http_requests), 1)
+        yield self.timed_get(url, 3)
+        self.assertEqual(len(self.dummy_client.http_requests), 2)
+
+        self.dummy_client.hold_next("foo")
+        d = self.dispatch_command('get', url=url)
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.dummy_client.http_requests), 3)
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.dummy_client.http_requests), 4)
+        self.dummy_client.release()
+        self.check_reply((yield d), body="foo")
+        self.assertEqual(
+            self.resource_stats('requests.'), {'requests.hedged': 1})
+
+    @inlineCallbacks
+    def test_hedge_only_gets(self):
+        self.clock = Clock()
+        self.patch(HttpClientResource, 'clock', self.clock)
+        yield self.create_resource({
+            'hedge_percentile': 50, 'hedge_min_samples': 1})
+        url = 'http://www.example.com/'
+        yield self.timed_get(url, 1)
+        self.dummy_client.hold_next("foo")
+        d = self.dispatch_command('post', url=url)
+        self.clock.advance(2)
+        self.assertEqual(len(self.dummy_client.http_requests), 2)
+        self.dummy_client.release()
+        self.check_reply((yield d), body="foo")
+
+    @inlineCallbacks
+    def test_dns_cache(self):
+        yield self.create_resource({'dns_cache_ttl': 60})
+        self.http_request_succeed("foo")
+        yield self.dispatch_command('get', url='http://www.example.com/')
+        agent_reactor = self.dummy_client.agent._reactor
+        self.assertIsInstance(agent_reactor, ResolverReactor)
+        self.assertIsInstance(
+            agent_reactor.nameResolver, CachingHostnameResolver)
+        self.assertEqual(agent_reactor.nameResolver.ttl, 60)
+        self.assertEqual(agent_reactor.nameResolver.negative_ttl, 5)
+
+    @inlineCallbacks
+    def test_dns_cache_disabled_by_default(self):
+        self.http_request_succeed("foo")
+        yield self.dispatch_command('get', url='http://www.example.com/')
+        self.assertNotIsInstance(
+            self.dummy_client.agent._reactor, ResolverReactor)
+
+    @inlineCallbacks
+    def request_pool(self, **kw):
+        self.http_request_succeed("foo")
+        reply = yield self.dispatch_command(
+            'get', url='https://www.example.com', **kw)
+        self.assertTrue(reply['success'])
+        returnValue(self.dummy_client.agent._pool)
+
+    @inlineCallbacks
+    def test_connection_persistence(self):
+        pool = yield self.request_pool()
+        self.assertEqual(
+            pool.persistent, self.resource.persistent_connections)
+
+
+class TestHttpClientResourcePersistent(TestHttpClientResource):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestHttpClientResourcePersistent, self).setUp()
+        yield self.create_resource({'persistent_connections': True})
+
+    @inlineCallbacks
+    def test_pool_shared_between_requests(self):
+        pool = yield self.request_pool()
+        self.assertIsInstance(pool, MeteredConnectionPool)
+        self.assertEqual(pool.maxPersistentPerHost, 2)
+        self.assertEqual(pool.cachedConnectionTimeout, 240)
+        self.assertIdentical((yield self.request_pool()), pool)
+
+    @inlineCallbacks
+    def test_pool_shared_between_sandboxes(self):
+        pool = yield self.request_pool()
+        self.api = self.app_worker.create_sandbox_api()
+        self.app_worker.create_sandbox_protocol('other_id', self.api)
+        self.assertIdentical((yield self.request_pool()), pool)
+
+    @inlineCallbacks
+    def test_pools_kept_apart_by_tls_settings(self):
+        pool = yield self.request_pool()
+        verify_none_pool = yield self.request_pool(
+            verify_options=['VERIFY_NONE'])
+        tls_pool = yield self.request_pool(ssl_method='TLSv1')
+        self.assertEqual(
+            len(set([pool, verify_none_pool, tls_pool])), 3)
+        self.assertEqual(sorted(self.resource.pools.keys()), [
+            (None, None), (None, TLSv1_METHOD), (VERIFY_NONE, None)])
+
+    @inlineCallbacks
+    def test_pool_config(self):
+        yield self.create_resource({
+            'persistent_connections': True,
+            'max_connections_per_host': 10,
+            'connection_idle_timeout': 30,
+        })
+        pool = yield self.request_pool()
+        self.assertEqual(pool.maxPersistentPerHost, 10)
+        self.assertEqual(pool.cachedConnectionTimeout, 30)
+
+    @inlineCallbacks
+    def test_teardown_closes_pools(self):
+        pool = yield self.request_pool()
+        closed = []
+        self.patch(pool, 'closeCachedConnections',
+                   lambda: succeed(closed.append(pool)))
+        yield self.resource.teardown()
+        self.assertEqual(closed, [pool])
+        self.assertEqual(self.resource.pools, {})
+
+    @inlineCallbacks
+    def test_pool_metrics(self):
+        yield self.create_resource({
+            'persistent_connections': True,
+            'metrics_prefix': 'http',
+        })
+        pool = yield self.request_pool()
+        self.assertIdentical(pool.stats, self.resource.stats)
+
+    @inlineCallbacks
+    def test_pool_uses_agent_reactor(self):
+        pool = yield self.request_pool()
+        self.assertIdentical(pool._reactor, self.resource.agent_reactor)
+
+
+class TestMeteredConnectionPool(VumiTestCase):
+
+    def stats(self, collector):
+        return dict((name, value)
+                    for name, _agg, value in collector.collect())
+
+    @inlineCallbacks
+    def test_hits_and_misses(self):
+        collector = StatsCollector('http')
+        pool = MeteredConnectionPool(Clock(), stats=collector)
+        endpoint = DummyEndpoint()
+        connection = yield pool.getConnection('key', endpoint)
+        self.assertEqual(endpoint.connections, [connection])
+        self.assertEqual(self.stats(collector), {'pool.misses': 1})
+
+        pool._putConnection('key', connection)
+        reused = yield pool.getConnection('key', endpoint)
+        self.assertEqual(endpoint.connections, [connection])
+        self.assertIdentical(reused._clientProtocol, connection)
+        self.assertEqual(self.stats(collector), {'pool.hits': 1})
+
+    @inlineCallbacks
+    def test_idle_connection_timed_out(self):
+        collector = StatsCollector('http')
+        clock = Clock()
+        pool = MeteredConnectionPool(clock, stats=collector)
+        endpoint = DummyEndpoint()
+        connection = yield pool.getConnection('key', endpoint)
+        pool._putConnection('key', connection)
+        clock.advance(pool.cachedConnectionTimeout)
+        self.assertEqual(connection.state, "DISCONNECTED")
+        yield pool.getConnection('key', endpoint)
+        self.assertEqual(len(endpoint.connections), 2)
+        self.assertEqual(self.stats(collector), {'pool.misses': 2})
+        self.assertEqual(pool._idle, {})
+
+    @inlineCallbacks
+    def test_idle_connections_limited(self):
+        collector = StatsCollector('http')
+        pool = MeteredConnectionPool(Clock(), stats=collector)
+        pool.maxPersistentPerHost = 1
+        endpoint = DummyEndpoint()
+        connections = []
+        for i in range(2):
+            connections.append((yield pool.getConnection('key', endpoint)))
+        for connection in connections:
+            pool._putConnection('key', connection)
+        self.assertEqual(pool._idle, {'key': connections[1:]})
+        for i in range(2):
+            yield pool.getConnection('key', endpoint)
+        self.assertEqual(
+            self.stats(collector), {'pool.hits': 1, 'pool.misses': 3})
+
+    @inlineCallbacks
+    def test_no_stats(self):
+        pool = MeteredConnectionPool(Clock())
+        endpoint = DummyEndpoint()
+        yield pool.getConnection('key', endpoint)
+        self.assertEqual(len(endpoint.connections), 1)
+
+
+class TestResumingCreator(VumiTestCase):
+
+    def mk_creator(self, *sessions):
+        connections = [DummyTLSConnection(session) for session in sessions]
+        creator = ResumingCreator(DummyCreator(connections))
+        return creator, connections
+
+    def test_first_connection(self):
+        creator, [connection] = self.mk_creator(None)
+        self.assertIdentical(
+            creator.clientConnectionForTLS("protocol"), connection)
+        self.assertEqual(connection.protocol, "protocol")
+        self.assertEqual(connection.offered_session, None)
+
+    def test_resume_previous_session(self):
+        creator, [_, connection] = self.mk_creator("session-1", None)
+        creator.clientConnectionForTLS("protocol")
+        creator.clientConnectionForTLS("protocol")
+        self.assertEqual(connection.offered_session, "session-1")
+
+    def test_keep_session_until_replaced(self):
+        # The second connection hasn't finished its handshake yet.
+        creator, connections = self.mk_creator(
+            "session-1", None, "session-2", None)
+        for _ in connections:
+            creator.clientConnectionForTLS("protocol")
+        self.assertEqual(
+            [connection.offered_session for connection in connections],
+            [None, "session-1", "session-1", "session-2"])
+
+
+class TestCreatorCache(VumiTestCase):
+
+    def test_least_recently_used_evicted(self):
+        self.patch(CreatorCache, 'MAX_CREATORS', 2)
+        creators = CreatorCache()
+        a = creators.get('a.example.com', 443, object)
+        self.assertIsInstance(a, ResumingCreator)
+        b = creators.get('b.example.com', 443, object)
+        self.assertIdentical(creators.get('a.example.com', 443, object), a)
+        creators.get('c.example.com', 443, object)
+        self.assertIdentical(creators.get('a.example.com', 443, object), a)
+        self.assertNotIdentical(
+            creators.get('b.example.com', 443, object), b)
+
+
+class TestLimitedBodyCollector(VumiTestCase):
+
+    def mk_collector(self, data_limit=None, length=None):
+        d = Deferred()
+        collector = LimitedBodyCollector(d, data_limit, length)
+        collector.makeConnection(DummyBodyTransport())
+        return collector, d
+
+    @inlineCallbacks
+    def test_body(self):
+        collector, d = self.mk_collector(data_limit=6)
+        collector.dataReceived('foo')
+        collector.dataReceived('bar')
+        collector.connectionLost(Failure(ResponseDone()))
+        self.assertEqual((yield d), 'foobar')
+
+    @inlineCallbacks
+    def test_potential_data_loss(self):
+        collector, d = self.mk_collector()
+        collector.dataReceived('foo')
+        collector.connectionLost(Failure(PotentialDataLoss()))
+        self.assertEqual((yield d), 'foo')
+
+    @inlineCallbacks
+    def test_connection_lost(self):
+        collector, d = self.mk_collector()
+        collector.dataReceived('foo')
+        collector.connectionLost(Failure(ConnectionLost()))
+        yield self.assertFailure(d, ConnectionLost)
+
+    @inlineCallbacks
+    def test_length_over_limit(self):
+        collector, d = self.mk_collector(data_limit=5, length=6)
+        self.assertFalse(collector.transport.producing)
+        collector.dataReceived('foobar')
+        collector.connectionLost(Failure(ConnectionLost()))
+        yield self.assertFailure(d, HttpDataLimitError)
+
+    @inlineCallbacks
+    def test_data_over_limit(self):
+        collector, d = self.mk_collector(data_limit=5)
+        collector.dataReceived('foo')
+        self.assertTrue(collector.transport.producing)
+        collector.dataReceived('bar')
+        self.assertFalse(collector.transport.producing)
+        self.assertEqual(collector._chunks, [])
+        collector.connectionLost(Failure(ConnectionLost()))
+        failure = yield self.assertFailure(d, HttpDataLimitError)
+        self.assertEqual(
+            str(failure), "Received 6 bytes, maximum of 5 bytes allowed.")
+
+
+class TestDecodingBodyCollector(VumiTestCase):
+
+    def mk_collector(self, encoding='gzip', data_limit=None):
+        d = Deferred()
+        collector = DecodingBodyCollector(d, encoding, data_limit)
+        collector.makeConnection(DummyBodyTransport())
+        return collector, d
+
+    @inlineCallbacks
+    def test_body(self):
+        collector, d = self.mk_collector(data_limit=6)
+        body = gzip_compress("foobar")
+        for i in range(len(body)):
+            collector.dataReceived(body[i])
+        collector.connectionLost(Failure(ResponseDone()))
+        self.assertEqual((yield d), 'foobar')
+
+    @inlineCallbacks
+    def test_deflate(self):
+        collector, d = self.mk_collector('deflate')
+        collector.dataReceived(zlib.compress("foobar"))
+        collector.connectionLost(Failure(ResponseDone()))
+        self.assertEqual((yield d), 'foobar')
+
+    @inlineCallbacks
+    def test_decompressed_data_over_limit(self):
+        collector, d = self.mk_collector(data_limit=1000)
+        collector._decoder = RecordingDecoder(collector._decoder)
+        collector.dataReceived(gzip_compress("x" * 1000000))
+        self.assertFalse(collector.transport.producing)
+        self.assertEqual(collector._decoder.decompressed, 1001)
+        failure = yield self.assertFailure(d, HttpDataLimitError)
+        self.assertEqual(
+            str(failure),
+            "Received 1001 bytes, maximum of 1000 bytes allowed.")
+
+    @inlineCallbacks
+    def test_invalid_body(self):
+        collector, d = self.mk_collector()
+        collector.dataReceived("not gzip")
+        self.assertFalse(collector.transport.producing)
+        collector.connectionLost(Failure(ConnectionLost()))
+        yield self.assertFailure(d, ContentDecodingError)
+
+    @inlineCallbacks
+    def test_connection_lost(self):
+        collector, d = self.mk_collector()
+        collector.dataReceived(gzip_compress("foobar")[:10])
+        collector.connectionLost(Failure(ConnectionLost()))
+        yield self.assertFailure(d, ConnectionLost)
+
+
+class TestCircuitBreaker(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.breaker = CircuitBreaker(2, 10, self.clock)
+
+    def open_breaker(self):
+        self.assertFalse(self.breaker.failed())
+        self.assertTrue(self.breaker.failed())
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_opens_after_consecutive_failures(self):
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failed()
+        self.breaker.succeeded()
+        self.assertTrue(self.breaker.allow())
+        self.open_breaker()
+        self.assertFalse(self.breaker.allow())
+        self.assertFalse(self.breaker.failed())
+
+    def test_probe_succeeds(self):
+        self.open_breaker()
+        self.clock.advance(9)
+        self.assertFalse(self.breaker.allow())
+        self.clock.advance(1)
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.breaker.succeeded()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_probe_fails(self):
+        self.open_breaker()
+        self.clock.advance(10)
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.failed())
+        self.assertFalse(self.breaker.allow())
+        self.clock.advance(10)
+        self.assertTrue(self.breaker.allow())
+
+    def test_probe_abandoned(self):
+        self.open_breaker()
+        self.clock.advance(10)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.abandoned()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(self.breaker.allow())
+
+
+class TestLatencyTracker(VumiTestCase):
+
+    def test_percentile(self):
+        tracker = LatencyTracker(min_samples=4)
+        for latency in [4, 1, 3]:
+            tracker.record('host', latency)
+        self.assertEqual(tracker.percentile('host', 50), None)
+        tracker.record('host', 2)
+        self.assertEqual(tracker.percentile('host', 50), 2)
+        self.assertEqual(tracker.percentile('host', 95), 4)
+        self.assertEqual(tracker.percentile('host', 1), 1)
+        self.assertEqual(tracker.percentile('other', 50), None)
+
+    def test_window(self):
+        self.patch(LatencyTracker, 'WINDOW', 2)
+        tracker = LatencyTracker(min_samples=1)
+        for latency in [5, 1, 2]:
+            tracker.record('host', latency)
+        self.assertEqual(tracker.percentile('host', 100), 2)
+
+    def test_least_recently_used_evicted(self):
+        self.patch(LatencyTracker, 'MAX_HOSTS', 2)
+        tracker = LatencyTracker(min_samples=1)
+        for host in ['a', 'b', 'a', 'c']:
+            tracker.record(host, 1)
+        self.assertEqual(tracker.percentile('a', 50), 1)
+        self.assertEqual(tracker.percentile('b', 50), None)
+        self.assertEqual(tracker.percentile('c', 50), 1)
+
+
+class TestHedgedRequest(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.requests = []
+        self.cancelled = []
+
+    def make_request(self):
+        d = Deferred(self.cancelled.append)
+        self.requests.append(d)
+        return d
+
+    def start(self, delay=1):
+        hedged = HedgedRequest(self.make_request, delay, self.clock)
+        return hedged, hedged.start()
+
+    @inlineCallbacks
+    def test_fast_response(self):
+        hedged, d = self.start()
+        self.clock.advance(0.5)
+        self.requests[0].callback("foo")
+        self.assertEqual((yield d), "foo")
+        self.clock.advance(1)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(
+            (hedged.hedged, hedged.winner, hedged.latency), (False, 0, 0.5))
+
+    @inlineCallbacks
+    def test_hedge_wins(self):
+        hedged, d = self.start()
+        self.clock.advance(1)
+        self.assertEqual(len(self.requests), 2)
+        self.clock.advance(0.25)
+        self.requests[1].callback("bar")
+        self.assertEqual((yield d), "bar")
+        self.assertEqual(self.cancelled, [self.requests[0]])
+        self.assertEqual(
+            (hedged.hedged, hedged.winner, hedged.latency), (True, 1, 0.25))
+
+    @inlineCallbacks
+    def test_first_wins_after_hedge(self):
+        hedged, d = self.start()
+        self.clock.advance(1)
+        self.requests[0].callback("foo")
+        self.assertEqual((yield d), "foo")
+        self.assertEqual(self.cancelled, [self.requests[1]])
+        self.assertEqual((hedged.winner, hedged.latency), (0, 1))
+
+    @inlineCallbacks
+    def test_failure_before_hedge(self):
+        hedged, d = self.start()
+        self.requests[0].errback(ValueError("foo"))
+        yield self.assertFailure(d, ValueError)
+        self.clock.advance(1)
+        self.assertEqual(len(self.requests), 1)
+
+    @inlineCallbacks
+    def test_one_request_fails(self):
+        hedged, d = self.start()
+        self.clock.advance(1)
+        self.requests[0].errback(ValueError("foo"))
+        self.assertNoResult(d)
+        self.requests[1].callback("bar")
+        self.assertEqual((yield d), "bar")
+
+    @inlineCallbacks
+    def test_both_requests_fail(self):
+        hedged, d = self.start()
+        self.clock.advance(1)
+        self.requests[1].errback(KeyError("bar"))
+        self.requests[0].errback(ValueError("foo"))
+        yield self.assertFailure(d, KeyError)
+        self.assertEqual(hedged.latency, None)
+
+    @inlineCallbacks
+    def test_no_delay(self):
+        hedged, d = self.start(delay=None)
+        self.clock.advance(100)
+        self.assertEqual(len(self.requests), 1)
+        self.requests[0].callback("foo")
+        self.assertEqual((yield d), "foo")
+
+
+class TestCachingHostnameResolver(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.upstream = DummyResolver()
+        self.stats = StatsCollector('http')
+        self.resolver = CachingHostnameResolver(
+            self.upstream, 10, 2, self.clock, self.stats)
+
+    def resolve(self, hostName='example.com'):
+        receiver = DummyResolutionReceiver()
+        self.resolver.resolveHostName(receiver, hostName, 80)
+        return receiver
+
+    def assert_stats(self, **expected):
+        self.assertEqual(
+            dict((name, value)
+                 for name, _agg, value in self.stats.collect()),
+            dict(("dns.%s" % (name,), value)
+                 for name, value in expected.iteritems()))
+
+    def test_cache_addresses(self):
+        receiver = self.resolve()
+        self.assertEqual(receiver.resolution.name, 'example.com')
+        self.assertFalse(hasattr(receiver, 'complete'))
+        self.upstream.answer('addr-1', 'addr-2')
+        self.assertEqual(receiver.addresses, ['addr-1', 'addr-2'])
+        self.assertTrue(receiver.complete)
+
+        receiver = self.resolve()
+        self.assertEqual(receiver.addresses, ['addr-1', 'addr-2'])
+        self.assertTrue(receiver.complete)
+        self.assertEqual(len(self.upstream.lookups), 1)
+        self.assert_stats(hits=1, misses=1)
+
+    def test_expiry(self):
+        self.resolve()
+        self.upstream.answer('addr-1')
+        self.clock.advance(10)
+        receiver = self.resolve()
+        self.assertEqual(len(self.upstream.lookups), 2)
+        self.upstream.answer('addr-2')
+        self.assertEqual(receiver.addresses, ['addr-2'])
+
+    def test_negative_cache(self):
+        receiver = self.resolve()
+        self.upstream.answer()
+        self.assertEqual(receiver.addresses, [])
+        self.clock.advance(1)
+        receiver = self.resolve()
+        self.assertEqual(receiver.addresses, [])
+        self.assertEqual(len(self.upstream.lookups), 1)
+        self.clock.advance(1)
+        self.resolve()
+        self.assertEqual(len(self.upstream.lookups), 2)
+
+    def test_concurrent_lookups_shared(self):
+        receivers = [self.resolve(), self.resolve()]
+        self.assertEqual(len(self.upstream.lookups), 1)
+        self.upstream.answer('addr-1')
+        self.assertEqual(
+            [receiver.addresses for receiver in receivers],
+            [['addr-1'], ['addr-1']])
+
+    def test_prefetch(self):
+        self.resolve()
+        self.upstream.answer('addr-1')
+        self.clock.advance(7)
+        self.resolve()
+        self.assertEqual(len(self.upstream.lookups), 1)
+        self.clock.advance(1)
+        receiver = self.resolve()
+        self.assertEqual(receiver.addresses, ['addr-1'])
+        self.assertTrue(receiver.complete)
+        self.assertEqual(len(self.upstream.lookups), 2)
+        self.resolve()
+        self.assertEqual(len(self.upstream.lookups), 2)
+        self.upstream.answer('addr-2')
+        self.clock.advance(7)
+        receiver = self.resolve()
+        self.assertEqual(receiver.addresses, ['addr-2'])
+        self.assert_stats(hits=4, misses=1, prefetches=1)
+
+    def test_failed_prefetch_keeps_addresses(self):
+        self.resolve()
+        self.upstream.answer('addr-1')
+        self.clock.advance(8)
+        self.resolve()
+        self.upstream.answer()
+        receiver = self.resolve()
+        self.assertEqual(receiver.addresses, ['addr-1'])
+        self.assertEqual(len(self.upstream.lookups), 2)
+        self.clock.advance(1.5)
+        receiver = self.resolve()
+        self.assertEqual(receiver.addresses, ['addr-1'])
+        self.assertEqual(len(self.upstream.lookups), 2)
+        self.clock.advance(0.5)
+        receiver = self.resolve()
+        self.assertEqual(receiver.addresses, [])
+        self.assertEqual(len(self.upstream.lookups), 3)
+
+    def test_failed_prefetch_retried(self):
+        self.patch(self.resolver, 'negative_ttl', 1)
+        self.resolve()
+        self.upstream.answer('addr-1')
+        self.clock.advance(8)
+        self.resolve()
+        self.upstream.answer()
+        self.resolve()
+        self.assertEqual(len(self.upstream.lookups), 2)
+        self.clock.advance(1)
+        self.resolve()
+        self.assertEqual(len(self.upstream.lookups), 3)
+        self.upstream.answer('addr-2')
+        receiver = self.resolve()
+        self.assertEqual(receiver.addresses, ['addr-2'])
+
+    def test_cancel(self):
+        receiver = self.resolve()
+        receiver.resolution.cancel()
+        self.upstream.answer('addr-1')
+        self.assertEqual(receiver.addresses, [])
+        self.assertFalse(hasattr(receiver, 'complete'))
+        receiver = self.resolve()
+        self.assertEqual(receiver.addresses, ['addr-1'])
+        self.assertEqual(len(self.upstream.lookups), 1)
+
+    def test_lookup_error(self):
+        def fail_lookup(*args):
+            raise ValueError("resolver broken")
+        self.patch(self.upstream, 'resolveHostName', fail_lookup)
+        receiver = self.resolve()
+        self.assertEqual(receiver.addresses, [])
+        self.assertTrue(receiver.complete)
+        [error] = self.flushLoggedErrors(ValueError)
+        self.assertEqual(error.getErrorMessage(), "resolver broken")
+
+    def test_least_recently_used_evicted(self):
+        self.patch(CachingHostnameResolver, 'MAX_ENTRIES', 2)
+        for hostName in ['a', 'b', 'a', 'c']:
+            self.resolve(hostName)
+            if self.upstream.lookups[-1][0] == hostName:
+                self.upstream.answer('addr-' + hostName)
+        self.resolve('a')
+        self.assertEqual(len(self.upstream.lookups), 3)
+        self.resolve('b')
+        self.assertEqual(len(self.upstream.lookups), 4)
+
+
+class TestResolverReactor(VumiTestCase):
+
+    def test_passes_through(self):
+        clock = Clock()
+        resolver = DummyResolver()
+        resolver_reactor = ResolverReactor(clock, resolver)
+        self.assertIdentical(resolver_reactor.nameResolver, resolver)
+        resolver_reactor.callLater(1, lambda: None)
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        other = DummyResolver()
+        self.assertIdentical(
+            resolver_reactor.installNameResolver(other), resolver)
+        self.assertIdentical(resolver_reactor.nameResolver, other)
@@ -1,12 +1,263 @@
+import fnmatch
 import json
 import logging
+import os
+import zlib
+from hashlib import sha1
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import (
+    inlineCallbacks, gatherResults, returnValue)
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import MemoryReactor
+from twisted.trial.unittest import SkipTest
 
-from vumi.tests.helpers import PersistenceHelper
+from txredis.exceptions import NoScript
 
-from vxsandbox.resources.kv import RedisResource
-from vxsandbox.resources.tests.utils import ResourceTestCaseBase
+from vumi.errors import ConfigError
+from vumi.persist.fake_redis import FakeRedis, ResponseError, maybe_async
+from vumi.persist.txredis_manager import TxRedisManager
+from vumi.tests.helpers import PersistenceHelper, VumiTestCase
+
+from vxsandbox.resources import kv
+from vxsandbox.resources.kv import (
+    RedisResource, HashRedisResource, SET_SCRIPT, INCR_SCRIPT, MSET_SCRIPT,
+    HASH_SET_SCRIPT, HASH_INCR_SCRIPT, HASH_GET_SCRIPT, HASH_DELETE_SCRIPT,
+    HASH_SCAN_SCRIPT, HASH_SWEEP_SCRIPT, CacheInvalidationFactory,
+    CacheInvalidationSubscriber, IncrBuffer, KvShard, glob_escape)
+from vxsandbox.resources.tests.utils import (
+    ResourceTestCaseBase, JsonRepliesMixin)
+from vxsandbox.resources.utils import SandboxCommand, RawJSON
+
+
+def real_redis():
+    """Return whether the tests are run against a real Redis server."""
+    return 'VUMITEST_REDIS_DB' in os.environ
+
+
+def scripting_redis_config(persistence_helper, fake_redis_cls=None):
+    """
+    Return the config of a Redis manager that can run the kv resource's
+    Lua scripts. When the tests are run against a real Redis server, the
+    scripts themselves are run there. Otherwise a
+    :class:`ScriptingFakeRedis` runs their Python equivalents.
+    """
+    config = persistence_helper.mk_config({})['redis_manager'].copy()
+    if not real_redis():
+        config['FAKE_REDIS'] = (fake_redis_cls or ScriptingFakeRedis)(
+            async=True)
+    return config
+
+
+def skip_without_real_redis():
+    """Skip a test that must run a Lua script on a real Redis server."""
+    if not real_redis():
+        raise SkipTest("Needs a real Redis server (set VUMITEST_REDIS_DB).")
+
+
+def skip_with_real_redis():
+    """Skip a test that inspects the calls made to a fake Redis."""
+    if real_redis():
+        raise SkipTest("Inspects the calls made to a fake Redis.")
+
+
+class ScriptingFakeRedis(FakeRedis):
+    """
+    FakeRedis has no Lua interpreter, so this runs Python equivalents of
+    the kv resource's scripts instead.
+    """
+
+    def __init__(self, *args, **kw):
+        super(ScriptingFakeRedis, self).__init__(*args, **kw)
+        self.script_cache = set()
+        self.script_calls = []
+        self.scripts = {
+            SET_SCRIPT.sha: self._set_script,
+            INCR_SCRIPT.sha: self._incr_script,
+            MSET_SCRIPT.sha: self._mset_script,
+            HASH_SET_SCRIPT.sha: self._hash_set_script,
+            HASH_INCR_SCRIPT.sha: self._hash_incr_script,
+            HASH_GET_SCRIPT.sha: self._hash_get_script,
+            HASH_DELETE_SCRIPT.sha: self._hash_delete_script,
+            HASH_SCAN_SCRIPT.sha: self._hash_scan_script,
+            HASH_SWEEP_SCRIPT.sha: self._hash_sweep_script,
+        }
+
+    @maybe_async
+    def evalsha(self, sha, keys=(), args=()):
+        self.script_calls.append('evalsha')
+        if sha not in self.script_cache:
+            raise NoScript("No matching script. Please use EVAL.")
+        return self.scripts[sha](keys, args)
+
+    @maybe_async
+    def eval(self, source, keys=(), args=()):
+        self.script_calls.append('eval')
+        sha = sha1(source).hexdigest()
+        if sha not in self.scripts:
+            raise ResponseError("Unknown script.")
+        self.script_cache.add(sha)
+        return self.scripts[sha](keys, args)
+
+    def _check_keys(self, keys, args):
+        key, count_key = keys
+        soft, hard = int(args[0]), int(args[1])
+        if self.exists.sync(self, key):
+            return 0
+        key_count = int(self.get.sync(self, count_key) or 0) + 1
+        if key_count > soft and key_count >= hard:
+            return -key_count
+        self.incr.sync(self, count_key)
+        return key_count
+
+    def _set_script(self, keys, args):
+        key_count = self._check_keys(keys, args)
+        if key_count >= 0:
+            if args[3] == '':
+                self.set.sync(self, keys[0], args[2])
+            else:
+                self.setex.sync(self, keys[0], int(args[3]), args[2])
+        return key_count
+
+    def _incr_script(self, keys, args):
+        key_count = self._check_keys(keys, args)
+        if key_count < 0:
+            return [key_count, 0]
+        try:
+            value = self.incr.sync(self, keys[0], int(args[2]))
+        except ValueError:
+            if key_count > 0:
+                self.decr.sync(self, keys[1])
+            raise ResponseError("ERR value is not an integer")
+        return [key_count, value]
+
+    def _mset_script(self, keys, args):
+        count_key, keys = keys[0], keys[1:]
+        soft, hard, seconds = int(args[0]), int(args[1]), args[2]
+        new_keys = len([key for key in keys
+                        if not self.exists.sync(self, key)])
+        key_count = 0
+        if new_keys:
+            key_count = int(self.get.sync(self, count_key) or 0) + new_keys
+            if key_count > soft and key_count >= hard:
+                return -key_count
+            self.incr.sync(self, count_key, new_keys)
+        for key, value in zip(keys, args[3:]):
+            if seconds == '':
+                self.set.sync(self, key, value)
+            else:
+                self.setex.sync(self, key, int(seconds), value)
+        return key_count
+
+    def _expired(self, keys, field, now):
+        expires = self.zscore.sync(self, keys[1], field)
+        return expires is not None and float(expires) <= float(now)
+
+    def _remove_all_expired(self, keys, now):
+        for field in self.zrangebyscore.sync(self, keys[1], '-inf', now):
+            self.hdel.sync(self, keys[0], field)
+            self.zrem.sync(self, keys[1], field)
+
+    def _check_new_fields(self, keys, fields, soft, hard, now):
+        self._remove_all_expired(keys, now)
+        new_fields = len([field for field in fields
+                          if not self.hexists.sync(self, keys[0], field)])
+        if new_fields == 0:
+            return 0
+        key_count = self.hlen.sync(self, keys[0]) + new_fields
+        if key_count > int(soft) and key_count >= int(hard):
+            return -key_count
+        return key_count
+
+    def _hash_set_script(self, keys, args):
+        soft, hard, now, sandbox_id, expires = args[:5]
+        items = zip(args[5::2], args[6::2])
+        key_count = self._check_new_fields(
+            keys, [field for field, _value in items], soft, hard, now)
+        if key_count < 0:
+            return key_count
+        for field, value in items:
+            self.hset.sync(self, keys[0], field, value)
+            if expires == '':
+                self.zrem.sync(self, keys[1], field)
+            else:
+                self.zadd.sync(self, keys[1], **{field: expires})
+                self.sadd.sync(self, keys[2], sandbox_id)
+        return key_count
+
+    def _hash_incr_script(self, keys, args):
+        soft, hard, now, field, amount = args
+        key_count = self._check_new_fields(keys, [field], soft, hard, now)
+        if key_count < 0:
+            return [key_count, 0]
+        return [key_count, self.hincrby.sync(self, keys[0], field, amount)]
+
+    def _hash_get_script(self, keys, args):
+        now = args[0]
+        return [None if self._expired(keys, field, now)
+                else self.hget.sync(self, keys[0], field)
+                for field in args[1:]]
+
+    def _hash_delete_script(self, keys, args):
+        now = args[0]
+        existed = []
+        for field in args[1:]:
+            was_expired = self._expired(keys, field, now)
+            deleted = self.hdel.sync(self, keys[0], field)
+            self.zrem.sync(self, keys[1], field)
+            existed.append(0 if was_expired else deleted)
+        return existed
+
+    def _hash_scan_script(self, keys, args):
+        now, cursor, match, count = args
+        fields = sorted(self.hgetall.sync(self, keys[0]))
+        start = int(cursor)
+        end = start + int(count)
+        next_cursor = str(end) if end < len(fields) else '0'
+        return [next_cursor, [
+            field for field in fnmatch.filter(fields[start:end], match)
+            if not self._expired(keys, field, now)]]
+
+    def _hash_sweep_script(self, keys, args):
+        now, sandbox_id, limit = args
+        fields = self.zrangebyscore.sync(
+            self, keys[1], '-inf', now, 0, int(limit))
+        for field in fields:
+            self.hdel.sync(self, keys[0], field)
+            self.zrem.sync(self, keys[1], field)
+        if self.zcard.sync(self, keys[1]) == 0:
+            self.srem.sync(self, keys[2], sandbox_id)
+        return len(fields)
+
+
+class MGetFakeRedis(FakeRedis):
+    """
+    FakeRedis with the ``MGET`` command that the txredis client provides.
+    """
+
+    def __init__(self, *args, **kw):
+        super(MGetFakeRedis, self).__init__(*args, **kw)
+        self.mget_calls = []
+
+    @maybe_async
+    def mget(self, *keys):
+        self.mget_calls.append(keys)
+        return [self.get.sync(self, key) for key in keys]
+
+
+class PublishingFakeRedis(FakeRedis):
+    """
+    FakeRedis with the ``PUBLISH`` command. Published messages are
+    recorded rather than delivered.
+    """
+
+    def __init__(self, *args, **kw):
+        super(PublishingFakeRedis, self).__init__(*args, **kw)
+        self.published = []
+
+    @maybe_async
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+        return 0
 
 
 class TestRedisResource(ResourceTestCaseBase):
@@ -54,6 +305,15 @@ class TestRedisResource(ResourceTestCaseBase):
         self.assertEqual(level, expected_level)
         self.assertEqual(message, expected_message)
 
+    @inlineCallbacks
+    def test_single_redis_manager(self):
+        self.assertEqual(
+            self.resource.r_config, self.resource.config['redis_manager'])
+        yield self.resource.redis.set(
+            'sandboxes#test_id#foo', json.dumps('bar'))
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value='bar')
+
     @inlineCallbacks
     def test_handle_set(self):
         reply = yield self.dispatch_command('set', key='foo', value='bar')
@@ -175,6 +435,21 @@ class TestRedisResource(ResourceTestCaseBase):
         self.assertTrue(reply['reason'])
         yield self.check_metric('foo', 'a', 1)
 
+    @inlineCallbacks
+    def test_handle_incr_float_amount(self):
+        reply = yield self.dispatch_command('incr', key='foo', amount=1.5)
+        self.check_reply(
+            reply, success=False, reason="amount must be an integer")
+        yield self.check_metric('foo', None, None)
+
+    @inlineCallbacks
+    def test_handle_incr_string_amount(self):
+        yield self.create_metric('foo', '1')
+        reply = yield self.dispatch_command('incr', key='foo', amount='2')
+        self.check_reply(
+            reply, success=False, reason="amount must be an integer")
+        yield self.check_metric('foo', '1', 1)
+
     @inlineCallbacks
     def test_handle_incr_soft_limit_reached(self):
         yield self.create_metric('foo', 'a', total_count=80)
@@ -202,3 +477,1260 @@ class TestRedisResource(ResourceTestCaseBase):
             message,
             'Redis hard limit of 100 keys reached for sandbox test_id. '
             'No more keys can be written.')
+
+    @inlineCallbacks
+    def test_handle_mget(self):
+        yield self.create_metric('foo', json.dumps('bar'))
+        yield self.r_server.set('sandboxes#test_id#baz', json.dumps([1, 2]))
+        reply = yield self.dispatch_command(
+            'mget', keys=['foo', 'missing', 'baz'])
+        self.check_reply(reply, success=True, values=['bar', None, [1, 2]])
+
+    @inlineCallbacks
+    def test_handle_mget_no_keys(self):
+        reply = yield self.dispatch_command('mget', keys=[])
+        self.check_reply(reply, success=True, values=[])
+
+    @inlineCallbacks
+    def test_handle_mget_bad_keys(self):
+        reply = yield self.dispatch_command('mget', keys='foo')
+        self.check_reply(
+            reply, success=False, reason="keys must be a list of strings")
+
+    @inlineCallbacks
+    def test_handle_mset(self):
+        yield self.create_metric('foo', json.dumps('old'))
+        reply = yield self.dispatch_command(
+            'mset', items={'foo': 'bar', 'baz': {'x': 1}})
+        self.check_reply(reply, success=True)
+        yield self.check_metric('foo', json.dumps('bar'), 2)
+        yield self.check_metric('baz', json.dumps({'x': 1}), 2)
+
+    @inlineCallbacks
+    def test_handle_mset_with_expiry(self):
+        reply = yield self.dispatch_command(
+            'mset', items={'foo': 'bar'}, seconds=5)
+        self.check_reply(reply, success=True)
+        yield self.check_metric('foo', json.dumps('bar'), 1, seconds=5)
+
+    @inlineCallbacks
+    def test_handle_mset_bad_items(self):
+        reply = yield self.dispatch_command('mset', items=['foo'])
+        self.check_reply(
+            reply, success=False, reason="items must be an object")
+
+    @inlineCallbacks
+    def test_handle_mset_hard_limit_reached(self):
+        yield self.create_metric('foo', json.dumps('a'), total_count=99)
+        reply = yield self.dispatch_command(
+            'mset', items={'foo': 'b', 'bar': 'c', 'baz': 'd'})
+        self.check_reply(reply, success=False, reason='Too many keys')
+        yield self.check_metric('foo', json.dumps('a'), 99)
+        yield self.check_metric('bar', None, 99)
+        self.assert_api_log(
+            logging.ERROR,
+            'Redis hard limit of 100 keys reached for sandbox test_id. '
+            'No more keys can be written.')
+
+    @inlineCallbacks
+    def test_handle_mdelete(self):
+        yield self.create_metric('foo', json.dumps('bar'), total_count=2)
+        yield self.r_server.set('sandboxes#test_id#baz', json.dumps('quux'))
+        reply = yield self.dispatch_command(
+            'mdelete', keys=['foo', 'missing', 'baz'])
+        self.check_reply(reply, success=True, existed=[True, False, True])
+        yield self.check_metric('foo', None, 0)
+        yield self.check_metric('baz', None, 0)
+
+    @inlineCallbacks
+    def test_handle_mdelete_bad_keys(self):
+        reply = yield self.dispatch_command('mdelete', keys=[1])
+        self.check_reply(
+            reply, success=False, reason="keys must be a list of strings")
+
+    @inlineCallbacks
+    def scan_all(self, **kw):
+        keys = []
+        cursor = None
+        while True:
+            reply = yield self.dispatch_command('scan', cursor=cursor, **kw)
+            self.check_reply(reply, success=True)
+            keys.extend(reply['keys'])
+            cursor = reply['cursor']
+            if cursor is None:
+                break
+        returnValue(sorted(set(keys)))
+
+    @inlineCallbacks
+    def test_handle_scan(self):
+        yield self.dispatch_command(
+            'mset', items=dict(('key%d' % i, i) for i in range(25)))
+        self.assertEqual(
+            (yield self.scan_all(count=3)),
+            sorted('key%d' % i for i in range(25)))
+
+    @inlineCallbacks
+    def test_handle_scan_match(self):
+        yield self.dispatch_command(
+            'mset', items={'user:1': 'a', 'user:2': 'b', 'other': 'c'})
+        self.assertEqual(
+            (yield self.scan_all(match='user:*')), ['user:1', 'user:2'])
+
+    @inlineCallbacks
+    def test_handle_scan_bad_args(self):
+        reply = yield self.dispatch_command('scan', cursor=1)
+        self.check_reply(
+            reply, success=False, reason="cursor must be a string or null")
+        reply = yield self.dispatch_command('scan', count=0)
+        self.check_reply(
+            reply, success=False, reason="count must be a positive number")
+        reply = yield self.dispatch_command('scan', match=None)
+        self.check_reply(reply, success=False, reason="match must be a string")
+
+    def test_scan_max_count(self):
+        self.assertEqual(
+            self.resource._scan_args({'count': 1000}), (None, 100, '*'))
+
+    @inlineCallbacks
+    def test_atomic_writes_require_scripting(self):
+        resource = RedisResource(self.resource_name, self.app_worker, {
+            'atomic_writes': True,
+            'redis_manager': {'FAKE_REDIS': FakeRedis(async=True)},
+        })
+        try:
+            yield resource.setup()
+        except ConfigError, e:
+            self.assertEqual(
+                str(e),
+                "atomic_writes requires a Redis client that supports EVALSHA")
+        else:
+            self.fail("Expected ConfigError")
+
+
+class TestRedisResourceAtomicWrites(TestRedisResource):
+    """
+    Runs all the RedisResource tests with ``atomic_writes`` enabled.
+    """
+
+    @inlineCallbacks
+    def setUp(self):
+        yield ResourceTestCaseBase.setUp(self)
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.r_server = yield self.persistence_helper.get_redis_manager(
+            scripting_redis_config(self.persistence_helper))
+        yield self.create_resource({})
+
+    def create_resource(self, config):
+        config.setdefault('atomic_writes', True)
+        return super(TestRedisResourceAtomicWrites, self).create_resource(
+            config)
+
+    @inlineCallbacks
+    def test_script_loaded_once(self):
+        skip_with_real_redis()
+        yield self.dispatch_command('set', key='foo', value='bar')
+        yield self.dispatch_command('set', key='foo', value='baz')
+        self.assertEqual(
+            self.r_server._client.script_calls,
+            ['evalsha', 'eval', 'evalsha'])
+        yield self.check_metric('foo', json.dumps('baz'), 1)
+
+    @inlineCallbacks
+    def test_mset_uses_script(self):
+        skip_with_real_redis()
+        yield self.create_metric('foo', json.dumps('old'))
+        reply = yield self.dispatch_command(
+            'mset', items={'foo': 'bar', 'baz': 'quux'})
+        self.check_reply(reply, success=True)
+        self.assertEqual(
+            self.r_server._client.script_calls, ['evalsha', 'eval'])
+        yield self.check_metric('foo', json.dumps('bar'), 2)
+        yield self.check_metric('baz', json.dumps('quux'), 2)
+
+
+class TestRedisResourceBatchedGets(TestRedisResource):
+    """
+    Runs all the RedisResource tests with ``batch_gets`` enabled.
+    """
+
+    @inlineCallbacks
+    def setUp(self):
+        yield ResourceTestCaseBase.setUp(self)
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        config = self.persistence_helper.mk_config({})['redis_manager'].copy()
+        config['FAKE_REDIS'] = MGetFakeRedis(async=True)
+        self.r_server = yield self.persistence_helper.get_redis_manager(
+            config)
+        yield self.create_resource({})
+
+    def create_resource(self, config):
+        config.setdefault('batch_gets', True)
+        return super(TestRedisResourceBatchedGets, self).create_resource(
+            config)
+
+    @inlineCallbacks
+    def test_gets_batched_into_mget(self):
+        skip_with_real_redis()
+        yield self.create_metric('foo', json.dumps('bar'), total_count=2)
+        yield self.r_server.set('sandboxes#other_id#foo', json.dumps('baz'))
+        other_api = self.app_worker.create_sandbox_api()
+        self.app_worker.create_sandbox_protocol('other_id', other_api)
+        replies = yield gatherResults([
+            self.dispatch_command('get', key='foo'),
+            self.dispatch_command('get', key='missing'),
+            self.resource.dispatch_request(
+                other_api, SandboxCommand(cmd='get', key='foo')),
+        ])
+        self.check_reply(replies[0], success=True, value='bar')
+        self.check_reply(replies[1], success=True, value=None)
+        self.check_reply(replies[2], success=True, value='baz')
+        [keys] = self.r_server._client.mget_calls
+        self.assertEqual(len(keys), 3)
+
+    @inlineCallbacks
+    def test_teardown_flushes_pending_gets(self):
+        yield self.create_metric('foo', json.dumps('bar'))
+        d = self.dispatch_command('get', key='foo')
+        yield self.resource.teardown()
+        reply = yield d
+        self.check_reply(reply, success=True, value='bar')
+
+
+class TestRedisResourceCached(TestRedisResource):
+    """
+    Runs all the RedisResource tests with the ``get`` cache enabled.
+    """
+
+    @inlineCallbacks
+    def setUp(self):
+        yield ResourceTestCaseBase.setUp(self)
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        config = self.persistence_helper.mk_config({})['redis_manager'].copy()
+        config['FAKE_REDIS'] = PublishingFakeRedis(async=True)
+        self.r_server = yield self.persistence_helper.get_redis_manager(
+            config)
+        self.patch(
+            RedisResource, 'connect_cache_subscriber',
+            lambda resource, shard: CacheInvalidationFactory(
+                resource, resource.cache_channel))
+        yield self.create_resource({})
+
+    def create_resource(self, config):
+        config.setdefault('cache_max_bytes', 1024)
+        config.setdefault('metrics_prefix', 'kv')
+        return super(TestRedisResourceCached, self).create_resource(config)
+
+    def stats(self):
+        return dict((name, value)
+                    for name, _agg, value in self.resource.stats.collect())
+
+    @inlineCallbacks
+    def assert_cached_get(self, key, expected):
+        """
+        Change the key behind the cache's back and check that ``get``
+        still returns ``expected``.
+        """
+        yield self.r_server.set('sandboxes#test_id#' + key, json.dumps('new'))
+        reply = yield self.dispatch_command('get', key=key)
+        self.check_reply(reply, success=True, value=expected)
+
+    @inlineCallbacks
+    def test_get_cached(self):
+        yield self.create_metric('foo', json.dumps('bar'))
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value='bar')
+        yield self.assert_cached_get('foo', 'bar')
+        self.assertEqual(self.stats(), {'cache.hits': 1, 'cache.misses': 1})
+
+    @inlineCallbacks
+    def test_missing_keys_not_cached(self):
+        yield self.dispatch_command('get', key='foo')
+        yield self.assert_cached_get('foo', 'new')
+
+    @inlineCallbacks
+    def test_cache_ttl(self):
+        yield self.create_resource({'cache_ttl': 0})
+        yield self.create_metric('foo', json.dumps('bar'))
+        yield self.dispatch_command('get', key='foo')
+        yield self.assert_cached_get('foo', 'new')
+
+    @inlineCallbacks
+    def test_cache_evictions(self):
+        yield self.create_resource({'cache_max_bytes': 40})
+        yield self.create_metric('foo', json.dumps('bar'))
+        yield self.create_metric('baz', json.dumps('quux'))
+        yield self.dispatch_command('get', key='foo')
+        yield self.dispatch_command('get', key='baz')
+        self.assertEqual(self.stats(), {
+            'cache.misses': 2, 'cache.evictions': 1})
+        yield self.assert_cached_get('foo', 'new')
+
+    @inlineCallbacks
+    def assert_write_invalidates(self, cmd, **kw):
+        yield self.create_metric('foo', '1')
+        yield self.dispatch_command('get', key='foo')
+        yield self.dispatch_command(cmd, **kw)
+        yield self.assert_cached_get('foo', 'new')
+
+    def test_set_invalidates(self):
+        return self.assert_write_invalidates('set', key='foo', value=2)
+
+    def test_incr_invalidates(self):
+        return self.assert_write_invalidates('incr', key='foo')
+
+    def test_delete_invalidates(self):
+        return self.assert_write_invalidates('delete', key='foo')
+
+    def test_mset_invalidates(self):
+        return self.assert_write_invalidates('mset', items={'foo': 2})
+
+    def test_mdelete_invalidates(self):
+        return self.assert_write_invalidates('mdelete', keys=['foo'])
+
+    @inlineCallbacks
+    def test_invalidation_channel_publish(self):
+        skip_with_real_redis()
+        yield self.create_resource({'cache_invalidation_channel': 'kv-inv'})
+        yield self.dispatch_command('set', key='foo', value='bar')
+        self.assertEqual(
+            self.r_server._client.published,
+            [(self.r_server._key('kv-inv'), 'sandboxes#test_id#foo')])
+
+    @inlineCallbacks
+    def test_invalidation_channel_subscribe(self):
+        yield self.create_resource({'cache_invalidation_channel': 'kv-inv'})
+        yield self.create_metric('foo', json.dumps('bar'))
+        yield self.dispatch_command('get', key='foo')
+        subscriber = CacheInvalidationSubscriber()
+        subscriber.factory = (
+            self.resource.shards['default'].cache_subscriber)
+        subscriber.messageReceived('kv-inv', u'sandboxes#test_id#foo')
+        yield self.assert_cached_get('foo', 'new')
+
+    @inlineCallbacks
+    def test_invalidation_channel_subscribe_non_ascii_key(self):
+        yield self.create_resource({'cache_invalidation_channel': 'kv-inv'})
+        yield self.create_metric(u'caf\xe9', json.dumps('bar'))
+        yield self.dispatch_command('get', key=u'caf\xe9')
+        subscriber = CacheInvalidationSubscriber()
+        subscriber.factory = (
+            self.resource.shards['default'].cache_subscriber)
+        subscriber.messageReceived(
+            'kv-inv', u'sandboxes#test_id#caf\xe9'.encode('utf-8'))
+        yield self.assert_cached_get(u'caf\xe9', 'new')
+
+
+class TestCacheSubscriberConnection(VumiTestCase):
+
+    def setUp(self):
+        self.reactor = MemoryReactor()
+        self.patch(kv, 'reactor', self.reactor)
+        self.resource = RedisResource('kv', None, {})
+        self.resource.cache_channel = 'kv-inv'
+
+    def test_connect_cache_subscriber(self):
+        redis = TxRedisManager(object(), {}, key_prefix='prefix')
+        shard = KvShard('default', {
+            'host': 'redis.example.com', 'port': 6380, 'password': 'secret',
+            'db': 2, 'key_prefix': 'prefix'}, redis)
+        factory = self.resource.connect_cache_subscriber(shard)
+        [(host, port, connected, _timeout, _bind)] = self.reactor.tcpClients
+        self.assertEqual((host, port), ('redis.example.com', 6380))
+        self.assertIdentical(connected, factory)
+        self.assertEqual(factory.channel, 'prefix:kv-inv')
+        self.assertEqual(factory._kwargs, {'password': 'secret', 'db': 2})
+
+    def test_connect_cache_subscriber_fake_redis(self):
+        redis = TxRedisManager(FakeRedis(async=True), {}, key_prefix=None)
+        shard = KvShard('default', {'FAKE_REDIS': redis._client}, redis)
+        self.assertEqual(self.resource.connect_cache_subscriber(shard), None)
+        self.assertEqual(self.reactor.tcpClients, [])
+
+
+class TestIncrBuffer(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.clock = Clock()
+        self.flushed = []
+
+    def mk_buffer(self, threshold=100):
+        incr_buffer = IncrBuffer(
+            self.redis, threshold, on_flushed=self.record_flushed,
+            clock=self.clock)
+        self.add_cleanup(incr_buffer.stop)
+        return incr_buffer
+
+    def record_flushed(self, *keys):
+        self.flushed.append(sorted(keys))
+
+    @inlineCallbacks
+    def test_incr_and_flush(self):
+        incr_buffer = self.mk_buffer()
+        self.assertEqual(incr_buffer.get('foo'), None)
+        incr_buffer.track('foo', 5)
+        self.assertEqual(incr_buffer.incr('foo', 2), 7)
+        self.assertEqual(incr_buffer.incr('foo', 3), 10)
+        self.assertEqual((yield self.redis.get('foo')), None)
+        yield incr_buffer.flush()
+        self.assertEqual((yield self.redis.get('foo')), '5')
+        self.assertEqual(incr_buffer.get('foo'), 5)
+        self.assertEqual(self.flushed, [['foo']])
+
+    @inlineCallbacks
+    def test_unused_keys_forgotten(self):
+        incr_buffer = self.mk_buffer()
+        incr_buffer.track('foo', 0)
+        incr_buffer.incr('foo', 1)
+        yield incr_buffer.flush()
+        self.assertEqual(incr_buffer.get('foo'), 1)
+        yield incr_buffer.flush()
+        self.assertEqual(incr_buffer.get('foo'), None)
+
+    @inlineCallbacks
+    def test_flush_on_threshold(self):
+        incr_buffer = self.mk_buffer(threshold=3)
+        incr_buffer.track('foo', 0)
+        incr_buffer.incr('foo', 1)
+        incr_buffer.incr('foo', 1)
+        self.assertEqual((yield self.redis.get('foo')), None)
+        incr_buffer.incr('foo', 1)
+        self.assertEqual((yield self.redis.get('foo')), '3')
+
+    @inlineCallbacks
+    def test_flush_on_interval(self):
+        incr_buffer = self.mk_buffer()
+        incr_buffer.start(5)
+        incr_buffer.track('foo', 0)
+        incr_buffer.incr('foo', 2)
+        self.clock.advance(4)
+        self.assertEqual((yield self.redis.get('foo')), None)
+        self.clock.advance(1)
+        self.assertEqual((yield self.redis.get('foo')), '2')
+
+    @inlineCallbacks
+    def test_stop_flushes(self):
+        incr_buffer = self.mk_buffer()
+        incr_buffer.start(5)
+        incr_buffer.track('foo', 0)
+        incr_buffer.incr('foo', 2)
+        yield incr_buffer.stop()
+        self.assertEqual((yield self.redis.get('foo')), '2')
+
+    @inlineCallbacks
+    def test_discard(self):
+        incr_buffer = self.mk_buffer()
+        incr_buffer.track('foo', 0)
+        incr_buffer.incr('foo', 2)
+        self.assertTrue(incr_buffer.has_pending('foo', 'bar'))
+        incr_buffer.discard('foo')
+        self.assertFalse(incr_buffer.has_pending('foo'))
+        self.assertEqual(incr_buffer.get('foo'), None)
+        yield incr_buffer.flush()
+        self.assertEqual((yield self.redis.get('foo')), None)
+
+    @inlineCallbacks
+    def test_failed_write(self):
+        incr_buffer = self.mk_buffer()
+        yield self.redis.set('foo', 'a')
+        incr_buffer.track('foo', 0)
+        incr_buffer.incr('foo', 2)
+        yield incr_buffer.flush()
+        self.assertEqual(incr_buffer.get('foo'), None)
+        self.assertEqual((yield self.redis.get('foo')), 'a')
+
+
+class TestRedisResourceBufferedIncrs(TestRedisResource):
+    """
+    Runs all the RedisResource tests with ``buffer_incrs`` enabled.
+    """
+
+    def create_resource(self, config):
+        config.setdefault('buffer_incrs', True)
+        return super(TestRedisResourceBufferedIncrs, self).create_resource(
+            config)
+
+    @inlineCallbacks
+    def check_metric(self, metric, value, total_count, seconds=None):
+        yield self.resource.shards['default'].incr_buffer.flush()
+        yield super(TestRedisResourceBufferedIncrs, self).check_metric(
+            metric, value, total_count, seconds=seconds)
+
+    @inlineCallbacks
+    def test_incr_buffered(self):
+        for expected in [1, 2, 3]:
+            reply = yield self.dispatch_command('incr', key='foo')
+            self.check_reply(reply, success=True, value=expected)
+        self.assertEqual(
+            (yield self.r_server.get('sandboxes#test_id#foo')), None)
+        yield self.check_metric('foo', '3', 1)
+
+    @inlineCallbacks
+    def test_incr_existing_key_tracked_once(self):
+        yield self.create_metric('foo', '5')
+        yield self.dispatch_command('incr', key='foo')
+        yield self.r_server.set('sandboxes#test_id#foo', '10')
+        reply = yield self.dispatch_command('incr', key='foo')
+        self.check_reply(reply, success=True, value=7)
+
+    @inlineCallbacks
+    def test_get_reads_buffered_value(self):
+        yield self.create_metric('foo', '5', total_count=2)
+        yield self.create_metric('bar', '1', total_count=2)
+        yield self.dispatch_command('incr', key='foo', amount=2)
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value=7)
+        reply = yield self.dispatch_command('mget', keys=['foo', 'bar'])
+        self.check_reply(reply, success=True, values=[7, 1])
+
+    @inlineCallbacks
+    def test_set_replaces_buffered_increments(self):
+        yield self.dispatch_command('incr', key='foo', amount=2)
+        yield self.dispatch_command('set', key='foo', value=10)
+        reply = yield self.dispatch_command('incr', key='foo')
+        self.check_reply(reply, success=True, value=11)
+        yield self.check_metric('foo', '11', 1)
+
+    @inlineCallbacks
+    def test_delete_discards_buffered_increments(self):
+        yield self.dispatch_command('incr', key='foo', amount=2)
+        reply = yield self.dispatch_command('delete', key='foo')
+        self.check_reply(reply, success=True, existed=True)
+        yield self.check_metric('foo', None, 0)
+
+    @inlineCallbacks
+    def test_teardown_flushes(self):
+        yield self.dispatch_command('incr', key='foo', amount=2)
+        yield self.resource.teardown()
+        self.assertEqual(
+            (yield self.r_server.get('sandboxes#test_id#foo')), '2')
+
+
+class TestHashRedisResource(ResourceTestCaseBase):
+
+    resource_cls = HashRedisResource
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestHashRedisResource, self).setUp()
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.r_server = yield self.persistence_helper.get_redis_manager(
+            scripting_redis_config(self.persistence_helper))
+        self.clock = Clock()
+        self.patch(HashRedisResource, 'clock', self.clock)
+        yield self.create_resource({})
+
+    def create_resource(self, config):
+        config.setdefault('redis_manager', {
+            'FAKE_REDIS': self.r_server,
+            'key_prefix': self.r_server._key_prefix,
+        })
+        return super(TestHashRedisResource, self).create_resource(config)
+
+    @inlineCallbacks
+    def set_fields(self, total_count=None, **values):
+        for key, value in values.iteritems():
+            yield self.r_server.hset('kv#test_id', key, json.dumps(value))
+        for i in range(len(values), total_count or 0):
+            yield self.r_server.hset('kv#test_id', 'filler%d' % i, '0')
+
+    @inlineCallbacks
+    def check_fields(self, total_count, **values):
+        self.assertEqual((yield self.r_server.hlen('kv#test_id')), total_count)
+        for key, value in values.iteritems():
+            raw_value = yield self.r_server.hget('kv#test_id', key)
+            self.assertEqual(
+                json.loads(raw_value) if raw_value is not None else None,
+                value)
+
+    def assert_api_log(self, expected_level, expected_message):
+        [(level, message)] = self.api.logs
+        self.assertEqual(level, expected_level)
+        self.assertEqual(message, expected_message)
+
+    @inlineCallbacks
+    def test_requires_scripting(self):
+        skip_with_real_redis()
+        resource = HashRedisResource(self.resource_name, self.app_worker, {
+            'redis_manager': {'FAKE_REDIS': FakeRedis(async=True)},
+        })
+        try:
+            yield resource.setup()
+        except ConfigError, e:
+            self.assertEqual(
+                str(e),
+                "HashRedisResource requires a Redis client that supports"
+                " EVALSHA")
+        else:
+            self.fail("Expected ConfigError")
+
+    @inlineCallbacks
+    def test_handle_set_and_get(self):
+        reply = yield self.dispatch_command('set', key='foo', value={'x': 1})
+        self.check_reply(reply, success=True)
+        yield self.check_fields(1, foo={'x': 1})
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value={'x': 1})
+
+    @inlineCallbacks
+    def test_handle_get_for_unknown_key(self):
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value=None)
+
+    @inlineCallbacks
+    def test_handle_set_with_bad_seconds(self):
+        reply = yield self.dispatch_command(
+            'set', key='foo', value='bar', seconds='foo')
+        self.check_reply(
+            reply, success=False, reason="seconds must be a number or null")
+        yield self.check_fields(0)
+
+    @inlineCallbacks
+    def test_handle_set_soft_limit_reached(self):
+        yield self.set_fields(total_count=80)
+        reply = yield self.dispatch_command('set', key='bar', value='bar')
+        self.check_reply(reply, success=True)
+        self.assert_api_log(
+            logging.WARNING,
+            'Redis soft limit of 80 keys reached for sandbox test_id. '
+            'Once the hard limit of 100 is reached no more keys can '
+            'be written.')
+
+    @inlineCallbacks
+    def test_handle_set_hard_limit_reached(self):
+        yield self.set_fields(total_count=99, foo='a')
+        reply = yield self.dispatch_command('set', key='bar', value='bar')
+        self.check_reply(reply, success=False, reason='Too many keys')
+        reply = yield self.dispatch_command('set', key='foo', value='b')
+        self.check_reply(reply, success=True)
+        yield self.check_fields(99, foo='b', bar=None)
+
+    @inlineCallbacks
+    def test_expiry(self):
+        self.clock.advance(1000)
+        yield self.dispatch_command('set', key='foo', value='bar', seconds=5)
+        self.clock.advance(4)
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value='bar')
+        self.clock.advance(1)
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value=None)
+        reply = yield self.dispatch_command('mget', keys=['foo'])
+        self.check_reply(reply, success=True, values=[None])
+
+    @inlineCallbacks
+    def test_expired_keys_not_counted(self):
+        yield self.set_fields(total_count=98)
+        yield self.dispatch_command('set', key='foo', value='bar', seconds=5)
+        self.clock.advance(5)
+        reply = yield self.dispatch_command('set', key='baz', value='quux')
+        self.check_reply(reply, success=True)
+        yield self.check_fields(99, foo=None, baz='quux')
+
+    @inlineCallbacks
+    def test_handle_bad_key(self):
+        for cmd in ['set', 'get', 'delete', 'incr']:
+            reply = yield self.dispatch_command(cmd, value='bar')
+            self.check_reply(
+                reply, success=False, reason="key must be a string")
+        yield self.check_fields(0)
+
+    @inlineCallbacks
+    def test_handle_incr_bad_amount(self):
+        reply = yield self.dispatch_command('incr', key='foo', amount=1.5)
+        self.check_reply(
+            reply, success=False, reason="amount must be an integer")
+        yield self.check_fields(0)
+
+    @inlineCallbacks
+    def test_set_without_expiry_clears_expiry(self):
+        yield self.dispatch_command('set', key='foo', value='bar', seconds=5)
+        yield self.dispatch_command('set', key='foo', value='baz')
+        self.clock.advance(5)
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value='baz')
+
+    @inlineCallbacks
+    def test_expired_key_replaced(self):
+        yield self.dispatch_command('set', key='foo', value=5, seconds=5)
+        self.clock.advance(5)
+        reply = yield self.dispatch_command('incr', key='foo')
+        self.check_reply(reply, success=True, value=1)
+        reply = yield self.dispatch_command('delete', key='foo')
+        self.check_reply(reply, success=True, existed=True)
+
+    @inlineCallbacks
+    def test_sweep_expired(self):
+        yield self.dispatch_command('set', key='foo', value='bar', seconds=5)
+        yield self.dispatch_command('set', key='baz', value='quux', seconds=10)
+        yield self.dispatch_command('set', key='keep', value='me')
+        self.assertEqual((yield self.resource.sweep_expired()), 0)
+        self.clock.advance(5)
+        self.assertEqual((yield self.resource.sweep_expired()), 1)
+        yield self.check_fields(2, baz='quux', keep='me')
+        self.assertEqual(
+            (yield self.r_server.smembers('kv-expiring')), set(['test_id']))
+        self.clock.advance(5)
+        self.assertEqual((yield self.resource.sweep_expired()), 1)
+        yield self.check_fields(1, keep='me')
+        self.assertEqual((yield self.r_server.smembers('kv-expiring')), set())
+
+    @inlineCallbacks
+    def test_sweep_script_in_redis(self):
+        skip_without_real_redis()
+        yield self.dispatch_command('set', key='foo', value='bar', seconds=5)
+        yield self.dispatch_command('set', key='baz', value='quux', seconds=6)
+        yield self.dispatch_command('set', key='keep', value='me')
+        keys = self.resource._script_keys('test_id')
+        now = self.clock.seconds()
+        removed = yield HASH_SWEEP_SCRIPT(
+            self.r_server, keys, [now + 10, 'test_id', 1])
+        self.assertEqual(removed, 1)
+        yield self.check_fields(2, foo=None, keep='me')
+        self.assertEqual(
+            (yield self.r_server.smembers('kv-expiring')), set(['test_id']))
+        removed = yield HASH_SWEEP_SCRIPT(
+            self.r_server, keys, [now + 10, 'test_id', 100])
+        self.assertEqual(removed, 1)
+        yield self.check_fields(1, baz=None, keep='me')
+        self.assertEqual(
+            (yield self.r_server.smembers('kv-expiring')), set())
+        self.assertEqual((yield self.r_server.zcard('kv-expiry#test_id')), 0)
+
+    @inlineCallbacks
+    def test_sweep_on_interval(self):
+        sweeps = []
+        self.patch(HashRedisResource, 'sweep_expired',
+                   lambda resource: sweeps.append(resource))
+        yield self.create_resource({'expiry_sweep_interval': 10})
+        self.clock.advance(9)
+        self.assertEqual(sweeps, [])
+        self.clock.advance(1)
+        self.assertEqual(sweeps, [self.resource])
+
+    @inlineCallbacks
+    def test_handle_delete(self):
+        yield self.set_fields(foo='bar')
+        reply = yield self.dispatch_command('delete', key='foo')
+        self.check_reply(reply, success=True, existed=True)
+        reply = yield self.dispatch_command('delete', key='foo')
+        self.check_reply(reply, success=True, existed=False)
+        yield self.check_fields(0)
+
+    @inlineCallbacks
+    def test_handle_incr(self):
+        reply = yield self.dispatch_command('incr', key='foo', amount=2)
+        self.check_reply(reply, success=True, value=2)
+        reply = yield self.dispatch_command('incr', key='foo')
+        self.check_reply(reply, success=True, value=3)
+        yield self.check_fields(1, foo=3)
+
+    @inlineCallbacks
+    def test_handle_incr_existing_non_int(self):
+        yield self.set_fields(foo='a')
+        reply = yield self.dispatch_command('incr', key='foo')
+        self.check_reply(reply, success=False)
+        self.assertTrue(reply['reason'])
+        yield self.check_fields(1, foo='a')
+
+    @inlineCallbacks
+    def test_handle_incr_hard_limit_reached(self):
+        yield self.set_fields(total_count=100)
+        reply = yield self.dispatch_command('incr', key='bar')
+        self.check_reply(reply, success=False, reason='Too many keys')
+        yield self.check_fields(100, bar=None)
+
+    @inlineCallbacks
+    def test_handle_mget(self):
+        yield self.set_fields(foo='bar', baz=[1, 2])
+        reply = yield self.dispatch_command(
+            'mget', keys=['foo', 'missing', 'baz'])
+        self.check_reply(reply, success=True, values=['bar', None, [1, 2]])
+        reply = yield self.dispatch_command('mget', keys=[])
+        self.check_reply(reply, success=True, values=[])
+
+    @inlineCallbacks
+    def test_handle_mset(self):
+        yield self.set_fields(foo='old')
+        reply = yield self.dispatch_command(
+            'mset', items={'foo': 'bar', 'baz': {'x': 1}})
+        self.check_reply(reply, success=True)
+        yield self.check_fields(2, foo='bar', baz={'x': 1})
+
+    @inlineCallbacks
+    def test_handle_mset_hard_limit_reached(self):
+        yield self.set_fields(total_count=99, foo='a')
+        reply = yield self.dispatch_command(
+            'mset', items={'foo': 'b', 'bar': 'c'})
+        self.check_reply(reply, success=False, reason='Too many keys')
+        yield self.check_fields(99, foo='a', bar=None)
+
+    @inlineCallbacks
+    def test_handle_mdelete(self):
+        yield self.set_fields(foo='bar', baz='quux')
+        reply = yield self.dispatch_command(
+            'mdelete', keys=['foo', 'missing', 'baz'])
+        self.check_reply(reply, success=True, existed=[True, False, True])
+        yield self.check_fields(0)
+
+    @inlineCallbacks
+    def test_handle_mdelete_bad_keys(self):
+        reply = yield self.dispatch_command('mdelete', keys=[1])
+        self.check_reply(
+            reply, success=False, reason="keys must be a list of strings")
+
+    @inlineCallbacks
+    def scan_all(self, **kw):
+        keys = []
+        cursor = None
+        while True:
+            reply = yield self.dispatch_command('scan', cursor=cursor, **kw)
+            self.check_reply(reply, success=True)
+            keys.extend(reply['keys'])
+            cursor = reply['cursor']
+            if cursor is None:
+                break
+        returnValue(sorted(set(keys)))
+
+    @inlineCallbacks
+    def test_handle_scan(self):
+        yield self.dispatch_command(
+            'mset', items=dict(('key%d' % i, i) for i in range(25)))
+        self.assertEqual(
+            (yield self.scan_all(count=3)),
+            sorted('key%d' % i for i in range(25)))
+        self.assertEqual((yield self.scan_all(match='key1*')), [
+            'key1', 'key10', 'key11', 'key12', 'key13', 'key14', 'key15',
+            'key16', 'key17', 'key18', 'key19'])
+
+    @inlineCallbacks
+    def test_handle_scan_skips_expired(self):
+        yield self.dispatch_command('set', key='foo', value=1, seconds=5)
+        yield self.dispatch_command('set', key='bar', value=2)
+        self.clock.advance(5)
+        self.assertEqual((yield self.scan_all()), ['bar'])
+
+    @inlineCallbacks
+    def test_compressed_values(self):
+        yield self.create_resource({'compress_threshold': 100})
+        yield self.dispatch_command('set', key='foo', value='x' * 1000)
+        raw_value = yield self.r_server.hget('kv#test_id', 'foo')
+        self.assertTrue(raw_value.startswith("\x00z"))
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value='x' * 1000)
+
+
+class TestRedisResourceCompressed(TestRedisResource):
+    """
+    Runs all the RedisResource tests with every written value compressed.
+    """
+
+    def create_resource(self, config):
+        config.setdefault('compress_threshold', 1)
+        config.setdefault('metrics_prefix', 'kv')
+        return super(TestRedisResourceCompressed, self).create_resource(
+            config)
+
+    @inlineCallbacks
+    def check_metric(self, metric, value, total_count, seconds=None):
+        metric_key = 'sandboxes#test_id#' + metric
+        raw_value = yield self.r_server.get(metric_key)
+        if raw_value is not None and raw_value.startswith("\x00z"):
+            yield self.r_server.set(metric_key, zlib.decompress(raw_value[2:]))
+            if seconds is not None:
+                yield self.r_server.expire(metric_key, seconds)
+        yield super(TestRedisResourceCompressed, self).check_metric(
+            metric, value, total_count, seconds=seconds)
+
+    def stats(self):
+        return dict((name, value)
+                    for name, _agg, value in self.resource.stats.collect())
+
+    @inlineCallbacks
+    def test_compress_large_values(self):
+        yield self.create_resource({'compress_threshold': 100})
+        large_value = 'x' * 1000
+        yield self.dispatch_command('set', key='small', value='y')
+        yield self.dispatch_command('set', key='large', value=large_value)
+        self.assertEqual(
+            (yield self.r_server.get('sandboxes#test_id#small')), '"y"')
+        raw_value = yield self.r_server.get('sandboxes#test_id#large')
+        self.assertTrue(raw_value.startswith("\x00z"))
+        self.assertTrue(len(raw_value) < 100)
+        reply = yield self.dispatch_command('get', key='large')
+        self.check_reply(reply, success=True, value=large_value)
+        reply = yield self.dispatch_command('mget', keys=['small', 'large'])
+        self.check_reply(reply, success=True, values=['y', large_value])
+
+    @inlineCallbacks
+    def test_compression_metrics(self):
+        yield self.dispatch_command('set', key='foo', value='x' * 1000)
+        yield self.dispatch_command('get', key='foo')
+        stats = self.stats()
+        self.assertEqual(stats['compression.bytes_in'], 1002)
+        self.assertTrue(stats['compression.bytes_out'] < 100)
+        self.assertEqual(stats['compression.compress_time.count'], 1)
+        self.assertEqual(stats['compression.decompress_time.count'], 1)
+
+    @inlineCallbacks
+    def test_read_uncompressed_values(self):
+        yield self.create_metric('foo', json.dumps('bar'))
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value='bar')
+
+
+class TestRedisResourceRawJSON(JsonRepliesMixin, TestRedisResource):
+    """
+    Runs all the RedisResource tests with ``raw_json_values`` enabled.
+    """
+
+    def create_resource(self, config):
+        config.setdefault('raw_json_values', True)
+        return super(TestRedisResourceRawJSON, self).create_resource(config)
+
+    @inlineCallbacks
+    def test_raw_json_stored_as_sent(self):
+        command = SandboxCommand.from_json(
+            '{"cmd": "set", "cmd_id": "1", "reply": false,'
+            ' "key": "foo", "value": {"a": 1.50}}')
+        yield self.resource.dispatch_request(self.api, command)
+        yield self.check_metric('foo', '{"a": 1.50}', 1)
+
+    @inlineCallbacks
+    def test_raw_json_replies(self):
+        yield self.create_metric('foo', '{"a": 1.50}')
+        command = SandboxCommand(cmd='get', key='foo')
+        reply = yield self.resource.dispatch_request(self.api, command)
+        self.assertTrue(isinstance(reply['value'], RawJSON))
+        self.assertTrue(reply.to_json().endswith(', "value": {"a": 1.50}}'))
+        command = SandboxCommand(cmd='mget', keys=['foo', 'bar'])
+        reply = yield self.resource.dispatch_request(self.api, command)
+        self.assertTrue(reply.to_json().endswith(
+            ', "values": [{"a": 1.50}, null]}'))
+
+
+class TestHashRedisResourceRawJSON(JsonRepliesMixin, TestHashRedisResource):
+    """
+    Runs all the HashRedisResource tests with ``raw_json_values`` enabled.
+    """
+
+    def create_resource(self, config):
+        config.setdefault('raw_json_values', True)
+        return super(TestHashRedisResourceRawJSON, self).create_resource(
+            config)
+
+
+class TestRedisResourceReplicas(ResourceTestCaseBase):
+
+    resource_cls = RedisResource
+
+    @inlineCallbacks
+    def setUp(self):
+        # Replicas share the backend's key prefix, so they need servers of
+        # their own.
+        skip_with_real_redis()
+        yield super(TestRedisResourceReplicas, self).setUp()
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.r_server = yield self.persistence_helper.get_redis_manager()
+        self.replicas = []
+        for i in range(2):
+            config = self.persistence_helper.mk_config(
+                {})['redis_manager'].copy()
+            config['FAKE_REDIS'] = FakeRedis(async=True)
+            self.replicas.append(
+                (yield self.persistence_helper.get_redis_manager(config)))
+        self.clock = Clock()
+        self.patch(RedisResource, 'clock', self.clock)
+        yield self.create_resource({})
+
+    def create_resource(self, config):
+        config.setdefault('redis_manager', {
+            'FAKE_REDIS': self.r_server,
+            'key_prefix': self.r_server._key_prefix,
+        })
+        config.setdefault('redis_replicas', [
+            {'FAKE_REDIS': replica, 'key_prefix': replica._key_prefix}
+            for replica in self.replicas])
+        return super(TestRedisResourceReplicas, self).create_resource(config)
+
+    @inlineCallbacks
+    def set_everywhere(self, key, primary, *replicas):
+        key = 'sandboxes#test_id#' + key
+        yield self.r_server.set(key, json.dumps(primary))
+        for replica, value in zip(self.replicas, replicas):
+            yield replica.set(key, json.dumps(value))
+
+    @inlineCallbacks
+    def test_reads_from_replicas_in_turn(self):
+        yield self.set_everywhere('foo', 'primary', 'replica0', 'replica1')
+        values = []
+        for i in range(4):
+            reply = yield self.dispatch_command('get', key='foo')
+            values.append(reply['value'])
+        self.assertEqual(
+            values, ['replica0', 'replica1', 'replica0', 'replica1'])
+
+    @inlineCallbacks
+    def test_mget_from_replicas(self):
+        yield self.set_everywhere('foo', 'primary', 'replica0', 'replica1')
+        yield self.replicas[1].set('sandboxes#test_id#bar', '1')
+        reply = yield self.dispatch_command('mget', keys=['foo', 'bar'])
+        self.check_reply(reply, success=True, values=['replica0', None])
+
+    @inlineCallbacks
+    def test_scan_from_primary(self):
+        keys = ['key%d' % i for i in range(10)]
+        for key in keys:
+            yield self.set_everywhere(key, 1, 1, 1)
+        # Keys other sandboxes wrote give each replica a different order.
+        for i, replica in enumerate(self.replicas):
+            for j in range(10 * (i + 1)):
+                yield replica.set('sandboxes#other%d#key%d' % (i, j), '1')
+        yield self.replicas[1].set('sandboxes#test_id#replicated', '1')
+        scanned, cursor = [], None
+        while True:
+            reply = yield self.dispatch_command(
+                'scan', cursor=cursor, count=1)
+            scanned.extend(reply['keys'])
+            cursor = reply['cursor']
+            if cursor is None:
+                break
+        self.assertEqual(sorted(scanned), keys)
+
+    @inlineCallbacks
+    def test_reads_after_writes_from_primary(self):
+        yield self.set_everywhere('foo', 'old', 'old', 'old')
+        yield self.dispatch_command('set', key='foo', value='new')
+        self.clock.advance(0.9)
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value='new')
+        reply = yield self.dispatch_command('mget', keys=['foo'])
+        self.check_reply(reply, success=True, values=['new'])
+        self.clock.advance(0.1)
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value='old')
+
+    @inlineCallbacks
+    def test_replica_lag(self):
+        yield self.create_resource({'replica_lag': 10})
+        yield self.set_everywhere('foo', 'old', 'old', 'old')
+        yield self.dispatch_command('delete', key='foo')
+        self.clock.advance(9)
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value=None)
+        self.clock.advance(1)
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value='old')
+
+    @inlineCallbacks
+    def test_old_writes_forgotten(self):
+        yield self.dispatch_command('incr', key='foo')
+        self.clock.advance(1)
+        self.resource._record_write(self.api)
+        self.assertEqual(self.resource._recent_writes.keys(), ['test_id'])
+        other_api = self.app_worker.create_sandbox_api()
+        self.app_worker.create_sandbox_protocol('other', other_api)
+        self.clock.advance(1)
+        self.resource._record_write(other_api)
+        self.assertEqual(self.resource._recent_writes.keys(), ['other'])
+
+    @inlineCallbacks
+    def test_unknown_replica_shard(self):
+        resource = RedisResource(self.resource_name, self.app_worker, {
+            'redis_manager': {'FAKE_REDIS': self.r_server},
+            'redis_replicas': {'missing': []},
+        })
+        try:
+            yield resource.setup()
+        except ConfigError, e:
+            self.assertEqual(
+                str(e), "redis_replicas names unknown shard 'missing'")
+        else:
+            self.fail("Expected ConfigError")
+
+
+class ShardedResourceMixin(object):
+    """
+    Helpers for tests of resources whose keys are sharded across two
+    Redis backends named ``a`` and ``b``.
+    """
+
+    @inlineCallbacks
+    def setup_shards(self, fake_redis_cls):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.shard_servers = {}
+        for name in ['a', 'b']:
+            config = scripting_redis_config(
+                self.persistence_helper, fake_redis_cls)
+            # A real Redis server is shared by both shards, so each one
+            # gets its own key prefix.
+            config['key_prefix'] = '%s-%s' % (config['key_prefix'], name)
+            self.shard_servers[name] = (
+                yield self.persistence_helper.get_redis_manager(config))
+
+    def create_resource(self, config):
+        config.setdefault('redis_managers', dict(
+            (name, {'FAKE_REDIS': r_server,
+                    'key_prefix': r_server._key_prefix})
+            for name, r_server in self.shard_servers.iteritems()))
+        return super(ShardedResourceMixin, self).create_resource(config)
+
+    def sandbox_on(self, name):
+        """Return the id of a sandbox whose keys live on the named shard."""
+        for i in range(100):
+            sandbox_id = "sandbox-%d" % (i,)
+            if self.resource.shard_for(sandbox_id).name == name:
+                return sandbox_id
+
+    def dispatch_as(self, sandbox_id, cmd, **kwargs):
+        api = self.app_worker.create_sandbox_api()
+        self.app_worker.create_sandbox_protocol(sandbox_id, api)
+        msg = SandboxCommand.from_json(
+            SandboxCommand(cmd=cmd, **kwargs).to_json())
+        return self.resource.dispatch_request(api, msg)
+
+
+class TestRedisResourceSharded(ShardedResourceMixin, ResourceTestCaseBase):
+
+    resource_cls = RedisResource
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestRedisResourceSharded, self).setUp()
+        yield self.setup_shards(FakeRedis)
+        yield self.create_resource({})
+
+    @inlineCallbacks
+    def test_keys_stored_on_sandbox_shard(self):
+        sb_a, sb_b = self.sandbox_on('a'), self.sandbox_on('b')
+        yield self.dispatch_as(sb_a, 'set', key='foo', value='on a')
+        yield self.dispatch_as(sb_b, 'mset', items={'foo': 'on b'})
+        yield self.dispatch_as(sb_b, 'incr', key='n', amount=2)
+        r_a, r_b = self.shard_servers['a'], self.shard_servers['b']
+        self.assertEqual(sorted((yield r_a.keys())), [
+            'count#' + sb_a, 'sandboxes#%s#foo' % (sb_a,)])
+        self.assertEqual(sorted((yield r_b.keys())), [
+            'count#' + sb_b, 'sandboxes#%s#foo' % (sb_b,),
+            'sandboxes#%s#n' % (sb_b,)])
+        reply = yield self.dispatch_as(sb_a, 'get', key='foo')
+        self.check_reply(reply, value='on a')
+        reply = yield self.dispatch_as(sb_b, 'mget', keys=['foo', 'n'])
+        self.check_reply(reply, values=['on b', 2])
+        reply = yield self.dispatch_as(sb_b, 'scan', cursor=None)
+        self.assertEqual(sorted(reply['keys']), ['foo', 'n'])
+        reply = yield self.dispatch_as(sb_a, 'delete', key='foo')
+        self.check_reply(reply, existed=True)
+        self.assertEqual((yield r_a.get('count#' + sb_a)), '0')
+
+    @inlineCallbacks
+    def test_key_limits_per_sandbox(self):
+        yield self.create_resource({'keys_per_user_hard': 2})
+        sb_a, sb_b = self.sandbox_on('a'), self.sandbox_on('b')
+        reply = yield self.dispatch_as(sb_a, 'set', key='foo', value=1)
+        self.check_reply(reply, success=True)
+        reply = yield self.dispatch_as(sb_b, 'set', key='foo', value=1)
+        self.check_reply(reply, success=True)
+        self.assertEqual((yield self.shard_servers['a'].get('count#' + sb_a)),
+                         '1')
+        reply = yield self.dispatch_as(sb_a, 'set', key='bar', value=1)
+        self.check_reply(reply, success=False, reason='Too many keys')
+
+    @inlineCallbacks
+    def test_shards_independent_of_config_order(self):
+        sandbox_ids = ["sandbox-%d" % (i,) for i in range(20)]
+        shards = [self.resource.shard_for(sandbox_id).name
+                  for sandbox_id in sandbox_ids]
+        self.assertEqual(set(shards), set(['a', 'b']))
+        yield self.create_resource({'redis_managers': {
+            'b': {'FAKE_REDIS': self.shard_servers['b']},
+            'a': {'FAKE_REDIS': self.shard_servers['a']},
+        }})
+        self.assertEqual(
+            [self.resource.shard_for(sandbox_id).name
+             for sandbox_id in sandbox_ids], shards)
+
+    @inlineCallbacks
+    def test_shard_replicas(self):
+        config = self.persistence_helper.mk_config({})['redis_manager'].copy()
+        config['FAKE_REDIS'] = FakeRedis(async=True)
+        replica = yield self.persistence_helper.get_redis_manager(config)
+        yield self.create_resource({'redis_replicas': {'a': [{
+            'FAKE_REDIS': replica, 'key_prefix': replica._key_prefix,
+        }]}})
+        sb_a, sb_b = self.sandbox_on('a'), self.sandbox_on('b')
+        yield replica.set('sandboxes#%s#foo' % (sb_a,), '"replica"')
+        yield self.shard_servers['b'].set(
+            'sandboxes#%s#foo' % (sb_b,), '"primary"')
+        reply = yield self.dispatch_as(sb_a, 'get', key='foo')
+        self.check_reply(reply, value='replica')
+        reply = yield self.dispatch_as(sb_b, 'get', key='foo')
+        self.check_reply(reply, value='primary')
+
+    def test_no_single_redis_manager(self):
+        self.assertEqual(self.resource.redis, None)
+        self.assertEqual(self.resource.r_config, None)
+
+    @inlineCallbacks
+    def test_redis_managers_must_not_be_empty(self):
+        resource = RedisResource(self.resource_name, self.app_worker, {
+            'redis_managers': {},
+        })
+        try:
+            yield resource.setup()
+        except ConfigError, e:
+            self.assertEqual(
+                str(e), "redis_managers must name at least one shard")
+        else:
+            self.fail("Expected ConfigError")
+
+
+class TestHashRedisResourceSharded(ShardedResourceMixin,
+                                  ResourceTestCaseBase):
+
+    resource_cls = HashRedisResource
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestHashRedisResourceSharded, self).setUp()
+        yield self.setup_shards(ScriptingFakeRedis)
+        self.clock = Clock()
+        self.patch(HashRedisResource, 'clock', self.clock)
+        yield self.create_resource({})
+
+    @inlineCallbacks
+    def test_keys_stored_on_sandbox_shard(self):
+        sb_a, sb_b = self.sandbox_on('a'), self.sandbox_on('b')
+        yield self.dispatch_as(sb_a, 'set', key='foo', value='on a')
+        yield self.dispatch_as(sb_b, 'incr', key='n', amount=2)
+        self.assertEqual(
+            (yield self.shard_servers['a'].hgetall('kv#' + sb_a)),
+            {'foo': json.dumps('on a')})
+        self.assertEqual(
+            (yield self.shard_servers['b'].hgetall('kv#' + sb_b)),
+            {'n': '2'})
+        reply = yield self.dispatch_as(sb_a, 'get', key='foo')
+        self.check_reply(reply, value='on a')
+        reply = yield self.dispatch_as(sb_b, 'get', key='n')
+        self.check_reply(reply, value=2)
+
+    @inlineCallbacks
+    def test_sweep_expired_on_all_shards(self):
+        sb_a, sb_b = self.sandbox_on('a'), self.sandbox_on('b')
+        yield self.dispatch_as(sb_a, 'set', key='foo', value=1, seconds=5)
+        yield self.dispatch_as(sb_b, 'set', key='foo', value=1, seconds=5)
+        self.clock.advance(5)
+        self.assertEqual((yield self.resource.sweep_expired()), 2)
+        for name, sandbox_id in [('a', sb_a), ('b', sb_b)]:
+            r_server = self.shard_servers[name]
+            self.assertEqual((yield r_server.hgetall('kv#' + sandbox_id)), {})
+            self.assertEqual((yield r_server.smembers('kv-expiring')), set())
+
+
+class TestGlobEscape(VumiTestCase):
+
+    def test_glob_escape(self):
+        self.assertEqual(glob_escape("plain#id"), "plain#id")
+        self.assertEqual(
+            glob_escape("a*b?c[d]e\\f"), "a\\*b\\?c\\[d\\]e\\\\f")
@@ -0,0 +1,369 @@
+"""Tests for vxsandbox.resources.sqlite_kv."""
+
+import json
+import logging
+import sqlite3
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock
+
+from vxsandbox.resources.sqlite_kv import SqliteKvResource
+from vxsandbox.resources.tests.utils import (
+    ResourceTestCaseBase, JsonRepliesMixin)
+
+
+class TestSqliteKvResource(ResourceTestCaseBase):
+
+    resource_cls = SqliteKvResource
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestSqliteKvResource, self).setUp()
+        self.clock = Clock()
+        self.patch(SqliteKvResource, 'clock', self.clock)
+        yield self.create_resource({})
+
+    def set_keys(self, total_count=None, **values):
+        rows = [(key, json.dumps(value)) for key, value in values.iteritems()]
+        rows.extend(('filler%d' % i, '0')
+                    for i in range(len(values), total_count or 0))
+        self.resource.db.executemany(
+            "INSERT INTO kv (sandbox_id, key, value) VALUES ('test_id', ?, ?)",
+            [(key, sqlite3.Binary(value)) for key, value in rows])
+
+    def check_keys(self, total_count, **values):
+        rows = dict(self.resource.db.execute(
+            "SELECT key, value FROM kv WHERE sandbox_id = 'test_id'"))
+        self.assertEqual(len(rows), total_count)
+        for key, value in values.iteritems():
+            raw_value = rows.get(key)
+            self.assertEqual(
+                json.loads(str(raw_value)) if raw_value is not None else None,
+                value)
+
+    def assert_api_log(self, expected_level, expected_message):
+        [(level, message)] = self.api.logs
+        self.assertEqual(level, expected_level)
+        self.assertEqual(message, expected_message)
+
+    @inlineCallbacks
+    def test_handle_set_and_get(self):
+        reply = yield self.dispatch_command('set', key='foo', value={'x': 1})
+        self.check_reply(reply, success=True)
+        self.check_keys(1, foo={'x': 1})
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value={'x': 1})
+
+    @inlineCallbacks
+    def test_handle_get_for_unknown_key(self):
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value=None)
+
+    @inlineCallbacks
+    def test_handle_set_with_bad_seconds(self):
+        reply = yield self.dispatch_command(
+            'set', key='foo', value='bar', seconds='foo')
+        self.check_reply(
+            reply, success=False, reason="seconds must be a number or null")
+        self.check_keys(0)
+
+    @inlineCallbacks
+    def test_handle_set_soft_limit_reached(self):
+        self.set_keys(total_count=80)
+        reply = yield self.dispatch_command('set', key='bar', value='bar')
+        self.check_reply(reply, success=True)
+        self.assert_api_log(
+            logging.WARNING,
+            'Redis soft limit of 80 keys reached for sandbox test_id. '
+            'Once the hard limit of 100 is reached no more keys can '
+            'be written.')
+
+    @inlineCallbacks
+    def test_handle_set_hard_limit_reached(self):
+        self.set_keys(total_count=99, foo='a')
+        reply = yield self.dispatch_command('set', key='bar', value='bar')
+        self.check_reply(reply, success=False, reason='Too many keys')
+        reply = yield self.dispatch_command('set', key='foo', value='b')
+        self.check_reply(reply, success=True)
+        self.check_keys(99, foo='b', bar=None)
+
+    @inlineCallbacks
+    def test_expiry(self):
+        self.clock.advance(1000)
+        yield self.dispatch_command('set', key='foo', value='bar', seconds=5)
+        self.clock.advance(4)
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value='bar')
+        self.clock.advance(1)
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value=None)
+        reply = yield self.dispatch_command('mget', keys=['foo'])
+        self.check_reply(reply, success=True, values=[None])
+
+    @inlineCallbacks
+    def test_set_without_expiry_clears_expiry(self):
+        yield self.dispatch_command('set', key='foo', value='bar', seconds=5)
+        yield self.dispatch_command('set', key='foo', value='baz')
+        self.clock.advance(5)
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value='baz')
+
+    @inlineCallbacks
+    def test_expired_keys_not_counted(self):
+        self.set_keys(total_count=98)
+        yield self.dispatch_command('set', key='foo', value=1, seconds=5)
+        reply = yield self.dispatch_command('set', key='bar', value=1)
+        self.check_reply(reply, success=False, reason='Too many keys')
+        self.clock.advance(5)
+        reply = yield self.dispatch_command('set', key='bar', value=1)
+        self.check_reply(reply, success=True)
+        self.check_keys(99, foo=None, bar=1)
+
+    @inlineCallbacks
+    def test_expired_key_replaced(self):
+        yield self.dispatch_command('set', key='foo', value=5, seconds=5)
+        self.clock.advance(5)
+        reply = yield self.dispatch_command('incr', key='foo')
+        self.check_reply(reply, success=True, value=1)
+        reply = yield self.dispatch_command('delete', key='foo')
+        self.check_reply(reply, success=True, existed=True)
+
+    @inlineCallbacks
+    def test_sweep_expired(self):
+        yield self.dispatch_command('set', key='foo', value='bar', seconds=5)
+        yield self.dispatch_command('set', key='keep', value='me')
+        self.assertEqual(self.resource.sweep_expired(), 0)
+        self.clock.advance(5)
+        self.assertEqual(self.resource.sweep_expired(), 1)
+        self.check_keys(1, keep='me')
+
+    @inlineCallbacks
+    def test_sweep_on_interval(self):
+        sweeps = []
+        self.patch(SqliteKvResource, 'sweep_expired',
+                   lambda resource: sweeps.append(resource))
+        yield self.create_resource({'expiry_sweep_interval': 10})
+        self.clock.advance(9)
+        self.assertEqual(sweeps, [])
+        self.clock.advance(1)
+        self.assertEqual(sweeps, [self.resource])
+
+    @inlineCallbacks
+    def test_handle_delete(self):
+        self.set_keys(foo='bar')
+        reply = yield self.dispatch_command('delete', key='foo')
+        self.check_reply(reply, success=True, existed=True)
+        reply = yield self.dispatch_command('delete', key='foo')
+        self.check_reply(reply, success=True, existed=False)
+        self.check_keys(0)
+
+    @inlineCallbacks
+    def test_handle_incr(self):
+        reply = yield self.dispatch_command('incr', key='foo', amount=2)
+        self.check_reply(reply, success=True, value=2)
+        reply = yield self.dispatch_command('incr', key='foo')
+        self.check_reply(reply, success=True, value=3)
+        self.check_keys(1, foo=3)
+
+    @inlineCallbacks
+    def test_handle_incr_keeps_expiry(self):
+        yield self.dispatch_command('set', key='foo', value=1, seconds=5)
+        reply = yield self.dispatch_command('incr', key='foo')
+        self.check_reply(reply, success=True, value=2)
+        self.clock.advance(5)
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value=None)
+
+    @inlineCallbacks
+    def test_handle_incr_existing_non_int(self):
+        self.set_keys(foo='a')
+        reply = yield self.dispatch_command('incr', key='foo')
+        self.check_reply(
+            reply, success=False, reason="value is not an integer")
+        self.check_keys(1, foo='a')
+
+    @inlineCallbacks
+    def test_handle_bad_key(self):
+        for cmd in ['set', 'get', 'delete', 'incr']:
+            for key in [None, 5]:
+                reply = yield self.dispatch_command(cmd, key=key, value=1)
+                self.check_reply(
+                    reply, success=False, reason="key must be a string")
+        self.check_keys(0)
+
+    @inlineCallbacks
+    def test_handle_incr_bad_amount(self):
+        for amount in [1.5, '2']:
+            reply = yield self.dispatch_command(
+                'incr', key='foo', amount=amount)
+            self.check_reply(
+                reply, success=False, reason="amount must be an integer")
+        self.check_keys(0)
+
+    @inlineCallbacks
+    def test_transaction_rolled_back_on_error(self):
+        def fail():
+            with self.resource._transaction():
+                self.resource.db.execute(
+                    "INSERT INTO kv (sandbox_id, key, value)"
+                    " VALUES ('test_id', 'foo', '1')")
+                raise ValueError("oops")
+        self.assertRaises(ValueError, fail)
+        self.check_keys(0)
+        reply = yield self.dispatch_command('set', key='bar', value=1)
+        self.check_reply(reply, success=True)
+        self.check_keys(1, bar=1)
+
+    @inlineCallbacks
+    def test_handle_incr_hard_limit_reached(self):
+        self.set_keys(total_count=99)
+        reply = yield self.dispatch_command('incr', key='bar')
+        self.check_reply(reply, success=False, reason='Too many keys')
+        self.check_keys(99, bar=None)
+
+    @inlineCallbacks
+    def test_handle_mget(self):
+        self.set_keys(foo='bar', baz=[1, 2])
+        reply = yield self.dispatch_command(
+            'mget', keys=['foo', 'missing', 'baz'])
+        self.check_reply(reply, success=True, values=['bar', None, [1, 2]])
+        reply = yield self.dispatch_command('mget', keys=[])
+        self.check_reply(reply, success=True, values=[])
+
+    @inlineCallbacks
+    def test_handle_mget_many_keys(self):
+        self.set_keys(total_count=20)
+        keys = ['filler%d' % i for i in range(1200)]
+        reply = yield self.dispatch_command('mget', keys=keys)
+        self.check_reply(
+            reply, success=True, values=[0] * 20 + [None] * 1180)
+
+    @inlineCallbacks
+    def test_handle_mset(self):
+        self.set_keys(foo='old')
+        reply = yield self.dispatch_command(
+            'mset', items={'foo': 'bar', 'baz': {'x': 1}})
+        self.check_reply(reply, success=True)
+        self.check_keys(2, foo='bar', baz={'x': 1})
+
+    @inlineCallbacks
+    def test_handle_mset_hard_limit_reached(self):
+        self.set_keys(total_count=99, foo='a')
+        reply = yield self.dispatch_command(
+            'mset', items={'foo': 'b', 'bar': 'c'})
+        self.check_reply(reply, success=False, reason='Too many keys')
+        self.check_keys(99, foo='a', bar=None)
+
+    @inlineCallbacks
+    def test_handle_mdelete(self):
+        self.set_keys(foo='bar', baz='quux')
+        reply = yield self.dispatch_command(
+            'mdelete', keys=['foo', 'missing', 'baz'])
+        self.check_reply(reply, success=True, existed=[True, False, True])
+        self.check_keys(0)
+
+    @inlineCallbacks
+    def test_handle_mdelete_bad_keys(self):
+        reply = yield self.dispatch_command('mdelete', keys=[1])
+        self.check_reply(
+            reply, success=False, reason="keys must be a list of strings")
+
+    @inlineCallbacks
+    def scan_all(self, **kw):
+        keys = []
+        cursor = None
+        while True:
+            reply = yield self.dispatch_command('scan', cursor=cursor, **kw)
+            self.check_reply(reply, success=True)
+            keys.extend(reply['keys'])
+            cursor = reply['cursor']
+            if cursor is None:
+                break
+        returnValue(sorted(set(keys)))
+
+    @inlineCallbacks
+    def test_handle_scan(self):
+        yield self.dispatch_command(
+            'mset', items=dict(('key%d' % i, i) for i in range(25)))
+        self.assertEqual(
+            (yield self.scan_all(count=3)),
+            sorted('key%d' % i for i in range(25)))
+        self.assertEqual((yield self.scan_all(match='key1*')), [
+            'key1', 'key10', 'key11', 'key12', 'key13', 'key14', 'key15',
+            'key16', 'key17', 'key18', 'key19'])
+
+    @inlineCallbacks
+    def test_handle_scan_skips_expired(self):
+        yield self.dispatch_command('set', key='foo', value=1, seconds=5)
+        yield self.dispatch_command('set', key='bar', value=2)
+        self.clock.advance(5)
+        self.assertEqual((yield self.scan_all()), ['bar'])
+
+    @inlineCallbacks
+    def test_handle_scan_bad_args(self):
+        reply = yield self.dispatch_command('scan', cursor=None, count=0)
+        self.check_reply(
+            reply, success=False, reason="count must be a positive number")
+
+    @inlineCallbacks
+    def test_sandboxes_separate(self):
+        self.set_keys(foo='mine')
+        self.resource.db.execute(
+            "INSERT INTO kv (sandbox_id, key, value)"
+            " VALUES ('other', 'foo', '\"theirs\"')")
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value='mine')
+        self.assertEqual((yield self.scan_all()), ['foo'])
+
+    @inlineCallbacks
+    def test_compressed_values(self):
+        yield self.create_resource({'compress_threshold': 100})
+        yield self.dispatch_command('set', key='foo', value='x' * 1000)
+        [(raw_value,)] = self.resource.db.execute("SELECT value FROM kv")
+        self.assertTrue(str(raw_value).startswith("\x00z"))
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value='x' * 1000)
+
+    @inlineCallbacks
+    def test_database_file(self):
+        database = self.mktemp()
+        yield self.create_resource({'database': database})
+        yield self.dispatch_command('set', key='foo', value='bar')
+        yield self.create_resource({'database': database})
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value='bar')
+
+
+    @inlineCallbacks
+    def test_database_locked(self):
+        database = self.mktemp()
+        yield self.create_resource(
+            {'database': database, 'lock_timeout': 0})
+        yield self.dispatch_command('set', key='foo', value='bar')
+        other = sqlite3.connect(database, isolation_level=None)
+        self.addCleanup(other.close)
+        other.execute("BEGIN IMMEDIATE")
+        reply = yield self.dispatch_command('set', key='foo', value='baz')
+        self.check_reply(reply, success=False, reason='database is locked')
+        self.assertEqual(self.resource.sweep_expired(), 0)
+        reply = yield self.dispatch_command('get', key='foo')
+        self.check_reply(reply, success=True, value='bar')
+        other.execute("ROLLBACK")
+        reply = yield self.dispatch_command('set', key='foo', value='baz')
+        self.check_reply(reply, success=True)
+
+class TestSqliteKvResourceRawJSON(JsonRepliesMixin, TestSqliteKvResource):
+    """
+    Runs all the SqliteKvResource tests with ``raw_json_values`` enabled.
+    """
+
+    def create_resource(self, config):
+        config.setdefault('raw_json_values', True)
+        return super(TestSqliteKvResourceRawJSON, self).create_resource(
+            config)
+
+    @inlineCallbacks
+    def test_raw_json_stored_as_sent(self):
+        yield self.dispatch_command('set', key='foo', value={'a': 1})
+        [(raw_value,)] = self.resource.db.execute("SELECT value FROM kv")
+        self.assertEqual(str(raw_value), '{"a": 1}')
@@ -4,12 +4,14 @@ import json
 import logging
 
 from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
 
 from vumi.tests.helpers import VumiTestCase
 from vumi.message import MissingMessageField
 
 from vxsandbox.resources.utils import (
-    SandboxCommand, SandboxResources, SandboxResource)
+    SandboxCommand, SandboxResources, SandboxResource, LRUCache, HashRing,
+    RawJSON, decode_json_fields)
 
 
 class RecordingResource(SandboxResource):
@@ -60,6 +62,29 @@ class TestSandboxCommand(VumiTestCase):
             cmd_id='123', cmd='name', reply=False,
         ))
 
+    def test_from_json_raw_json(self):
+        cmd = SandboxCommand.from_json(
+            '{"cmd_id": "123", "cmd": "name", "reply": false,'
+            ' "value": {"a": [1, 2.50]} }')
+        self.assertEqual(cmd['value'], {'a': [1, 2.5]})
+        self.assertEqual(cmd.raw_json('value'), '{"a": [1, 2.50]}')
+        self.assertEqual(cmd.raw_json('reply'), 'false')
+        self.assertEqual(cmd.raw_json('missing'), None)
+
+    def test_raw_json_without_json(self):
+        cmd = SandboxCommand(cmd='name', value=1)
+        self.assertEqual(cmd.raw_json('value'), None)
+
+    def test_to_json_raw_json(self):
+        cmd = SandboxCommand(cmd_id='123', cmd='name', reply=True,
+                             value=RawJSON('{"a": [1, 2.50]}'))
+        self.assertEqual(json.loads(cmd.to_json()), {
+            'cmd_id': '123', 'cmd': 'name', 'reply': True,
+            'value': {'a': [1, 2.5]},
+        })
+        self.assertTrue(cmd.to_json().endswith(
+            ', "value": {"a": [1, 2.50]}}'))
+
     def assert_field_missing(self, field, cmd_data):
         err = self.failUnlessRaises(
             MissingMessageField,
@@ -82,6 +107,35 @@ class TestSandboxCommand(VumiTestCase):
         })
 
 
+class TestDecodeJsonFields(VumiTestCase):
+
+    def assert_decoded(self, json_string):
+        fields, spans = decode_json_fields(json_string)
+        self.assertEqual(fields, json.loads(json_string))
+        return dict((key, json_string[start:end])
+                    for key, (start, end) in spans.iteritems())
+
+    def test_object(self):
+        self.assertEqual(
+            self.assert_decoded(
+                ' { "a" : [1, {"b": "}"}] ,"c":null,"d": "\\u00e9"} '),
+            {'a': '[1, {"b": "}"}]', 'c': 'null', 'd': '"\\u00e9"'})
+
+    def test_empty_object(self):
+        self.assertEqual(self.assert_decoded('{ }'), {})
+
+    def test_duplicate_keys(self):
+        self.assertEqual(self.assert_decoded('{"a": 1, "a": 2}'), {'a': '2'})
+
+    def test_other_values(self):
+        self.assertEqual(decode_json_fields('[1, 2]'), ([1, 2], {}))
+
+    def test_invalid(self):
+        for json_string in ['', '{', '{"a"}', '{"a": }', '{"a": 1,}',
+                            '{"a": 1 "b": 2}', '{1: 2}', '{"a": 1} x']:
+            self.assertRaises(ValueError, decode_json_fields, json_string)
+
+
 class TestSandboxResources(VumiTestCase):
     def mk_resources(self, app_worker=None, config=None):
         app_worker = app_worker or object()
@@ -286,3 +340,106 @@ class TestSandboxResource(VumiTestCase):
             " 'sandbox_uno'. Killing sandbox. [Full command:"
             " <Message payload="))
         self.assertEqual(lvl, logging.ERROR)
+
+
+class TestLRUCache(VumiTestCase):
+
+    def test_get_and_set(self):
+        cache = LRUCache(100)
+        self.assertEqual(cache.get("foo"), None)
+        cache.set("foo", "bar", 10)
+        self.assertEqual(cache.get("foo"), "bar")
+        self.assertEqual(cache.size, 10)
+        cache.set("foo", "baz", 5)
+        self.assertEqual(cache.get("foo"), "baz")
+        self.assertEqual(cache.size, 5)
+
+    def test_evict_least_recently_used(self):
+        cache = LRUCache(30)
+        cache.set("a", 1, 10)
+        cache.set("b", 2, 10)
+        cache.set("c", 3, 10)
+        cache.get("a")
+        cache.set("d", 4, 15)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("c"), None)
+        self.assertEqual(cache.get("d"), 4)
+        self.assertEqual(cache.size, 25)
+        self.assertEqual(cache.evictions, 2)
+
+    def test_too_large(self):
+        cache = LRUCache(10)
+        cache.set("a", 1, 5)
+        cache.set("b", 2, 11)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("b"), None)
+
+    def test_ttl(self):
+        clock = Clock()
+        cache = LRUCache(100, clock=clock)
+        cache.set("a", 1, 10, ttl=5)
+        cache.set("b", 2, 10)
+        clock.advance(4.9)
+        self.assertEqual(cache.get("a"), 1)
+        clock.advance(0.1)
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.get("b"), 2)
+        self.assertEqual(cache.size, 10)
+        self.assertEqual(len(cache), 1)
+
+    def test_delete_and_clear(self):
+        cache = LRUCache(100)
+        cache.set("a", 1, 10)
+        cache.set("b", 2, 10)
+        cache.delete("a")
+        cache.delete("missing")
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.size, 10)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+
+class TestHashRing(VumiTestCase):
+
+    def keys(self):
+        return ["sandbox-%d" % i for i in range(1000)]
+
+    def test_single_node(self):
+        ring = HashRing(["a"])
+        self.assertEqual(set(ring.get_node(key) for key in self.keys()),
+                         set(["a"]))
+
+    def test_no_nodes(self):
+        self.assertRaises(ValueError, HashRing, [])
+
+    def test_keys_spread_across_nodes(self):
+        ring = HashRing(["a", "b", "c"])
+        counts = {}
+        for key in self.keys():
+            node = ring.get_node(key)
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(sorted(counts), ["a", "b", "c"])
+        self.assertTrue(min(counts.values()) > 200)
+
+    def test_node_order_ignored(self):
+        ring1 = HashRing(["a", "b", "c"])
+        ring2 = HashRing(["c", "a", "b"])
+        for key in self.keys():
+            self.assertEqual(ring1.get_node(key), ring2.get_node(key))
+
+    def test_adding_node_only_moves_keys_to_it(self):
+        ring1 = HashRing(["a", "b", "c"])
+        ring2 = HashRing(["a", "b", "c", "d"])
+        moved = [key for key in self.keys()
+                 if ring1.get_node(key) != ring2.get_node(key)]
+        self.assertTrue(0 < len(moved) < 400)
+        self.assertEqual(set(ring2.get_node(key) for key in moved),
+                         set(["d"]))
+
+    def test_unicode_keys(self):
+        ring = HashRing(["a", "b"])
+        self.assertEqual(ring.get_node(u"sandbox-1"),
+                         ring.get_node("sandbox-1"))
+        self.assertTrue(ring.get_node(u"\u00e9") in ["a", "b"])
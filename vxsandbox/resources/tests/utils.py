@@ -1,4 +1,4 @@
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi.application.tests.helpers import ApplicationHelper
 from vumi.tests.helpers import VumiTestCase
@@ -52,3 +52,16 @@ class ResourceTestCaseBase(VumiTestCase):
         # msgs are loaded from JSON.
         msg = SandboxCommand.from_json(msg.to_json())
         return self.resource.dispatch_request(self.api, msg)
+
+
+class JsonRepliesMixin(object):
+    """
+    Round-trips replies through JSON, as they would be when sent to a
+    real sandbox, so that tests see decoded values.
+    """
+
+    @inlineCallbacks
+    def dispatch_command(self, cmd, **kwargs):
+        reply = yield super(JsonRepliesMixin, self).dispatch_command(
+            cmd, **kwargs)
+        returnValue(SandboxCommand.from_json(reply.to_json()))
@@ -6,12 +6,86 @@ from __future__ import absolute_import
 
 import json
 import logging
+import re
+from bisect import bisect
+from collections import OrderedDict
+from hashlib import md5
 from uuid import uuid4
 
+from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, maybeDeferred
 
 from vumi.utils import load_class_by_string, to_kwargs
-from vumi.message import Message
+from vumi.message import Message, to_json
+from vumi.blinkenlights.metrics import MetricPublisher
+
+from ..stats import StatsCollector
+
+
+_json_decoder = json.JSONDecoder()
+_json_whitespace = re.compile(r'[ \t\n\r]*').match
+
+
+def _scan_json(json_string, index):
+    try:
+        return _json_decoder.scan_once(json_string, index)
+    except StopIteration:
+        raise ValueError("No JSON object could be decoded")
+
+
+def decode_json_fields(json_string):
+    """
+    Decode a JSON object. Returns the decoded dictionary and a dictionary
+    mapping each of its fields to the start and end offsets of the field's
+    value in ``json_string``. Other JSON values are decoded as usual, with
+    no offsets.
+    """
+    index = _json_whitespace(json_string, 0).end()
+    if json_string[index:index + 1] != '{':
+        return json.loads(json_string), {}
+    fields, spans = {}, {}
+    index = _json_whitespace(json_string, index + 1).end()
+    delimiter = json_string[index:index + 1]
+    index += 1
+    while delimiter != '}':
+        if delimiter != '"':
+            raise ValueError("Expecting property name")
+        key, index = _scan_json(json_string, index - 1)
+        index = _json_whitespace(json_string, index).end()
+        if json_string[index:index + 1] != ':':
+            raise ValueError("Expecting : delimiter")
+        start = _json_whitespace(json_string, index + 1).end()
+        fields[key], index = _scan_json(json_string, start)
+        spans[key] = (start, index)
+        index = _json_whitespace(json_string, index).end()
+        delimiter = json_string[index:index + 1]
+        index += 1
+        if delimiter == ',':
+            index = _json_whitespace(json_string, index).end()
+            delimiter = json_string[index:index + 1]
+            index += 1
+            if delimiter == '}':
+                raise ValueError("Expecting property name")
+        elif delimiter != '}':
+            raise ValueError("Expecting , delimiter")
+    if _json_whitespace(json_string, index).end() != len(json_string):
+        raise ValueError("Extra data")
+    return fields, spans
+
+
+class RawJSON(object):
+    """
+    JSON text to include as it is when a :class:`SandboxCommand` is
+    encoded, instead of a value that must be encoded.
+
+    Only the top-level fields of a command may hold raw JSON.
+    """
+
+    def __init__(self, json_text):
+        self.json_text = json_text
+
+    def __repr__(self):
+        return "RawJSON(%r)" % (self.json_text,)
 
 
 class SandboxCommand(Message):
@@ -36,8 +110,151 @@ class SandboxCommand(Message):
 
     @classmethod
     def from_json(cls, json_string):
-        # We override this to avoid the datetime conversions.
-        return cls(_process_fields=False, **to_kwargs(json.loads(json_string)))
+        # We override this to avoid the datetime conversions and to keep
+        # the JSON text for raw_json().
+        command = cls(
+            _process_fields=False, **to_kwargs(json.loads(json_string)))
+        command._json_string = json_string
+        return command
+
+    def raw_json(self, field):
+        """
+        Return the JSON text a field was decoded from, or ``None`` if the
+        command wasn't decoded from JSON or doesn't have the field.
+
+        The command's JSON is only scanned for the offsets of its fields
+        the first time this is called, so that commands that don't need
+        raw JSON are decoded by :func:`json.loads` alone.
+        """
+        json_string = getattr(self, '_json_string', None)
+        if json_string is None:
+            return None
+        spans = getattr(self, '_json_spans', None)
+        if spans is None:
+            _fields, spans = decode_json_fields(json_string)
+            self._json_spans = spans
+        span = spans.get(field)
+        if span is None:
+            return None
+        start, end = span
+        return json_string[start:end]
+
+    def to_json(self):
+        raw_fields = [(key, value) for key, value in self.payload.iteritems()
+                      if isinstance(value, RawJSON)]
+        if not raw_fields:
+            return super(SandboxCommand, self).to_json()
+        payload = dict((key, value) for key, value in self.payload.iteritems()
+                       if not isinstance(value, RawJSON))
+        # Commands always have other fields, so the raw fields can be
+        # added before the encoded payload's closing brace.
+        raw_json = "".join(
+            ", %s: %s" % (json.dumps(key), value.json_text)
+            for key, value in sorted(raw_fields))
+        return "%s%s}" % (to_json(payload)[:-1], raw_json)
+
+
+class LRUCache(object):
+    """
+    An in-memory least-recently-used cache bounded by the total size of
+    the values it holds. Each entry also has its own lifetime.
+
+    :param int max_bytes:
+        Maximum total size of the cached values. Least recently used
+        entries are evicted to make room for new ones.
+    :param clock:
+        Provider of the current time. Defaults to the reactor.
+    """
+
+    def __init__(self, max_bytes, clock=reactor):
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.size = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Return the cached value for ``key``, or ``None`` if it isn't
+        cached or has expired.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        value, size, expires = entry
+        if expires is not None and expires <= self.clock.seconds():
+            self.size -= size
+            return None
+        self._entries[key] = entry
+        return value
+
+    def set(self, key, value, size, ttl=None):
+        """
+        Cache ``value`` for ``key``. ``size`` is the number of bytes the
+        value counts for and ``ttl`` its lifetime in seconds. Values larger
+        than the whole cache are not cached.
+        """
+        self.delete(key)
+        if size > self.max_bytes:
+            return
+        while self.size + size > self.max_bytes:
+            _key, (_value, evicted_size, _expires) = self._entries.popitem(
+                last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+        expires = self.clock.seconds() + ttl if ttl is not None else None
+        self._entries[key] = (value, size, expires)
+        self.size += size
+
+    def delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+
+class HashRing(object):
+    """
+    A consistent hash ring mapping keys onto a set of named nodes.
+
+    Each node is placed at ``replicas`` points on the ring and a key
+    belongs to the first node point at or after the key's hash. Adding or
+    removing a node only moves the keys between it and its neighbours on
+    the ring, and the mapping depends only on the node names, not on the
+    order they are given in.
+
+    :param list nodes:
+        The names of the nodes.
+    :param int replicas:
+        Number of points on the ring for each node. More points spread
+        the keys more evenly. (default: 100).
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = sorted(set(nodes))
+        if not self.nodes:
+            raise ValueError("A hash ring needs at least one node")
+        ring = sorted(
+            (self._hash("%s-%d" % (node, i)), node)
+            for node in self.nodes for i in range(replicas))
+        self._points = [point for point, _node in ring]
+        self._ring_nodes = [node for _point, node in ring]
+
+    def _hash(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return int(md5(key).hexdigest()[:8], 16)
+
+    def get_node(self, key):
+        """Return the name of the node ``key`` belongs to."""
+        index = bisect(self._points, self._hash(key)) % len(self._points)
+        return self._ring_nodes[index]
 
 
 class SandboxResources(object):
@@ -109,3 +326,38 @@ class SandboxResource(object):
                 % (self.name, command['cmd'], api.sandbox_id, command),
                 logging.ERROR)
         api.sandbox_kill()  # it's a harsh world
+
+
+class StatsMixin(object):
+    """
+    Mixin for resources that publish metrics about their own work.
+
+    Metrics are published with the ``metrics_prefix`` configuration option
+    as their prefix every ``metrics_interval`` seconds (default: 60). If
+    ``metrics_prefix`` isn't set, ``stats`` is ``None`` and recording a
+    metric does nothing.
+    """
+
+    stats = None
+
+    @inlineCallbacks
+    def setup_stats(self):
+        self.stats = None
+        prefix = self.config.get('metrics_prefix')
+        if prefix is None:
+            return
+        self.stats = StatsCollector(prefix)
+        publisher = yield self.app_worker.start_publisher(MetricPublisher)
+        self.stats.start(publisher, self.config.get('metrics_interval', 60))
+
+    def teardown_stats(self):
+        if self.stats is not None:
+            self.stats.stop()
+
+    def _incr_stat(self, name, amount=1):
+        if self.stats is not None and amount:
+            self.stats.incr(name, amount)
+
+    def _observe_stat(self, name, value):
+        if self.stats is not None:
+            self.stats.observe(name, value)
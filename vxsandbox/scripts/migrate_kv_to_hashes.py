@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- test-case-name: vxsandbox.scripts.tests.test_migrate_kv_to_hashes -*-
+
+"""
+Move the keys written by :class:`vxsandbox.resources.kv.RedisResource`
+into the per-sandbox hashes used by
+:class:`vxsandbox.resources.kv.HashRedisResource`.
+
+Workers should be stopped while the migration runs, since writes made
+through the old layout during the migration may be lost.
+"""
+
+import sys
+import time
+
+import yaml
+from twisted.python import usage
+
+from vumi.persist.redis_manager import RedisManager
+from vumi.scripts.vumi_redis_tools import scan_keys
+
+from vxsandbox.resources.kv import HashRedisResource
+
+
+class Options(usage.Options):
+
+    synopsis = "<config-file.yaml>"
+
+    longdesc = """Move sandbox kv keys into per-sandbox hashes. The config
+                  file should contain the kv resource's redis_manager
+                  configuration."""
+
+    optFlags = [
+        ["dry-run", None, "Count the keys to migrate without moving them."],
+    ]
+
+    def parseArgs(self, config_file):
+        self['config'] = yaml.safe_load(open(config_file))
+
+
+class KvMigrator(object):
+
+    stdout = sys.stdout
+
+    def __init__(self, options):
+        self.dry_run = options['dry-run']
+        self.redis = self.get_redis(options['config'])
+
+    def emit(self, s):
+        """
+        Print the given string and then a newline.
+        """
+        self.stdout.write(s)
+        self.stdout.write("\n")
+
+    def get_redis(self, config):
+        """
+        Create and return a redis manager.
+        """
+        redis_config = config.get('redis_manager', {})
+        return RedisManager.from_config(redis_config)
+
+    def migrate_key(self, key):
+        """
+        Move a single key into its sandbox's hash. Returns the sandbox id,
+        or ``None`` if the key was skipped.
+        """
+        _prefix, sandbox_id, field = key.split("#", 2)
+        if self.redis.type(key) != 'string':
+            self.emit("Skipping %s, which is missing or not a string." % (
+                key,))
+            return None
+        if self.dry_run:
+            return sandbox_id
+        value = self.redis.get(key)
+        ttl = self.redis.ttl(key)
+        self.redis.hset(HashRedisResource.HASH_KEY % (sandbox_id,),
+                        field, value)
+        if ttl is not None:
+            self.redis.zadd(HashRedisResource.EXPIRY_KEY % (sandbox_id,),
+                            **{field: time.time() + ttl})
+            self.redis.sadd(HashRedisResource.EXPIRING_KEY, sandbox_id)
+        self.redis.delete(key)
+        return sandbox_id
+
+    def run(self):
+        """
+        Migrate all keys and then remove the old key counts.
+        """
+        sandbox_ids = set()
+        migrated = 0
+        for key in scan_keys(self.redis, "sandboxes#*"):
+            sandbox_id = self.migrate_key(key)
+            if sandbox_id is not None:
+                sandbox_ids.add(sandbox_id)
+                migrated += 1
+        if not self.dry_run:
+            for key in scan_keys(self.redis, "count#*"):
+                self.redis.delete(key)
+        self.emit("%s %d keys for %d sandboxes." % (
+            "Found" if self.dry_run else "Migrated",
+            migrated, len(sandbox_ids)))
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    migrator = KvMigrator(options)
+    migrator.run()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- test-case-name: vxsandbox.scripts.tests.test_rebalance_kv_shards -*-
+
+"""
+Move sandbox kv keys onto the shards that
+:class:`vxsandbox.resources.kv.RedisResource` and
+:class:`vxsandbox.resources.kv.HashRedisResource` expect them on after
+shards have been added to or removed from ``redis_managers``.
+
+Workers should be stopped while keys are moved, since they would not find
+keys that haven't been moved yet and writes made to the old shards during
+the move may be lost.
+"""
+
+import sys
+
+import yaml
+from twisted.python import usage
+
+from vumi.persist.redis_manager import RedisManager
+from vumi.scripts.vumi_redis_tools import scan_keys
+
+from vxsandbox.resources.kv import HashRedisResource
+from vxsandbox.resources.utils import HashRing
+
+
+class Options(usage.Options):
+
+    synopsis = "<config-file.yaml>"
+
+    longdesc = """Move sandbox kv keys onto the shards they belong on. The
+                  config file should contain the kv resource's new
+                  redis_managers configuration and, if shards are being
+                  removed, the configuration of the removed shards as
+                  retired_redis_managers."""
+
+    optFlags = [
+        ["dry-run", None, "Count the keys to move without moving them."],
+    ]
+
+    def parseArgs(self, config_file):
+        self['config'] = yaml.safe_load(open(config_file))
+
+
+class KvRebalancer(object):
+
+    stdout = sys.stdout
+
+    #: Patterns matching the keys that belong to a single sandbox, with
+    #: the sandbox id as the second ``#``-separated part of the key.
+    SANDBOX_KEY_PATTERNS = [
+        "sandboxes#*", "count#*",
+        HashRedisResource.HASH_KEY % ("*",),
+        HashRedisResource.EXPIRY_KEY % ("*",),
+    ]
+
+    def __init__(self, options):
+        self.dry_run = options['dry-run']
+        config = options['config']
+        r_configs = config.get('redis_managers')
+        if r_configs is None:
+            r_configs = {'default': config.get('redis_manager', {})}
+        self.ring = HashRing(r_configs.keys())
+        self.shards = {}
+        for name, r_config in r_configs.items():
+            self.shards[name] = self.get_redis(r_config)
+        for name, r_config in config.get(
+                'retired_redis_managers', {}).items():
+            self.shards[name] = self.get_redis(r_config)
+
+    def emit(self, s):
+        """
+        Print the given string and then a newline.
+        """
+        self.stdout.write(s)
+        self.stdout.write("\n")
+
+    def get_redis(self, config):
+        """
+        Create and return a redis manager.
+        """
+        return RedisManager.from_config(config)
+
+    def move_key(self, source, target, key):
+        """
+        Copy a key from one shard to another, keeping its expiry, and then
+        delete it from the old shard. Returns whether the key was moved.
+        """
+        key_type = source.type(key)
+        if key_type == 'string':
+            if not self.dry_run:
+                target.set(key, source.get(key))
+        elif key_type == 'hash':
+            if not self.dry_run:
+                target.hmset(key, source.hgetall(key))
+        elif key_type == 'zset':
+            if not self.dry_run:
+                target.zadd(key, **dict(
+                    source.zrange(key, 0, -1, withscores=True)))
+        else:
+            self.emit("Skipping %s, which has unexpected type %s." % (
+                key, key_type))
+            return False
+        if not self.dry_run:
+            ttl = source.ttl(key)
+            if ttl is not None:
+                target.expire(key, ttl)
+            source.delete(key)
+        return True
+
+    def move_expiring(self, name, source):
+        """
+        Move the sandboxes with expiring hash keys that no longer belong
+        on this shard to the shard they belong on.
+        """
+        expiring_key = HashRedisResource.EXPIRING_KEY
+        for sandbox_id in list(source.smembers(expiring_key)):
+            target_name = self.ring.get_node(sandbox_id)
+            if target_name != name and not self.dry_run:
+                self.shards[target_name].sadd(expiring_key, sandbox_id)
+                source.srem(expiring_key, sandbox_id)
+
+    def run(self):
+        """
+        Move all sandbox keys that are on the wrong shard.
+        """
+        sandbox_ids = set()
+        moved = 0
+        for name, source in sorted(self.shards.items()):
+            keys = []
+            for pattern in self.SANDBOX_KEY_PATTERNS:
+                keys.extend(scan_keys(source, pattern))
+            for key in keys:
+                sandbox_id = key.split("#")[1]
+                target_name = self.ring.get_node(sandbox_id)
+                if target_name == name:
+                    continue
+                if self.move_key(source, self.shards[target_name], key):
+                    sandbox_ids.add(sandbox_id)
+                    moved += 1
+            self.move_expiring(name, source)
+        self.emit("%s %d keys for %d sandboxes." % (
+            "Found" if self.dry_run else "Moved",
+            moved, len(sandbox_ids)))
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    rebalancer = KvRebalancer(options)
+    rebalancer.run()
@@ -0,0 +1,80 @@
+"""Tests for vxsandbox.scripts.migrate_kv_to_hashes."""
+
+import StringIO
+import time
+
+import yaml
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxsandbox.scripts.migrate_kv_to_hashes import Options, KvMigrator
+
+
+class TestKvMigrator(VumiTestCase):
+
+    def make_migrator(self, *args):
+        options = Options()
+        options.parseOptions(list(args) + [self.mk_redis_config()])
+        migrator = KvMigrator(options)
+        migrator.stdout = StringIO.StringIO()
+        return migrator
+
+    def output(self, migrator):
+        return migrator.stdout.getvalue().splitlines()
+
+    def mk_redis_config(self):
+        config = {
+            'redis_manager': {
+                'FAKE_REDIS': True,
+            },
+        }
+        name = self.mktemp()
+        with open(name, "wb") as config_file:
+            config_file.write(yaml.safe_dump(config))
+        return name
+
+    def test_migrate(self):
+        migrator = self.make_migrator()
+        redis = migrator.redis
+        redis.set("sandboxes#sb1#foo", '"bar"')
+        redis.set("sandboxes#sb1#with#hash", '1')
+        redis.setex("sandboxes#sb2#temp", 60, '2')
+        redis.set("count#sb1", '2')
+        redis.set("count#sb2", '1')
+        redis.set("unrelated", 'x')
+        migrator.run()
+        self.assertEqual(self.output(migrator), [
+            "Migrated 3 keys for 2 sandboxes.",
+        ])
+        self.assertEqual(redis.hgetall("kv#sb1"), {
+            "foo": '"bar"',
+            "with#hash": '1',
+        })
+        self.assertEqual(redis.hgetall("kv#sb2"), {"temp": '2'})
+        expires = redis.zscore("kv-expiry#sb2", "temp")
+        self.assertTrue(time.time() < expires <= time.time() + 60)
+        self.assertEqual(redis.smembers("kv-expiring"), set(["sb2"]))
+        self.assertEqual(sorted(redis.keys()), [
+            "kv#sb1", "kv#sb2", "kv-expiring", "kv-expiry#sb2", "unrelated",
+        ])
+
+    def test_skip_non_string_keys(self):
+        migrator = self.make_migrator()
+        migrator.redis.sadd("sandboxes#sb1#set", "a")
+        migrator.run()
+        self.assertEqual(self.output(migrator), [
+            "Skipping sandboxes#sb1#set, which is missing or not a string.",
+            "Migrated 0 keys for 0 sandboxes.",
+        ])
+
+    def test_dry_run(self):
+        migrator = self.make_migrator("--dry-run")
+        redis = migrator.redis
+        redis.set("sandboxes#sb1#foo", '"bar"')
+        redis.set("count#sb1", '1')
+        migrator.run()
+        self.assertEqual(self.output(migrator), [
+            "Found 1 keys for 1 sandboxes.",
+        ])
+        self.assertEqual(
+            sorted(redis.keys()), ["count#sb1", "sandboxes#sb1#foo"])
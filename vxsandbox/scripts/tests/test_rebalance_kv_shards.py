@@ -0,0 +1,111 @@
+"""Tests for vxsandbox.scripts.rebalance_kv_shards."""
+
+import StringIO
+
+import yaml
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxsandbox.resources.utils import HashRing
+from vxsandbox.scripts.rebalance_kv_shards import Options, KvRebalancer
+
+
+class TestKvRebalancer(VumiTestCase):
+
+    def make_rebalancer(self, *args, **config):
+        options = Options()
+        options.parseOptions(list(args) + [self.mk_config(config)])
+        rebalancer = KvRebalancer(options)
+        rebalancer.stdout = StringIO.StringIO()
+        return rebalancer
+
+    def output(self, rebalancer):
+        return rebalancer.stdout.getvalue().splitlines()
+
+    def mk_config(self, config):
+        name = self.mktemp()
+        with open(name, "wb") as config_file:
+            config_file.write(yaml.safe_dump(config))
+        return name
+
+    def shard_configs(self, *names):
+        return dict((name, {'FAKE_REDIS': True}) for name in names)
+
+    def sandbox_on(self, ring, name):
+        for i in range(100):
+            sandbox_id = "sandbox-%d" % (i,)
+            if ring.get_node(sandbox_id) == name:
+                return sandbox_id
+
+    def test_move_to_new_shard(self):
+        rebalancer = self.make_rebalancer(
+            redis_managers=self.shard_configs('a', 'b'))
+        ring = HashRing(['a', 'b'])
+        sb_a, sb_b = self.sandbox_on(ring, 'a'), self.sandbox_on(ring, 'b')
+        r_a, r_b = rebalancer.shards['a'], rebalancer.shards['b']
+        for sandbox_id in [sb_a, sb_b]:
+            r_a.set("sandboxes#%s#foo" % (sandbox_id,), '"bar"')
+            r_a.set("count#%s" % (sandbox_id,), '1')
+        r_a.setex("sandboxes#%s#temp" % (sb_b,), 60, '1')
+        r_a.hmset("kv#%s" % (sb_b,), {"foo": '"bar"'})
+        r_a.zadd("kv-expiry#%s" % (sb_b,), foo=1000.0)
+        r_a.sadd("kv-expiring", sb_a, sb_b)
+        r_a.set("unrelated", "x")
+        rebalancer.run()
+        self.assertEqual(self.output(rebalancer), [
+            "Moved 5 keys for 1 sandboxes.",
+        ])
+        self.assertEqual(sorted(r_a.keys()), [
+            "count#" + sb_a, "kv-expiring", "sandboxes#%s#foo" % (sb_a,),
+            "unrelated",
+        ])
+        self.assertEqual(r_a.smembers("kv-expiring"), set([sb_a]))
+        self.assertEqual(r_b.get("sandboxes#%s#foo" % (sb_b,)), '"bar"')
+        self.assertEqual(r_b.get("count#" + sb_b), '1')
+        self.assertTrue(0 < r_b.ttl("sandboxes#%s#temp" % (sb_b,)) <= 60)
+        self.assertEqual(r_b.hgetall("kv#" + sb_b), {"foo": '"bar"'})
+        self.assertEqual(
+            r_b.zrange("kv-expiry#" + sb_b, 0, -1, withscores=True),
+            [("foo", 1000.0)])
+        self.assertEqual(r_b.smembers("kv-expiring"), set([sb_b]))
+
+    def test_move_from_retired_shard(self):
+        rebalancer = self.make_rebalancer(
+            redis_managers=self.shard_configs('a'),
+            retired_redis_managers=self.shard_configs('old'))
+        r_a, r_old = rebalancer.shards['a'], rebalancer.shards['old']
+        r_old.set("sandboxes#sb1#foo", '1')
+        r_old.set("count#sb1", '1')
+        rebalancer.run()
+        self.assertEqual(self.output(rebalancer), [
+            "Moved 2 keys for 1 sandboxes.",
+        ])
+        self.assertEqual(r_old.keys(), [])
+        self.assertEqual(
+            sorted(r_a.keys()), ["count#sb1", "sandboxes#sb1#foo"])
+
+    def test_skip_unexpected_types(self):
+        rebalancer = self.make_rebalancer(
+            redis_managers=self.shard_configs('a'),
+            retired_redis_managers=self.shard_configs('old'))
+        rebalancer.shards['old'].sadd("sandboxes#sb1#set", "a")
+        rebalancer.run()
+        self.assertEqual(self.output(rebalancer), [
+            "Skipping sandboxes#sb1#set, which has unexpected type set.",
+            "Moved 0 keys for 0 sandboxes.",
+        ])
+
+    def test_dry_run(self):
+        rebalancer = self.make_rebalancer(
+            "--dry-run", redis_managers=self.shard_configs('a'),
+            retired_redis_managers=self.shard_configs('old'))
+        r_old = rebalancer.shards['old']
+        r_old.set("sandboxes#sb1#foo", '1')
+        r_old.sadd("kv-expiring", "sb1")
+        rebalancer.run()
+        self.assertEqual(self.output(rebalancer), [
+            "Found 1 keys for 1 sandboxes.",
+        ])
+        self.assertEqual(
+            sorted(r_old.keys()), ["kv-expiring", "sandboxes#sb1#foo"])
+        self.assertEqual(rebalancer.shards['a'].keys(), [])
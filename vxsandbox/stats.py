@@ -0,0 +1,174 @@
+# -*- test-case-name: vxsandbox.tests.test_stats -*-
+
+"""In-memory counters and latency histograms for sandbox worker metrics."""
+
+import re
+from bisect import bisect_left
+
+from twisted.internet.task import LoopingCall
+
+from vumi.blinkenlights.metrics import SUM, AVG, MAX, Metric, MetricManager
+from vumi import log
+
+
+class Histogram(object):
+    """
+    A histogram with fixed bucket boundaries.
+
+    :param list buckets:
+        Sorted upper bounds of the buckets. Values larger than the last
+        bound are counted in an extra overflow bucket.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def cumulative_counts(self):
+        """
+        Return a list of ``(label, count)`` pairs where ``count`` is the
+        number of values less than or equal to the bucket bound.
+        """
+        labels = ["le_%s" % (bound,) for bound in self.buckets] + ["le_inf"]
+        counts, running = [], 0
+        for label, count in zip(labels, self.counts):
+            running += count
+            counts.append((label, running))
+        return counts
+
+
+class StatsCollector(object):
+    """
+    Accumulates counters and histograms in memory and periodically
+    publishes them through a :class:`MetricPublisher`.
+
+    Values are reset each time they are collected, so every published
+    data point covers a single publishing interval.
+
+    :param str prefix:
+        Prefix for the names of all published metrics.
+    :param list buckets:
+        Upper bounds of the histogram buckets.
+    """
+
+    DEFAULT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self, prefix, buckets=None):
+        self.prefix = prefix
+        self.buckets = sorted(
+            buckets if buckets is not None else self.DEFAULT_BUCKETS)
+        self._counters = {}
+        self._histograms = {}
+        self._manager = None
+        self._task = None
+
+    def incr(self, name, amount=1):
+        self._counters[name] = self._counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = Histogram(self.buckets)
+        histogram.record(value)
+
+    def collect(self):
+        """
+        Return and reset the accumulated values as a list of
+        ``(name, aggregator, value)`` tuples.
+        """
+        counters, self._counters = self._counters, {}
+        histograms, self._histograms = self._histograms, {}
+        values = [(name, SUM, value) for name, value in counters.iteritems()]
+        for name, histogram in histograms.iteritems():
+            for label, count in histogram.cumulative_counts():
+                values.append(("%s.%s" % (name, label), SUM, count))
+            values.append(("%s.count" % (name,), SUM, histogram.count))
+            values.append(
+                ("%s.avg" % (name,), AVG, histogram.total / histogram.count))
+            values.append(("%s.max" % (name,), MAX, histogram.max))
+        return sorted(values)
+
+    def start(self, publisher, interval):
+        """Start publishing collected values every ``interval`` seconds."""
+        self._manager = MetricManager(
+            "%s." % (self.prefix,), publisher=publisher)
+        self._task = LoopingCall(self.publish)
+        d = self._task.start(interval, now=False)
+        d.addErrback(log.err, "StatsCollector publishing task died")
+
+    def stop(self):
+        """Stop the publishing task and publish any outstanding values."""
+        if self._task is None:
+            return
+        if self._task.running:
+            self._task.stop()
+        self._task = None
+        self.publish()
+
+    def publish(self):
+        values = self.collect()
+        if not values:
+            return
+        for name, agg, value in values:
+            self._manager.oneshot(Metric(name, [agg]), value)
+        self._manager.publish_metrics()
+
+
+class CommandStats(object):
+    """
+    Records the latency and outcome of commands dispatched by sandboxes.
+
+    :param StatsCollector collector:
+        The collector to record values in.
+    :param int max_sandboxes:
+        Maximum number of distinct sandbox ids to keep a per-sandbox
+        breakdown for. Commands from sandboxes beyond this limit are only
+        recorded in the totals. Set to ``0`` to disable the breakdown.
+    """
+
+    UNSAFE_NAME_CHARS = re.compile(r"[^a-zA-Z0-9_-]")
+
+    def __init__(self, collector, max_sandboxes=0):
+        self.collector = collector
+        self.max_sandboxes = max_sandboxes
+        self._sandbox_names = {}
+
+    def _sandbox_name(self, sandbox_id):
+        name = self._sandbox_names.get(sandbox_id)
+        if name is None and len(self._sandbox_names) < self.max_sandboxes:
+            name = self.UNSAFE_NAME_CHARS.sub("_", sandbox_id)
+            self._sandbox_names[sandbox_id] = name
+        return name
+
+    def _record(self, name, outcome, latency):
+        self.collector.observe("%s.latency" % (name,), latency)
+        self.collector.incr("%s.%s" % (name, outcome))
+
+    def record(self, sandbox_id, resource_name, cmd, outcome, latency):
+        """
+        Record a dispatched command.
+
+        :param str outcome:
+            One of ``success``, ``failure`` (the command replied with
+            ``success`` set to ``false``) or ``error`` (the command raised
+            an exception).
+        :param float latency:
+            Time taken to handle the command in milliseconds.
+        """
+        name = "commands.%s.%s" % (resource_name, cmd)
+        self._record(name, outcome, latency)
+        if sandbox_id is not None:
+            sandbox_name = self._sandbox_name(sandbox_id)
+            if sandbox_name is not None:
+                self._record(
+                    "sandboxes.%s.%s" % (sandbox_name, name), outcome, latency)
@@ -0,0 +1,95 @@
+"""Tests for vxsandbox.profiling."""
+
+import os
+import pstats
+
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxsandbox.profiling import ReactorProfiler
+
+
+def profiled_function():
+    return sum(range(10))
+
+
+def unprofiled_function():
+    return 3
+
+
+class TestReactorProfiler(VumiTestCase):
+
+    def mk_profiler(self, sandbox_id=None, duration=10):
+        self.clock = Clock()
+        self.path = self.mktemp()
+        return ReactorProfiler(
+            duration, self.path, sandbox_id=sandbox_id, clock=self.clock)
+
+    def profiled_functions(self, path):
+        stats = pstats.Stats(path)
+        return set(func_name for _file, _line, func_name in stats.stats)
+
+    def test_start_and_stop_after_duration(self):
+        profiler = self.mk_profiler()
+        d = profiler.start()
+        self.assertTrue(profiler.running)
+        profiled_function()
+        self.clock.advance(9)
+        self.assertTrue(profiler.running)
+        self.assertFalse(d.called)
+        self.clock.advance(1)
+        self.assertFalse(profiler.running)
+        self.assertEqual(d.result, self.path)
+        self.assertTrue(
+            'profiled_function' in self.profiled_functions(self.path))
+
+    def test_start_while_running(self):
+        profiler = self.mk_profiler()
+        profiler.start()
+        self.add_cleanup(profiler.stop)
+        self.assertEqual(profiler.start(), None)
+
+    def test_stop_early(self):
+        profiler = self.mk_profiler()
+        d = profiler.start()
+        profiler.stop()
+        self.assertEqual(d.result, self.path)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_stop_when_not_running(self):
+        profiler = self.mk_profiler()
+        profiler.stop()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_path_placeholders(self):
+        profiler = self.mk_profiler()
+        profiler.path = self.path + "-$pid"
+        d = profiler.start()
+        profiler.stop()
+        self.assertEqual(d.result, "%s-%s" % (self.path, os.getpid()))
+
+    def test_path_with_percent(self):
+        profiler = self.mk_profiler()
+        profiler.path = self.path + "-100%-$pid"
+        d = profiler.start()
+        profiler.stop()
+        self.assertEqual(
+            d.result, "%s-100%%-%s" % (self.path, os.getpid()))
+        self.assertTrue(os.path.exists(d.result))
+
+    def test_call_not_running(self):
+        profiler = self.mk_profiler(sandbox_id='sandbox1')
+        self.assertEqual(profiler.call('sandbox1', profiled_function), 45)
+
+    def test_call_scoped_to_sandbox(self):
+        profiler = self.mk_profiler(sandbox_id='sandbox1')
+        profiler.start()
+        self.assertEqual(profiler.call('sandbox2', unprofiled_function), 3)
+        self.assertEqual(profiler.call('sandbox1', profiled_function), 45)
+        unprofiled_function()
+        profiler.stop()
+        functions = self.profiled_functions(self.path)
+        self.assertTrue('profiled_function' in functions)
+        self.assertFalse('unprofiled_function' in functions)
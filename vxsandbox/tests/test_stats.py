@@ -0,0 +1,130 @@
+"""Tests for vxsandbox.stats."""
+
+from zope.interface import implementer
+
+from vumi.blinkenlights.metrics import SUM, AVG, MAX, IMetricPublisher
+from vumi.tests.helpers import VumiTestCase
+
+from vxsandbox.stats import Histogram, StatsCollector, CommandStats
+
+
+@implementer(IMetricPublisher)
+class ListPublisher(object):
+    def __init__(self):
+        self.msgs = []
+
+    def publish_message(self, msg):
+        self.msgs.append(msg)
+
+
+class TestHistogram(VumiTestCase):
+
+    def test_record(self):
+        histogram = Histogram([10, 100])
+        for value in [1, 10, 11, 500]:
+            histogram.record(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.total, 522)
+        self.assertEqual(histogram.max, 500)
+
+    def test_cumulative_counts(self):
+        histogram = Histogram([10, 100])
+        for value in [1, 10, 11, 500]:
+            histogram.record(value)
+        self.assertEqual(histogram.cumulative_counts(), [
+            ("le_10", 2), ("le_100", 3), ("le_inf", 4)])
+
+
+class TestStatsCollector(VumiTestCase):
+
+    def test_collect_counters(self):
+        collector = StatsCollector("prefix")
+        collector.incr("foo")
+        collector.incr("foo", 2)
+        self.assertEqual(collector.collect(), [("foo", SUM, 3)])
+        self.assertEqual(collector.collect(), [])
+
+    def test_collect_histograms(self):
+        collector = StatsCollector("prefix", buckets=[10, 100])
+        collector.observe("lat", 5)
+        collector.observe("lat", 15)
+        self.assertEqual(collector.collect(), [
+            ("lat.avg", AVG, 10.0),
+            ("lat.count", SUM, 2),
+            ("lat.le_10", SUM, 1),
+            ("lat.le_100", SUM, 2),
+            ("lat.le_inf", SUM, 2),
+            ("lat.max", MAX, 15),
+        ])
+        self.assertEqual(collector.collect(), [])
+
+    def test_publish(self):
+        publisher = ListPublisher()
+        collector = StatsCollector("prefix")
+        collector.start(publisher, 60)
+        self.add_cleanup(collector.stop)
+        collector.incr("foo")
+        collector.publish()
+        [msg] = publisher.msgs
+        [(name, aggs, [(_, value)])] = msg.datapoints()
+        self.assertEqual(name, "prefix.foo")
+        self.assertEqual(aggs, ("sum",))
+        self.assertEqual(value, 1)
+
+    def test_publish_nothing(self):
+        publisher = ListPublisher()
+        collector = StatsCollector("prefix")
+        collector.start(publisher, 60)
+        self.add_cleanup(collector.stop)
+        collector.publish()
+        self.assertEqual(publisher.msgs, [])
+
+    def test_stop_publishes_outstanding_values(self):
+        publisher = ListPublisher()
+        collector = StatsCollector("prefix")
+        collector.start(publisher, 60)
+        collector.incr("foo")
+        collector.stop()
+        self.assertEqual(len(publisher.msgs), 1)
+
+
+class TestCommandStats(VumiTestCase):
+
+    def names(self, collector):
+        return set(name for name, _agg, _value in collector.collect())
+
+    def test_record(self):
+        collector = StatsCollector("prefix", buckets=[10])
+        stats = CommandStats(collector)
+        stats.record("sandbox1", "kv", "get", "success", 2.5)
+        self.assertEqual(self.names(collector), set([
+            "commands.kv.get.success",
+            "commands.kv.get.latency.avg",
+            "commands.kv.get.latency.count",
+            "commands.kv.get.latency.le_10",
+            "commands.kv.get.latency.le_inf",
+            "commands.kv.get.latency.max",
+        ]))
+
+    def test_record_per_sandbox(self):
+        collector = StatsCollector("prefix", buckets=[10])
+        stats = CommandStats(collector, max_sandboxes=1)
+        stats.record("sandbox.1", "kv", "get", "failure", 2.5)
+        names = self.names(collector)
+        self.assertTrue("commands.kv.get.failure" in names)
+        self.assertTrue("sandboxes.sandbox_1.commands.kv.get.failure" in names)
+
+    def test_record_per_sandbox_cardinality_limit(self):
+        collector = StatsCollector("prefix", buckets=[10])
+        stats = CommandStats(collector, max_sandboxes=1)
+        stats.record("sandbox1", "kv", "get", "success", 2.5)
+        stats.record("sandbox2", "kv", "get", "success", 2.5)
+        stats.record("sandbox1", "kv", "get", "success", 2.5)
+        values = dict(
+            (name, value) for name, _agg, value in collector.collect())
+        self.assertEqual(values["commands.kv.get.success"], 3)
+        self.assertEqual(
+            values["sandboxes.sandbox1.commands.kv.get.success"], 2)
+        self.assertFalse(any(name.startswith("sandboxes.sandbox2.")
+                             for name in values))
@@ -0,0 +1,101 @@
+"""Tests for vxsandbox.tracing."""
+
+import json
+
+from vumi.tests.helpers import VumiTestCase
+
+from vxsandbox.tracing import (
+    Tracer, Span, NULL_SPAN, NULL_TRACER, JsonLinesSpanExporter)
+
+
+class ListSpanExporter(object):
+    def __init__(self, config):
+        self.config = config
+        self.spans = []
+        self.closed = False
+
+    def export(self, span):
+        self.spans.append(span)
+
+    def close(self):
+        self.closed = True
+
+
+class TestTracer(VumiTestCase):
+
+    def test_sample_everything(self):
+        tracer = Tracer(ListSpanExporter({}), 1.0)
+        self.assertTrue(tracer.sampled("msg1"))
+        self.assertTrue(tracer.sampled(u"msg2"))
+        self.assertFalse(tracer.sampled(None))
+
+    def test_sample_nothing(self):
+        tracer = Tracer(ListSpanExporter({}), 0)
+        self.assertFalse(tracer.sampled("msg1"))
+        self.assertEqual(tracer.start_span("msg1", "foo"), NULL_SPAN)
+
+    def test_sample_rate(self):
+        tracer = Tracer(ListSpanExporter({}), 0.5)
+        sampled = [tracer.sampled("msg%d" % i) for i in range(1000)]
+        self.assertTrue(400 < sampled.count(True) < 600)
+        # The decision is consistent for a given trace id.
+        self.assertEqual(
+            sampled, [tracer.sampled("msg%d" % i) for i in range(1000)])
+
+    def test_start_span(self):
+        exporter = ListSpanExporter({})
+        tracer = Tracer(exporter, 1.0)
+        span = tracer.start_span("msg1", "dispatch", cmd="kv.get")
+        self.assertTrue(isinstance(span, Span))
+        self.assertEqual(exporter.spans, [])
+        span.finish(outcome="success")
+        self.assertEqual(exporter.spans, [span])
+        span_dict = span.to_dict()
+        self.assertEqual(span_dict["trace_id"], "msg1")
+        self.assertEqual(span_dict["name"], "dispatch")
+        self.assertEqual(
+            span_dict["attrs"], {"cmd": "kv.get", "outcome": "success"})
+        self.assertTrue(span_dict["duration_ms"] >= 0)
+
+    def test_event(self):
+        exporter = ListSpanExporter({})
+        tracer = Tracer(exporter, 1.0)
+        tracer.event("msg1", "done")
+        [span] = exporter.spans
+        self.assertEqual(span.name, "done")
+        self.assertEqual(span.start, span.end)
+
+    def test_from_config(self):
+        tracer = Tracer.from_config(
+            {'cls': '%s.ListSpanExporter' % (__name__,), 'foo': 'bar'}, 0.5)
+        self.assertTrue(isinstance(tracer.exporter, ListSpanExporter))
+        self.assertEqual(tracer.exporter.config, {'foo': 'bar'})
+        self.assertEqual(tracer.sample_rate, 0.5)
+
+    def test_close(self):
+        exporter = ListSpanExporter({})
+        Tracer(exporter, 1.0).close()
+        self.assertTrue(exporter.closed)
+        NULL_TRACER.close()
+
+
+class TestJsonLinesSpanExporter(VumiTestCase):
+
+    def test_export(self):
+        path = self.mktemp()
+        exporter = JsonLinesSpanExporter({'path': path})
+        tracer = Tracer(exporter, 1.0)
+        tracer.start_span("msg1", "first").finish()
+        tracer.start_span("msg1", "second", cmd="kv.get").finish()
+        exporter.close()
+        with open(path) as f:
+            spans = [json.loads(line) for line in f]
+        self.assertEqual(
+            [(s["trace_id"], s["name"], s["attrs"]) for s in spans],
+            [("msg1", "first", {}), ("msg1", "second", {"cmd": "kv.get"})])
+
+    def test_close_without_spans(self):
+        path = self.mktemp()
+        exporter = JsonLinesSpanExporter({'path': path})
+        exporter.close()
+        self.assertEqual(exporter.path, path)
@@ -2,22 +2,27 @@
 
 import os
 import sys
+import signal
 import json
 import resource
 import pkg_resources
 import logging
 from datetime import datetime
 
-from twisted.internet.defer import inlineCallbacks, DeferredQueue
+from twisted.internet.defer import inlineCallbacks, DeferredQueue, Deferred
 from twisted.internet.error import ProcessTerminated
 
 from vumi.application.tests.helpers import ApplicationHelper
 from vumi.tests.utils import LogCatcher
 from vumi.tests.helpers import VumiTestCase
+from vumi.errors import ConfigError
 
 from vxsandbox.worker import (
     Sandbox, SandboxApi, SandboxCommand, SandboxResources,
     JsSandboxResource, JsSandbox, JsFileSandbox, StandaloneJsFileSandbox)
+from vxsandbox.stats import StatsCollector, CommandStats
+from vxsandbox.tracing import Tracer, NULL_TRACER
+from vxsandbox.tests.test_tracing import ListSpanExporter
 from vxsandbox import SandboxResource, LoggingResource
 from vxsandbox.tests.utils import DummyAppWorker
 from vxsandbox.resources.tests.utils import ResourceTestCaseBase
@@ -375,6 +380,140 @@ class TestSandbox(SandboxTestCaseBase):
         ack.set_routing_endpoint('foo')
         return self.event_dispatch_check(ack)
 
+    @inlineCallbacks
+    def test_command_metrics(self):
+        app = yield self.setup_app(
+            "import sys, json\n"
+            "log = {'cmd': 'log.info', 'cmd_id': '1',\n"
+            "       'reply': False, 'msg': 'hello'}\n"
+            "sys.stdout.write(json.dumps(log) + '\\n')\n",
+            {'command_metrics_prefix': 'sandbox_metrics',
+             'command_metrics_max_sandboxes': 10,
+             'sandbox': {
+                 'log': {'cls': 'vxsandbox.LoggingResource'},
+             }},
+        )
+        with LogCatcher():
+            status = yield app.process_message_in_sandbox(
+                self.app_helper.make_inbound("foo", sandbox_id='sandbox1'))
+        self.assertEqual(status, 0)
+        values = dict((name, value) for name, _agg, value
+                      in app.command_stats.collector.collect())
+        self.assertEqual(values['commands.log.info.success'], 1)
+        self.assertEqual(values['commands.log.info.latency.count'], 1)
+        self.assertEqual(
+            values['sandboxes.sandbox1.commands.log.info.success'], 1)
+
+    @inlineCallbacks
+    def test_command_metrics_disabled_by_default(self):
+        app = yield self.setup_app("pass")
+        self.assertEqual(app.command_stats, None)
+
+    @inlineCallbacks
+    def test_tracing(self):
+        app = yield self.setup_app(
+            "import sys, json\n"
+            "log = {'cmd': 'log.info', 'cmd_id': '1',\n"
+            "       'reply': False, 'msg': 'hello'}\n"
+            "sys.stdout.write(json.dumps(log) + '\\n')\n",
+            {'tracing_sample_rate': 1.0,
+             'tracing_exporter': {
+                 'cls': 'vxsandbox.tests.test_tracing.ListSpanExporter'},
+             'sandbox': {
+                 'log': {'cls': 'vxsandbox.LoggingResource'},
+             }},
+        )
+        msg = self.app_helper.make_inbound("foo", sandbox_id='sandbox1')
+        with LogCatcher():
+            status = yield app.process_message_in_sandbox(msg)
+        self.assertEqual(status, 0)
+        spans = app.tracer.exporter.spans
+        self.assertEqual(
+            [span.name for span in spans],
+            ['sandbox_protocol_for_message', 'started', 'sandbox_init',
+             'dispatch'])
+        self.assertEqual(
+            set(span.trace_id for span in spans), set([msg['message_id']]))
+        self.assertEqual(
+            spans[-1].attrs, {'cmd': 'log.info', 'outcome': 'success'})
+
+    @inlineCallbacks
+    def test_tracing_events(self):
+        app = yield self.setup_app(
+            "pass",
+            {'tracing_sample_rate': 1.0,
+             'tracing_exporter': {
+                 'cls': 'vxsandbox.tests.test_tracing.ListSpanExporter'}},
+        )
+        ack = self.app_helper.make_ack(sandbox_id='sandbox1')
+        status = yield app.process_event_in_sandbox(ack)
+        self.assertEqual(status, 0)
+        spans = app.tracer.exporter.spans
+        self.assertEqual(
+            set(span.trace_id for span in spans),
+            set([ack['user_message_id']]))
+        self.assertEqual(spans[0].attrs['event_id'], ack['event_id'])
+
+    @inlineCallbacks
+    def test_tracing_disabled_by_default(self):
+        app = yield self.setup_app("pass")
+        self.assertEqual(app.tracer, NULL_TRACER)
+
+    @inlineCallbacks
+    def test_profiler_on_startup(self):
+        path = self.mktemp()
+        app = yield self.setup_app("pass", {
+            'profiler_on_startup': True,
+            'profiler_path': path,
+        })
+        self.assertTrue(app.profiler.running)
+        yield self.app_helper.cleanup_worker(app)
+        self.assertFalse(app.profiler.running)
+        self.assertTrue(os.path.exists(path))
+
+    @inlineCallbacks
+    def test_profiler_signal(self):
+        original_handler = signal.getsignal(signal.SIGUSR2)
+        path = self.mktemp()
+        app = yield self.setup_app("pass", {
+            'profiler_signal': 'SIGUSR2',
+            'profiler_path': path,
+        })
+        self.assertFalse(app.profiler.running)
+        self.assertEqual(
+            signal.getsignal(signal.SIGUSR2), app._profiler_signal_handler)
+        d = Deferred()
+        self.patch(app.profiler, 'start', lambda: d.callback(None))
+        app._profiler_signal_handler(signal.SIGUSR2, None)
+        yield d
+        yield self.app_helper.cleanup_worker(app)
+        self.assertEqual(signal.getsignal(signal.SIGUSR2), original_handler)
+
+    @inlineCallbacks
+    def test_profiler_bad_signal(self):
+        try:
+            yield self.setup_app("pass", {'profiler_signal': 'SIGFOO'})
+        except ConfigError, e:
+            self.assertEqual(str(e), "Unknown profiler signal 'SIGFOO'")
+        else:
+            self.fail("Expected ConfigError")
+
+    @inlineCallbacks
+    def test_profiler_signal_not_a_signal_name(self):
+        for name in ['SIG_IGN', 'NSIG']:
+            try:
+                yield self.setup_app("pass", {'profiler_signal': name})
+            except ConfigError, e:
+                self.assertEqual(
+                    str(e), "Unknown profiler signal %r" % (name,))
+            else:
+                self.fail("Expected ConfigError")
+
+    @inlineCallbacks
+    def test_profiler_disabled_by_default(self):
+        app = yield self.setup_app("pass")
+        self.assertEqual(app.profiler, None)
+
     def test_sandbox_command_does_not_parse_timestamps(self):
         # We should serialise datetime objects correctly.
         timestamp = datetime(2014, 07, 18, 15, 0, 0)
@@ -744,6 +883,50 @@ class TestSandboxApi(VumiTestCase):
         self.assertEqual(str(logged_error.value), 'Something bad happened')
         self.assertEqual(logged_error.type, Exception)
 
+    def dispatch_with_stats(self, cmd, **handlers):
+        collector = StatsCollector('prefix')
+        self.api.command_stats = CommandStats(collector)
+        self.patch(SandboxApi, 'sandbox_id', 'sandbox1')
+        self.patch(SandboxApi, 'sandbox_kill', lambda api: None)
+        self.resources.add_resource(
+            'mock', MockResource('mock', self.app, **handlers))
+        self.api.dispatch_request(SandboxCommand(cmd=cmd))
+        return dict((name, value) for name, _agg, value in collector.collect())
+
+    def test_command_stats_success(self):
+        values = self.dispatch_with_stats(
+            'mock.use', use=lambda api, command: None)
+        self.assertEqual(values['commands.mock.use.success'], 1)
+        self.assertEqual(values['commands.mock.use.latency.count'], 1)
+
+    def test_command_stats_failure(self):
+        values = self.dispatch_with_stats(
+            'mock.use', use=lambda api, command: SandboxCommand(
+                reply=True, success=False, reason='no'))
+        self.assertEqual(values['commands.mock.use.failure'], 1)
+
+    def test_command_stats_error(self):
+        def handle_use(api, command):
+            raise Exception('Something bad happened')
+        values = self.dispatch_with_stats('mock.use', use=handle_use)
+        self.assertEqual(values['commands.mock.use.error'], 1)
+        self.flushLoggedErrors(Exception)
+
+    def test_command_stats_unknown_command(self):
+        values = self.dispatch_with_stats(
+            'nonexistent.foo', use=lambda api, command: None)
+        self.assertEqual(values['commands.unknown.unknown.success'], 1)
+
+    def test_message_or_event_processed_traced(self):
+        exporter = ListSpanExporter({})
+        self.api.tracer = Tracer(exporter, 1.0)
+        self.api.trace_id = 'msg1'
+        self.api.message_or_event_processed()
+        [span] = exporter.spans
+        self.assertEqual(
+            (span.trace_id, span.name), ('msg1', 'message_or_event_processed'))
+        self.assertEqual(self.api.done.result, 0)
+
 
 class JsDummyAppWorker(DummyAppWorker):
     def javascript_for_api(self, api):
@@ -0,0 +1,138 @@
+# -*- test-case-name: vxsandbox.tests.test_tracing -*-
+
+"""Sampled tracing of the time spent processing messages in sandboxes."""
+
+import json
+import time
+from zlib import crc32
+
+from vumi.utils import load_class_by_string
+
+
+class Span(object):
+    """A named, timed section of the processing of a single message."""
+
+    def __init__(self, tracer, trace_id, name, attrs):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.end = None
+
+    def finish(self, **attrs):
+        """Mark the span as finished and hand it to the tracer's exporter."""
+        self.end = time.time()
+        self.attrs.update(attrs)
+        self.tracer.export(self)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": (self.end - self.start) * 1000,
+            "attrs": self.attrs,
+        }
+
+
+class NullSpan(object):
+    """A span for traces that are not sampled. Finishing it does nothing."""
+
+    def finish(self, **attrs):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer(object):
+    """
+    Creates spans for a sample of traces and exports them once finished.
+
+    The sampling decision is made from a hash of the trace id, so all the
+    spans for a given message are either exported or dropped together.
+
+    :param exporter:
+        An object with ``export(span)`` and ``close()`` methods.
+    :param float sample_rate:
+        Fraction of traces to export, between ``0`` and ``1``.
+    """
+
+    def __init__(self, exporter, sample_rate):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self._threshold = int(sample_rate * 0x100000000)
+
+    @classmethod
+    def from_config(cls, exporter_config, sample_rate):
+        """
+        Build a tracer for an exporter configuration dictionary. The ``cls``
+        key gives the full name of the exporter class and the rest of the
+        dictionary is passed to the class as its configuration.
+        """
+        exporter_config = exporter_config.copy()
+        exporter_cls = load_class_by_string(exporter_config.pop('cls'))
+        return cls(exporter_cls(exporter_config), sample_rate)
+
+    def sampled(self, trace_id):
+        if trace_id is None:
+            return False
+        if isinstance(trace_id, unicode):
+            trace_id = trace_id.encode('utf-8')
+        return (crc32(trace_id) & 0xffffffff) < self._threshold
+
+    def start_span(self, trace_id, name, **attrs):
+        """
+        Start a span. Returns :data:`NULL_SPAN` if the trace isn't sampled.
+        """
+        if not self.sampled(trace_id):
+            return NULL_SPAN
+        return Span(self, trace_id, name, attrs)
+
+    def event(self, trace_id, name, **attrs):
+        """Record a span of zero duration."""
+        span = self.start_span(trace_id, name, **attrs)
+        if span is not NULL_SPAN:
+            span.end = span.start
+            self.export(span)
+
+    def export(self, span):
+        self.exporter.export(span)
+
+    def close(self):
+        if self.exporter is not None:
+            self.exporter.close()
+
+
+#: A tracer that never samples anything.
+NULL_TRACER = Tracer(None, 0)
+
+
+class JsonLinesSpanExporter(object):
+    """
+    Span exporter that appends each span to a file as a line of JSON.
+
+    Configuration options:
+
+    :param str path:
+        Path of the file to append spans to.
+        (default: ``sandbox_spans.jsonl``).
+    """
+
+    DEFAULT_PATH = "sandbox_spans.jsonl"
+
+    def __init__(self, config):
+        self.path = config.get('path', self.DEFAULT_PATH)
+        self._file = None
+
+    def export(self, span):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(json.dumps(span.to_dict()))
+        self._file.write("\n")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
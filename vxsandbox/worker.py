@@ -4,18 +4,26 @@
 
 import resource
 import os
+import signal
 import pkg_resources
 import logging
+import time
 
+from twisted.internet import reactor
 from twisted.internet.defer import (
     Deferred, inlineCallbacks, returnValue, succeed)
 
-from vumi.config import ConfigText, ConfigInt, ConfigList, ConfigDict
+from vumi.config import (
+    ConfigText, ConfigInt, ConfigFloat, ConfigBool, ConfigList, ConfigDict)
 from vumi.application.base import ApplicationWorker
+from vumi.blinkenlights.metrics import MetricPublisher
 from vumi.errors import ConfigError
 from vumi import log
 
 from .utils import SandboxError
+from .stats import StatsCollector, CommandStats
+from .tracing import Tracer, NULL_TRACER
+from .profiling import ReactorProfiler
 from .protocol import SandboxProtocol
 from .resources import (
     SandboxResources, SandboxResource, SandboxCommand, LoggingResource)
@@ -44,10 +52,15 @@ class JsSandboxResource(SandboxResource):
 class SandboxApi(object):
     """A sandbox API instance for a particular sandbox run."""
 
-    def __init__(self, resources, config):
+    def __init__(self, resources, config, command_stats=None, tracer=None,
+                 profiler=None):
         self._sandbox = None
         self._inbound_messages = {}
         self.resources = resources
+        self.command_stats = command_stats
+        self.tracer = tracer if tracer is not None else NULL_TRACER
+        self.profiler = profiler
+        self.trace_id = None
         self.fallback_resource = SandboxResource("fallback", None, {})
         potential_logger = None
         if config.logging_resource:
@@ -96,10 +109,12 @@ class SandboxApi(object):
 
     def sandbox_inbound_message(self, msg):
         self._inbound_messages[msg['message_id']] = msg
+        self.trace_id = msg['message_id']
         self.sandbox_send(SandboxCommand(cmd="inbound-message",
                                          msg=msg.payload))
 
     def sandbox_inbound_event(self, event):
+        self.trace_id = event['user_message_id']
         self.sandbox_send(SandboxCommand(cmd="inbound-event",
                                          msg=event.payload))
 
@@ -122,32 +137,62 @@ class SandboxApi(object):
 
     @inlineCallbacks
     def dispatch_request(self, command):
+        span = self.tracer.start_span(
+            self.trace_id, 'dispatch', cmd=command['cmd'])
         resource_name, sep, rest = command['cmd'].partition('.')
         if not sep:
             resource_name, rest = '', resource_name
         command['cmd'] = rest
         resource = self.resources.resources.get(resource_name,
                                                 self.fallback_resource)
+        start = time.time()
         try:
-            reply = yield resource.dispatch_request(self, command)
+            if self.profiler is None:
+                reply = yield resource.dispatch_request(self, command)
+            else:
+                reply = yield self.profiler.call(
+                    self.sandbox_id, resource.dispatch_request, self, command)
         except Exception, e:
             # errors here are bugs in Vumi so we always log them
             # via Twisted. However, we reply to the sandbox with
             # a failure and log via the sandbox api so that the
             # sandbox owner can be notified.
             log.error()
+            span.finish(outcome='error')
+            self._record_command(resource, rest, 'error', start)
             self.log(str(e), level=logging.ERROR)
             reply = SandboxCommand(
                 reply=True,
                 cmd_id=command['cmd_id'],
                 success=False,
                 reason=unicode(e))
+        else:
+            succeeded = reply is None or reply.get('success', True)
+            outcome = 'success' if succeeded else 'failure'
+            span.finish(outcome=outcome)
+            self._record_command(resource, rest, outcome, start)
 
         if reply is not None:
             reply['cmd'] = '%s%s%s' % (resource_name, sep, rest)
             self.sandbox_send(reply)
 
+    def _record_command(self, resource, cmd, outcome, start):
+        if self.command_stats is None:
+            return
+        latency = (time.time() - start) * 1000
+        # Sandboxes may send arbitrary command names, so only commands
+        # that a resource actually handles get their own metrics.
+        if resource is self.fallback_resource:
+            resource_name, cmd = 'unknown', 'unknown'
+        else:
+            resource_name = resource.name
+            if not hasattr(resource, 'handle_%s' % (cmd,)):
+                cmd = 'unknown'
+        self.command_stats.record(
+            self.sandbox_id, resource_name, cmd, outcome, latency)
+
     def message_or_event_processed(self):
+        self.tracer.event(self.trace_id, 'message_or_event_processed')
         self.done.callback(0)
 
 
@@ -190,12 +235,63 @@ class SandboxConfig(ApplicationWorker.CONFIG_CLASS):
     sandbox_id = ConfigText("This is set based on individual messages.")
     messages_per_process = ConfigInt(
         "Number of messages to handle per process.", default=1)
+    command_metrics_prefix = ConfigText(
+        "Prefix for the latency histograms and outcome counts published"
+        " for commands dispatched by sandboxes. Set to null (the default)"
+        " to disable command metrics.", default=None, static=True)
+    command_metrics_interval = ConfigInt(
+        "Number of seconds between publishing command metrics.",
+        default=60, static=True)
+    command_metrics_buckets = ConfigList(
+        "Upper bounds, in milliseconds, of the command latency histogram"
+        " buckets.", default=list(StatsCollector.DEFAULT_BUCKETS),
+        static=True)
+    command_metrics_max_sandboxes = ConfigInt(
+        "Maximum number of sandbox ids to publish a per-sandbox breakdown"
+        " of command metrics for. Set to 0 (the default) to disable the"
+        " per-sandbox breakdown.", default=0, static=True)
+    tracing_sample_rate = ConfigFloat(
+        "Fraction of messages and events, between 0 and 1, to record"
+        " tracing spans for. Spans are recorded for finding the sandbox"
+        " process, waiting for it to start, initializing it, each command"
+        " it dispatches and the end of processing. Defaults to 0, which"
+        " disables tracing.", default=0.0, static=True)
+    tracing_exporter = ConfigDict(
+        "Exporter to send finished tracing spans to. The `cls` key gives"
+        " the full name of the exporter class and other keys are passed"
+        " to the exporter as its configuration. Defaults to appending"
+        " spans to a JSON lines file.",
+        default={'cls': 'vxsandbox.tracing.JsonLinesSpanExporter'},
+        static=True)
+    profiler_signal = ConfigText(
+        "Name of a signal (e.g. `SIGUSR2`) that starts profiling the worker"
+        " when received. Set to null (the default) to not install a signal"
+        " handler.", default=None, static=True)
+    profiler_on_startup = ConfigBool(
+        "Start profiling the worker as soon as it starts.",
+        default=False, static=True)
+    profiler_duration = ConfigInt(
+        "Number of seconds to profile the worker for each time profiling"
+        " is started.", default=30, static=True)
+    profiler_path = ConfigText(
+        "Path to write profiling results to in pstats format. May contain"
+        " `$pid` and `$timestamp` placeholders.",
+        default="sandbox-profile-$pid-$timestamp.pstats", static=True)
+    profiler_sandbox_id = ConfigText(
+        "If set, only commands from the sandbox with this id are profiled.",
+        default=None, static=True)
+
 
 class Sandbox(ApplicationWorker):
     """Sandbox application worker."""
 
     CONFIG_CLASS = SandboxConfig
 
+    command_stats = None
+    tracer = NULL_TRACER
+    profiler = None
+    _previous_profiler_handler = None
+
     KB, MB = 1024, 1024 * 1024
     DEFAULT_RLIMITS = {
         resource.RLIMIT_CORE: (1 * MB, 1 * MB),
@@ -227,9 +323,13 @@ class Sandbox(ApplicationWorker):
                 raise ConfigError("Unknown resource limit key %r" % (key,))
         return rlimits
 
+    @inlineCallbacks
     def setup_application(self):
         self._sandbox_pool = {}
-        return self.resources.setup_resources()
+        self.setup_tracing()
+        self.setup_profiler()
+        yield self.setup_command_stats()
+        yield self.resources.setup_resources()
 
     @inlineCallbacks
     def teardown_application(self):
@@ -238,6 +338,62 @@ class Sandbox(ApplicationWorker):
             # Drop (already logged) sandbox errors to avoid breaking teardown.
             yield sp["cleanup_d"].addErrback(lambda _: None)
         yield self.resources.teardown_resources()
+        if self.command_stats is not None:
+            self.command_stats.collector.stop()
+        self.tracer.close()
+        self.teardown_profiler()
+
+    def setup_tracing(self):
+        config = self.get_static_config()
+        if config.tracing_sample_rate > 0:
+            self.tracer = Tracer.from_config(
+                config.tracing_exporter, config.tracing_sample_rate)
+
+    def setup_profiler(self):
+        config = self.get_static_config()
+        if not (config.profiler_signal or config.profiler_on_startup):
+            return
+        self.profiler = ReactorProfiler(
+            config.profiler_duration, config.profiler_path,
+            sandbox_id=config.profiler_sandbox_id)
+        if config.profiler_signal:
+            name = config.profiler_signal
+            signum = None
+            if name.startswith("SIG") and not name.startswith("SIG_"):
+                signum = getattr(signal, name, None)
+            if not isinstance(signum, int):
+                raise ConfigError(
+                    "Unknown profiler signal %r" % (config.profiler_signal,))
+            self._profiler_signum = signum
+            self._previous_profiler_handler = signal.signal(
+                signum, self._profiler_signal_handler)
+        if config.profiler_on_startup:
+            self.profiler.start()
+
+    def _profiler_signal_handler(self, signum, frame):
+        reactor.callFromThread(self.profiler.start)
+
+    def teardown_profiler(self):
+        if self.profiler is None:
+            return
+        if self._previous_profiler_handler is not None:
+            signal.signal(
+                self._profiler_signum, self._previous_profiler_handler)
+            self._previous_profiler_handler = None
+        self.profiler.stop()
+
+    @inlineCallbacks
+    def setup_command_stats(self):
+        config = self.get_static_config()
+        if config.command_metrics_prefix is None:
+            return
+        collector = StatsCollector(
+            config.command_metrics_prefix,
+            buckets=config.command_metrics_buckets)
+        publisher = yield self.start_publisher(MetricPublisher)
+        collector.start(publisher, config.command_metrics_interval)
+        self.command_stats = CommandStats(
+            collector, max_sandboxes=config.command_metrics_max_sandboxes)
 
     def _get_cached_sandbox(self, msg_type):
         empty_cache = {"protocol": None, "msgs": 0}
@@ -296,7 +452,9 @@ class Sandbox(ApplicationWorker):
         return protocol
 
     def create_sandbox_api(self, resources, config):
-        return SandboxApi(resources, config)
+        return SandboxApi(
+            resources, config, command_stats=self.command_stats,
+            tracer=self.tracer, profiler=self.profiler)
 
     def sandbox_id_for_message(self, msg_or_event):
         """Return a sandbox id for a message or event.
@@ -327,9 +485,18 @@ class Sandbox(ApplicationWorker):
             cache["cleanup_d"] = d
         return cache["protocol"]
 
-    def _process_in_sandbox(self, sandbox_protocol, api_callback, msg_type):
+    def _process_in_sandbox(self, sandbox_protocol, api_callback, msg_type,
+                            trace_id=None):
+        sandbox_id = sandbox_protocol.sandbox_id
+        started_span = self.tracer.start_span(
+            trace_id, 'started', sandbox_id=sandbox_id)
+
         def on_start(_result):
+            started_span.finish()
+            init_span = self.tracer.start_span(
+                trace_id, 'sandbox_init', sandbox_id=sandbox_id)
             sandbox_protocol.api.sandbox_init()
+            init_span.finish()
             api_callback()
             d = sandbox_protocol.api.done
             d.addCallback(self._update_cached_sandbox_cb, msg_type)
@@ -343,27 +510,40 @@ class Sandbox(ApplicationWorker):
     @inlineCallbacks
     def process_message_in_sandbox(self, msg):
         config = yield self.get_config(msg)
+        trace_id = msg['message_id']
+        span = self.tracer.start_span(
+            trace_id, 'sandbox_protocol_for_message',
+            sandbox_id=config.sandbox_id)
         sandbox_protocol = yield self.sandbox_protocol_for_message(msg, config)
+        span.finish()
 
         def sandbox_init():
             sandbox_protocol.api.sandbox_inbound_message(msg)
 
         status = yield self._process_in_sandbox(
             sandbox_protocol, sandbox_init, msg["message_type"],
+            trace_id=trace_id,
         )
         returnValue(status)
 
     @inlineCallbacks
     def process_event_in_sandbox(self, event):
         config = yield self.get_config(event)
+        # Events are traced under the id of the message they refer to.
+        trace_id = event['user_message_id']
+        span = self.tracer.start_span(
+            trace_id, 'sandbox_protocol_for_message',
+            sandbox_id=config.sandbox_id, event_id=event['event_id'])
         sandbox_protocol = yield self.sandbox_protocol_for_message(
             event, config)
+        span.finish()
 
         def sandbox_init():
             sandbox_protocol.api.sandbox_inbound_event(event)
 
         status = yield self._process_in_sandbox(
             sandbox_protocol, sandbox_init, event["message_type"],
+            trace_id=trace_id,
         )
         returnValue(status)
 